@@ -20,7 +20,7 @@ class ActionCountPages(InterfaceActionBase):
     description             = 'Count number of pages/words in an ePub/Mobi to store in custom columns'
     supported_platforms     = ['windows', 'osx', 'linux']
     author                  = 'Grant Drake'
-    version                 = (1, 13, 6)
+    version                 = (1, 14, 0)
     minimum_calibre_version = (2, 0, 0)
 
     #: This field defines the GUI plugin class that contains all the code
@@ -226,7 +226,8 @@ class CountPagesAction(InterfaceAction):
                             icu_wordcount, self._queue_job, db, page_count_mode=page_count_mode, download_source=download_source)
 
     def _queue_job(self, tdir, books_to_scan, statistics_cols_map, pages_algorithm, 
-                   custom_chars_per_page, icu_wordcount, page_count_mode='Estimate', download_source=None):
+                   custom_chars_per_page, icu_wordcount, page_count_mode='Estimate', download_source=None,
+                   copy_times=None):
         if not books_to_scan:
             if tdir:
                 # All failed so cleanup our temp directory
@@ -235,9 +236,13 @@ class CountPagesAction(InterfaceAction):
 
         func = 'arbitrary_n'
         cpus = self.gui.job_manager.server.pool_size
+        c = cfg.plugin_prefs[cfg.STORE_NAME]
+        download_cache_days = c.get(cfg.KEY_DOWNLOAD_CACHE_DAYS, cfg.DEFAULT_STORE_VALUES[cfg.KEY_DOWNLOAD_CACHE_DAYS])
+        export_timings = c.get(cfg.KEY_EXPORT_TIMINGS, cfg.DEFAULT_STORE_VALUES[cfg.KEY_EXPORT_TIMINGS])
         args = ['calibre_plugins.count_pages.jobs', 'do_count_statistics',
                 (books_to_scan, pages_algorithm, self.nltk_pickle, custom_chars_per_page,
-                 icu_wordcount, page_count_mode, download_source, cpus)]
+                 icu_wordcount, page_count_mode, download_source, cpus, download_cache_days,
+                 copy_times, export_timings)]
         desc = _('Count Page/Word Statistics')
         job = self.gui.job_manager.run_job(
                 self.Dispatcher(self._get_statistics_completed), func, args=args,
@@ -11,12 +11,12 @@ try:
     from qt.core import (Qt, QWidget, QGridLayout, QLabel, QPushButton, QUrl,
                           QGroupBox, QComboBox, QVBoxLayout, QCheckBox,
                           QLineEdit, QTabWidget, QAbstractItemView,
-                          QTableWidget, QHBoxLayout, QSize, QToolButton)
+                          QTableWidget, QHBoxLayout, QSize, QToolButton, QSpinBox)
 except ImportError:
     from PyQt5.Qt import (Qt, QWidget, QGridLayout, QLabel, QPushButton, QUrl,
                           QGroupBox, QComboBox, QVBoxLayout, QCheckBox,
                           QLineEdit, QTabWidget,QAbstractItemView,
-                          QTableWidget, QHBoxLayout, QSize, QToolButton)
+                          QTableWidget, QHBoxLayout, QSize, QToolButton, QSpinBox)
 
 from calibre.gui2 import open_url, dynamic, info_dialog
 from calibre.utils.config import JSONConfig
@@ -51,6 +51,8 @@ KEY_CHECK_ALL_SOURCES = 'checkAllSources'
 KEY_DOWNLOAD_SOURCES = 'downloadSources'
 KEY_SHOW_TRY_ALL_SOURCES = 'showTryAllSources'
 KEY_USE_ICU_WORDCOUNT = 'useIcuWordcount'
+KEY_DOWNLOAD_CACHE_DAYS = 'downloadCacheDays'
+KEY_EXPORT_TIMINGS = 'exportTimings'
 
 STORE_NAME = 'Options'
 KEY_PAGES_ALGORITHM = 'algorithmPages'
@@ -147,7 +149,9 @@ DEFAULT_STORE_VALUES = {
                         KEY_USE_ICU_WORDCOUNT: True,
                         KEY_CHECK_ALL_SOURCES: True,
                         KEY_SHOW_TRY_ALL_SOURCES: True,
-                        KEY_DOWNLOAD_SOURCES: DOWNLOAD_SOURCES_DEFAULTS
+                        KEY_DOWNLOAD_SOURCES: DOWNLOAD_SOURCES_DEFAULTS,
+                        KEY_DOWNLOAD_CACHE_DAYS: 30,
+                        KEY_EXPORT_TIMINGS: False
                         }
 DEFAULT_LIBRARY_VALUES = {
                           KEY_PAGES_ALGORITHM: 0,
@@ -274,7 +278,9 @@ class ConfigWidget(QWidget):
         new_prefs[KEY_CHECK_ALL_SOURCES] = self.other_tab.check_all_checkbox.isChecked()
         new_prefs[KEY_SHOW_TRY_ALL_SOURCES] = self.other_tab.show_try_all_sources_checkbox.isChecked()
         new_prefs[KEY_DOWNLOAD_SOURCES] = self.get_source_list()
+        new_prefs[KEY_DOWNLOAD_CACHE_DAYS] = self.other_tab.download_cache_days_spin.value()
         new_prefs[KEY_ASK_FOR_CONFIRMATION] = self.other_tab.ask_for_confirmation_checkbox.isChecked()
+        new_prefs[KEY_EXPORT_TIMINGS] = self.other_tab.export_timings_checkbox.isChecked()
         new_prefs[KEY_USE_ICU_WORDCOUNT] = self.statistics_tab.icu_wordcount_checkbox.isChecked()
         plugin_prefs[STORE_NAME] = new_prefs
 
@@ -339,6 +345,8 @@ class OtherTab(QWidget):
                 if default_download_source[0] not in download_sources_names:
                     download_sources.append(default_download_source)
         show_try_all_sources = c.get(KEY_SHOW_TRY_ALL_SOURCES, DEFAULT_STORE_VALUES[KEY_SHOW_TRY_ALL_SOURCES])
+        download_cache_days = c.get(KEY_DOWNLOAD_CACHE_DAYS, DEFAULT_STORE_VALUES[KEY_DOWNLOAD_CACHE_DAYS])
+        export_timings = c.get(KEY_EXPORT_TIMINGS, DEFAULT_STORE_VALUES[KEY_EXPORT_TIMINGS])
 
         # Fudge the button default to cater for the options no longer supported by plugin as of 1.5
         if button_default in ['Estimate', 'EstimatePage', 'EstimateWord']:
@@ -393,6 +401,26 @@ class OtherTab(QWidget):
         self.check_all_checkbox.setChecked(check_all_sources)
         download_group_box_layout.addWidget(self.check_all_checkbox, 4, 0, 1, 1)
 
+        cache_layout = QHBoxLayout()
+        download_group_box_layout.addLayout(cache_layout, 5, 0, 1, 1)
+        download_cache_days_label = QLabel(_('Cache downloaded page counts for (days):'), self)
+        toolTip = _('Page counts downloaded for a book identifier are remembered for\n'
+                    'this many days, so downloading again for the same identifiers\n'
+                    'will not contact the website. Set to 0 to disable the cache.')
+        download_cache_days_label.setToolTip(toolTip)
+        self.download_cache_days_spin = QSpinBox(self)
+        self.download_cache_days_spin.setRange(0, 3650)
+        self.download_cache_days_spin.setValue(download_cache_days)
+        self.download_cache_days_spin.setToolTip(toolTip)
+        download_cache_days_label.setBuddy(self.download_cache_days_spin)
+        clear_cache_button = QPushButton(_('Clear cache'), self)
+        clear_cache_button.setToolTip(_('Remove all previously downloaded page counts from the cache'))
+        clear_cache_button.clicked.connect(self.clear_download_cache)
+        cache_layout.addWidget(download_cache_days_label)
+        cache_layout.addWidget(self.download_cache_days_spin)
+        cache_layout.addWidget(clear_cache_button)
+        cache_layout.addStretch(1)
+
         # --- Other options ---
         layout.addSpacing(5)
         other_group_box = QGroupBox(_('Other options:'), self)
@@ -449,6 +477,13 @@ class OtherTab(QWidget):
         self.ask_for_confirmation_checkbox.setChecked(ask_for_confirmation)
         other_group_box_layout.addWidget(self.ask_for_confirmation_checkbox, 4, 0, 1, 3)
 
+        self.export_timings_checkbox = QCheckBox(_('Save timing report as JSON'), self)
+        self.export_timings_checkbox.setToolTip(_('Check this option to write the per book timing breakdown shown\n'
+                                                  'in the job log to "Count Pages Timings.json" in the plugins\n'
+                                                  'folder of your calibre configuration directory.'))
+        self.export_timings_checkbox.setChecked(export_timings)
+        other_group_box_layout.addWidget(self.export_timings_checkbox, 5, 0, 1, 3)
+
         button_layout = QHBoxLayout()
         keyboard_shortcuts_button = QPushButton(' '+_('Keyboard shortcuts')+'... ', self)
         keyboard_shortcuts_button.setToolTip(_('Edit the keyboard shortcuts associated with this plugin'))
@@ -465,6 +500,12 @@ class OtherTab(QWidget):
         button_layout.addWidget(help_button)
         layout.addLayout(button_layout)
 
+    def clear_download_cache(self):
+        from calibre_plugins.count_pages.download import clear_download_cache
+        clear_download_cache()
+        info_dialog(self, _('Done'),
+                _('Downloaded page count cache has been cleared'), show=True)
+
     def reset_dialogs(self):
         for key in dynamic.keys():
             if key.startswith('reading_list_') and key.endswith('_again') \
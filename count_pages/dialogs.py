@@ -3,7 +3,7 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake'
 
-import os, traceback
+import os, traceback, time
 from collections import OrderedDict
 try:
     from qt.core import QProgressDialog, QTimer
@@ -50,6 +50,7 @@ class QueueProgressDialog(QProgressDialog):
         self.icu_wordcount = icu_wordcount
         self.gui = gui
         self.i, self.books_to_scan = 0, []
+        self.copy_times = {}
         self.bad = OrderedDict()
         self.warnings = []
         self.input_order = []
@@ -158,8 +159,10 @@ class QueueProgressDialog(QProgressDialog):
                 try:
                     # Copy the book to the temp directory, using book id as filename
                     dest_file = os.path.join(self.tdir, '%d.%s'%(book_id, bf.lower()))
+                    start = time.time()
                     with open(dest_file, 'w+b') as f:
                         self.db.copy_format_to(book_id, bf, f, index_is_id=True)
+                    self.copy_times[book_id] = time.time() - start
                     self.books_to_scan.append((book_id, title_author, dest_file,
                                                 download_sources, statistics_to_run))
                     found_format = True
@@ -204,4 +207,5 @@ class QueueProgressDialog(QProgressDialog):
         self.gui = None
         # Queue a job to process these books
         self.queue(self.tdir, self.books_to_scan, self.statistics_cols_map,
-                   self.pages_algorithm, self.custom_chars_per_page, self.icu_wordcount, self.page_count_mode, self.download_source)
+                   self.pages_algorithm, self.custom_chars_per_page, self.icu_wordcount, self.page_count_mode, self.download_source,
+                   copy_times=self.copy_times)
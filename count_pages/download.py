@@ -3,16 +3,24 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake'
 
-import socket, re, random
+import os, socket, re, random, json, time, traceback
+from threading import Thread, Lock
 
 from six import text_type as unicode
+from six.moves.queue import Queue, Empty
+from six.moves.urllib.parse import urlparse
 
 from lxml.html import fromstring, tostring
 from calibre import browser
 from calibre.constants import numeric_version as calibre_version
+from calibre.utils.config import config_dir
 
 from calibre_plugins.count_pages.config import PAGE_DOWNLOADS
 
+DOWNLOAD_CACHE_FILE = 'plugins/Count Pages Download Cache.json'
+MAX_CONCURRENT_DOWNLOADS = 4
+HOST_REQUEST_INTERVAL = 1.0 # Minimum seconds between requests to the same website
+
 def clean_html(raw):
     from calibre.ebooks.chardet import xml_to_unicode
     from calibre.utils.cleantext import clean_ascii_chars
@@ -24,16 +32,35 @@ def parse_html(raw):
     from html5_parser import parse
     return parse(raw, maybe_xhtml=False, sanitize_names=True, return_root=False,keep_doctype=False)
 
+def get_user_agent():
+    # This utter filth is necessary to deal with periods of time when calibre did or did not have
+    # various iterations of a random chrome user agent function.
+    if calibre_version >= (5,40,0):
+        from calibre.utils.random_ua import random_common_chrome_user_agent
+        return random_common_chrome_user_agent()
+    elif  calibre_version <= (5,8,1):
+        from calibre.utils.random_ua import random_chrome_ua
+        return random_chrome_ua()
+    else:
+        # From 5.9.0 to 5.39.1 there was no function, we will have to replicate the equivalent code here
+        from calibre.utils.random_ua import all_chrome_versions, random_desktop_platform
+        chrome_version = random.choice(all_chrome_versions())
+        render_chrome_version = 'Mozilla/5.0 ({p}) AppleWebKit/{wv} (KHTML, like Gecko) Chrome/{cv} Safari/{wv}'.format(
+            p=random_desktop_platform(), wv=chrome_version['webkit_version'], cv=chrome_version['chrome_version'])
+        return render_chrome_version
+
 
 class DownloadPagesWorker():
     '''
     Get page count from book book page
     '''
-    def __init__(self, sources, timeout=20):
+    def __init__(self, sources, timeout=20, br=None, rate_limiter=None):
         self.timeout = timeout
         self.page_count = None
-        self.page_count = None
+        self.source_name = None
         self.sources = sources
+        self.br = br
+        self.rate_limiter = rate_limiter
         self.run()
 
     def run(self):
@@ -61,26 +88,14 @@ class DownloadPagesWorker():
 
     @property
     def user_agent(self):
-        # This utter filth is necessary to deal with periods of time when calibre did or did not have
-        # various iterations of a random chrome user agent function.
-        if calibre_version >= (5,40,0):
-            from calibre.utils.random_ua import random_common_chrome_user_agent
-            return random_common_chrome_user_agent()
-        elif  calibre_version <= (5,8,1):
-            from calibre.utils.random_ua import random_chrome_ua
-            return random_chrome_ua()
-        else:
-            # From 5.9.0 to 5.39.1 there was no function, we will have to replicate the equivalent code here
-            from calibre.utils.random_ua import all_chrome_versions, random_desktop_platform
-            chrome_version = random.choice(all_chrome_versions())
-            render_chrome_version = 'Mozilla/5.0 ({p}) AppleWebKit/{wv} (KHTML, like Gecko) Chrome/{cv} Safari/{wv}'.format(
-                p=random_desktop_platform(), wv=chrome_version['webkit_version'], cv=chrome_version['chrome_version'])
-            return render_chrome_version
+        return get_user_agent()
 
     def _get_details(self):
         try:
             print('Download source book url: %r'%self.url)
-            br = browser(user_agent=self.user_agent)
+            br = self.br if self.br is not None else browser(user_agent=self.user_agent)
+            if self.rate_limiter is not None:
+                self.rate_limiter.wait(self.url)
             raw = br.open_novisit(self.url, timeout=self.timeout).read().strip()
         except Exception as e:
             if callable(getattr(e, 'getcode', None)) and \
@@ -150,3 +165,197 @@ class DownloadPagesWorker():
             print('Error parsing page count for url: %r'%self.url)
             print('exceptions: %s' % e)
         print("_parse_page_count: end")
+
+
+class PageCountCache(object):
+    '''
+    On-disk cache of page counts previously downloaded, keyed by source and
+    identifier. Entries older than the configured number of days are ignored.
+    '''
+    def __init__(self, cache_days, path=None):
+        self.ttl = cache_days * 24 * 60 * 60
+        self.path = path or os.path.join(config_dir, DOWNLOAD_CACHE_FILE)
+        self.lock = Lock()
+        self.is_dirty = False
+        self.entries = {}
+        if self.ttl > 0:
+            self._load()
+
+    def _key(self, source_name, source_id):
+        return '%s:%s' % (source_name, source_id)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                self.entries = json.loads(f.read().decode('utf-8'))
+        except:
+            print('Failed to read page count download cache: %s' % self.path)
+            traceback.print_exc()
+            self.entries = {}
+
+    def get(self, source_name, source_id):
+        if self.ttl <= 0:
+            return None
+        with self.lock:
+            entry = self.entries.get(self._key(source_name, source_id))
+        if entry and time.time() - entry['timestamp'] < self.ttl:
+            return entry['pages']
+        return None
+
+    def set(self, source_name, source_id, pages):
+        if self.ttl <= 0 or not pages:
+            return
+        with self.lock:
+            self.entries[self._key(source_name, source_id)] = {'pages': pages, 'timestamp': time.time()}
+            self.is_dirty = True
+
+    def save(self):
+        if not self.is_dirty:
+            return
+        with self.lock:
+            # Drop anything expired so the file does not grow forever
+            now = time.time()
+            self.entries = dict((k, v) for k, v in self.entries.items() if now - v['timestamp'] < self.ttl)
+            try:
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(json.dumps(self.entries).encode('utf-8'))
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                os.rename(tmp_path, self.path)
+                self.is_dirty = False
+            except:
+                print('Failed to write page count download cache: %s' % self.path)
+                traceback.print_exc()
+
+
+def clear_download_cache():
+    path = os.path.join(config_dir, DOWNLOAD_CACHE_FILE)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class HostRateLimiter(object):
+    '''
+    Spaces out requests to the same website by a minimum interval, shared
+    across all download threads.
+    '''
+    def __init__(self, interval=HOST_REQUEST_INTERVAL):
+        self.interval = interval
+        self.lock = Lock()
+        self.next_request_time = {}
+
+    def wait(self, url):
+        host = urlparse(url).netloc.lower()
+        with self.lock:
+            now = time.time()
+            request_time = max(now, self.next_request_time.get(host, now))
+            self.next_request_time[host] = request_time + self.interval
+        if request_time > now:
+            time.sleep(request_time - now)
+
+
+class DownloadPagesThread(Thread):
+    '''
+    Worker thread taking (source_name, source_id) keys off a shared queue,
+    reusing a single browser for all of its requests.
+    '''
+    def __init__(self, keys_queue, results_queue, rate_limiter, timeout):
+        Thread.__init__(self)
+        self.daemon = True
+        self.keys_queue = keys_queue
+        self.results_queue = results_queue
+        self.rate_limiter = rate_limiter
+        self.timeout = timeout
+
+    def run(self):
+        try:
+            br = browser(user_agent=get_user_agent())
+        except:
+            traceback.print_exc()
+            br = None
+        while True:
+            try:
+                key = self.keys_queue.get_nowait()
+            except Empty:
+                break
+            page_count = None
+            try:
+                worker = DownloadPagesWorker([key], timeout=self.timeout, br=br,
+                                             rate_limiter=self.rate_limiter)
+                page_count = worker.page_count
+            except:
+                traceback.print_exc()
+            self.results_queue.put((key, page_count))
+
+
+class DownloadPagesEngine(object):
+    '''
+    Download page counts for a whole batch of books. Each distinct
+    (source, identifier) is fetched at most once, using a bounded number of
+    threads and a per-website rate limit, with results cached on disk.
+    '''
+    def __init__(self, cache_days=0, max_workers=MAX_CONCURRENT_DOWNLOADS, timeout=20,
+                 notification=lambda x, y:x):
+        self.cache = PageCountCache(cache_days)
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.notification = notification
+        self.rate_limiter = HostRateLimiter()
+
+    def download(self, books_sources):
+        '''
+        books_sources is a dict of book_id to a list of (source_name, source_id) in
+        order of preference. Each book tries its sources in turn until a page
+        count is found. Returns a dict of book_id to (page_count, source_name).
+        '''
+        results = {}
+        pending = dict((book_id, list(sources)) for book_id, sources in books_sources.items() if sources)
+        try:
+            while pending:
+                keys = set(tuple(sources[0]) for sources in pending.values())
+                page_counts = {}
+                keys_to_fetch = []
+                for key in keys:
+                    pages = self.cache.get(*key)
+                    if pages:
+                        print('Using cached page count for %s:%s - %d' % (key[0], key[1], pages))
+                        page_counts[key] = pages
+                    else:
+                        keys_to_fetch.append(key)
+                page_counts.update(self._fetch_all(keys_to_fetch))
+
+                for book_id in list(pending.keys()):
+                    sources = pending[book_id]
+                    key = tuple(sources.pop(0))
+                    pages = page_counts.get(key)
+                    if pages:
+                        results[book_id] = (pages, key[0])
+                    if pages or not sources:
+                        del pending[book_id]
+                        if not pages:
+                            results[book_id] = (None, None)
+        finally:
+            self.cache.save()
+        return results
+
+    def _fetch_all(self, keys):
+        page_counts = {}
+        if not keys:
+            return page_counts
+        keys_queue = Queue()
+        for key in keys:
+            keys_queue.put(key)
+        results_queue = Queue()
+        threads = [DownloadPagesThread(keys_queue, results_queue, self.rate_limiter, self.timeout)
+                   for i in range(min(self.max_workers, len(keys)))]
+        for thread in threads:
+            thread.start()
+        for count in range(1, len(keys) + 1):
+            key, page_count = results_queue.get()
+            page_counts[key] = page_count
+            self.cache.set(key[0], key[1], page_count)
+            self.notification(float(count) / len(keys), 'Downloading page counts')
+        return page_counts
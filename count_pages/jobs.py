@@ -12,11 +12,15 @@ from calibre.utils.ipc.server import Server
 from calibre.utils.ipc.job import ParallelJob
 
 import calibre_plugins.count_pages.config as cfg
-from calibre_plugins.count_pages.download import DownloadPagesWorker
+from calibre_plugins.count_pages.download import DownloadPagesWorker, DownloadPagesEngine
+from calibre_plugins.count_pages.profiling import (StageTimings, summarise_timings,
+                                    print_timings_summary, export_timings_json, TIMINGS_RESULT_KEY,
+                                    STAGE_COPY, STAGE_DOWNLOAD, STAGE_OPEN, STAGE_PAGES, STAGE_WORDS,
+                                    STAGE_ANALYSIS, STAGE_CLEANUP)
 from calibre_plugins.count_pages.statistics import (get_page_count, get_pdf_page_count,
                                     get_word_count, get_text_analysis, get_gunning_fog_index,
                                     get_flesch_reading_ease, get_flesch_kincaid_grade_level,
-                                    get_cbr_page_count, get_cbz_page_count)
+                                    get_cbr_page_count, get_cbz_page_count, open_epub_file)
 
 
 def call_plugin_callback(plugin_callback, parent, plugin_results=None):
@@ -60,14 +64,57 @@ def call_plugin_callback(plugin_callback, parent, plugin_results=None):
 
 def do_count_statistics(books_to_scan, pages_algorithm,
                         nltk_pickle, custom_chars_per_page, icu_wordcount,
-                        page_count_mode, download_sources, cpus, notification=lambda x, y:x):
+                        page_count_mode, download_sources, cpus,
+                        download_cache_days=cfg.DEFAULT_STORE_VALUES[cfg.KEY_DOWNLOAD_CACHE_DAYS],
+                        copy_times=None, export_timings=False,
+                        notification=lambda x, y:x):
     '''
     Master job, to launch child jobs to count pages in this list of books
     '''
+    book_stats_map = dict()
+    book_timings = dict()
+    for book_id, seconds in (copy_times or {}).items():
+        book_timings[book_id] = {'stages': {STAGE_COPY: seconds}}
+
+    # Any page counts to be downloaded are fetched for the whole batch up front,
+    # so that books sharing an identifier or with a cached result do not each
+    # make their own requests. The child jobs then only compute the other statistics.
+    books_download_sources = {}
+    if page_count_mode == 'Download':
+        for book_id, title, book_path, book_download_sources, statistics_to_run in books_to_scan:
+            if book_download_sources and cfg.STATISTIC_PAGE_COUNT in statistics_to_run:
+                books_download_sources[book_id] = book_download_sources
+    if books_download_sources:
+        notification(0.01, 'Downloading page counts')
+        engine = DownloadPagesEngine(cache_days=download_cache_days, notification=notification)
+        start = time.time()
+        downloaded = engine.download(books_download_sources)
+        # Downloads are done as a batch, so attribute an equal share to each book
+        download_share = (time.time() - start) / len(books_download_sources)
+        print('-------------------------------')
+        for book_id, title, book_path, book_download_sources, statistics_to_run in books_to_scan:
+            if book_id not in books_download_sources:
+                continue
+            pages, source_name = downloaded.get(book_id, (None, None))
+            book_stats_map[book_id] = {cfg.STATISTIC_PAGE_COUNT: pages}
+            book_timings.setdefault(book_id, {'stages': {}})['stages'][STAGE_DOWNLOAD] = download_share
+            print('Page count download for book ID %d (%s)' % (book_id, title))
+            print('\tMethod of counting _page_count_mode=%s _download_sources=%s' % (page_count_mode, book_download_sources))
+            if pages:
+                print('\tDownloaded page count from %s: %d' % (cfg.PAGE_DOWNLOADS[source_name]['name'], pages))
+            else:
+                print('\tFAILED TO GET PAGE COUNT FROM WEBSITE')
+
     server = Server(pool_size=cpus)
 
     # Queue all the jobs
+    total = 0
     for book_id, title, book_path, download_sources, statistics_to_run in books_to_scan:
+        if book_id in books_download_sources:
+            statistics_to_run = [s for s in statistics_to_run if s != cfg.STATISTIC_PAGE_COUNT]
+            if not statistics_to_run or not book_path:
+                continue
+            download_sources = None
         args = ['calibre_plugins.count_pages.jobs', 'do_statistics_for_book',
                 (book_path, pages_algorithm, page_count_mode, download_sources, 
                  statistics_to_run, nltk_pickle, custom_chars_per_page, icu_wordcount)]
@@ -83,6 +130,7 @@ def do_count_statistics(books_to_scan, pages_algorithm,
         job._page_count_mode = page_count_mode
         job._statistics_to_run = statistics_to_run
         server.add_job(job)
+        total += 1
         print("do_count_statistics - job started for file book_path=%s" % book_path)
 
     # This server is an arbitrary_n job, so there is a notifier available.
@@ -90,10 +138,8 @@ def do_count_statistics(books_to_scan, pages_algorithm,
     notification(0.01, 'Counting Statistics')
 
     # dequeue the job results as they arrive, saving the results
-    total = len(books_to_scan)
     count = 0
-    book_stats_map = dict()
-    while True:
+    while count < total:
         job = server.changed_jobs_queue.get()
         # A job can 'change' when it is not finished, for example if it
         # produces a notification. Ignore these.
@@ -103,7 +149,14 @@ def do_count_statistics(books_to_scan, pages_algorithm,
         # A job really finished. Get the information.
         results = job.result
         book_id = job._book_id
-        book_stats_map[book_id] = results
+        if results and TIMINGS_RESULT_KEY in results:
+            timings = results.pop(TIMINGS_RESULT_KEY)
+            timings['stages'].update(book_timings.get(book_id, {}).get('stages', {}))
+            book_timings[book_id] = timings
+        if book_id in book_stats_map:
+            book_stats_map[book_id].update(results)
+        else:
+            book_stats_map[book_id] = results
         count = count + 1
         notification(float(count) / total, 'Counting Statistics')
 
@@ -138,13 +191,21 @@ def do_count_statistics(books_to_scan, pages_algorithm,
                 if stat in results and results[stat]:
                     print('\tComputed %.1f Gunning Fog Index' % results[stat])
 
+        if book_id in book_timings:
+            print('\tTimings: ' + ', '.join('%s=%.3fs' % (name, seconds)
+                                         for name, seconds in book_timings[book_id]['stages'].items()))
         print(job.details)
 
-        if count >= total:
-            # All done!
-            break
-
     server.close()
+
+    if book_timings:
+        for book_id, title, book_path, book_download_sources, statistics_to_run in books_to_scan:
+            if book_id in book_timings:
+                book_timings[book_id]['title'] = title
+        summary = summarise_timings(book_timings)
+        print_timings_summary(summary)
+        if export_timings:
+            export_timings_json(book_timings, summary)
     # return the map as the job result
     return book_stats_map
 
@@ -156,6 +217,7 @@ def do_statistics_for_book(book_path, pages_algorithm, page_count_mode,
     Child job, to count statistics in this specific book
     '''
     results = {}
+    timings = StageTimings()
     try:
         iterator = None
         print("do_statistics_for_book: ", book_path, pages_algorithm, page_count_mode, 
@@ -180,15 +242,21 @@ def do_statistics_for_book(book_path, pages_algorithm, page_count_mode,
                             if pages:
                                 results['download_source'] = goodreads_worker.source_name
                     else:
-                        if extension == '.pdf':
-                            # As an optimisation for PDFs we will read the page count directly
-                            pages = get_pdf_page_count(book_path)
-                        elif extension == '.cbr':
-                            pages = get_cbr_page_count(book_path)
-                        elif extension == '.cbz':
-                            pages = get_cbz_page_count(book_path)
-                        else:
-                            iterator, pages = get_page_count(iterator, book_path, pages_algorithm, custom_chars_per_page)
+                        # Open the book up front so its time is reported under the open stage,
+                        # unless the Adobe algorithm can read the page count from the ePub archive
+                        if extension not in ['.pdf', '.cbr', '.cbz'] and \
+                                not (pages_algorithm == 2 and extension == '.epub'):
+                            iterator = _open_iterator(iterator, book_path, timings)
+                        with timings.stage(STAGE_PAGES):
+                            if extension == '.pdf':
+                                # As an optimisation for PDFs we will read the page count directly
+                                pages = get_pdf_page_count(book_path)
+                            elif extension == '.cbr':
+                                pages = get_cbr_page_count(book_path)
+                            elif extension == '.cbz':
+                                pages = get_cbz_page_count(book_path)
+                            else:
+                                iterator, pages = get_page_count(iterator, book_path, pages_algorithm, custom_chars_per_page)
                     results[cfg.STATISTIC_PAGE_COUNT] = pages
 
                 if is_comic:
@@ -197,7 +265,9 @@ def do_statistics_for_book(book_path, pages_algorithm, page_count_mode,
                 else:
                     if cfg.STATISTIC_WORD_COUNT in stats:
                         stats.remove(cfg.STATISTIC_WORD_COUNT)
-                        iterator, words = get_word_count(iterator, book_path, icu_wordcount)
+                        iterator = _open_iterator(iterator, book_path, timings)
+                        with timings.stage(STAGE_WORDS):
+                            iterator, words = get_word_count(iterator, book_path, icu_wordcount)
                         if words == 0:
                             # Something dodgy about the conversion - no point in calculating remaining stats
                             print('ERROR: No words found in this book (conversion error?), word count will not be stored')
@@ -208,7 +278,9 @@ def do_statistics_for_book(book_path, pages_algorithm, page_count_mode,
                         # The remaining stats are all reading level based
                         # As an optimisation, we will run the text analysis once and
                         # then add the relevant results
-                        iterator, text_analysis = get_text_analysis(iterator, book_path, nltk_pickle)
+                        iterator = _open_iterator(iterator, book_path, timings)
+                        with timings.stage(STAGE_ANALYSIS):
+                            iterator, text_analysis = get_text_analysis(iterator, book_path, nltk_pickle)
                         if text_analysis['wordCount'] == 0:
                             # Something dodgy about the conversion - no point in calculating remaining stats
                             print('ERROR: No words found in this book (conversion error?) - readability statistics will not be calculated')
@@ -224,13 +296,15 @@ def do_statistics_for_book(book_path, pages_algorithm, page_count_mode,
                         if cfg.STATISTIC_GUNNING_FOG in statistics_to_run:
                             results[cfg.STATISTIC_GUNNING_FOG] = get_gunning_fog_index(text_analysis)
             finally:
-                if iterator:
-                    iterator.__exit__()
-                    iterator = None
-                if book_path is not None:
-                    if os.path.exists(book_path):
-                        time.sleep(0.1)
-                        cleanup(book_path)
+                with timings.stage(STAGE_CLEANUP):
+                    if iterator:
+                        iterator.__exit__()
+                        iterator = None
+                    if book_path is not None:
+                        if os.path.exists(book_path):
+                            time.sleep(0.1)
+                            cleanup(book_path)
+                results[TIMINGS_RESULT_KEY] = timings.as_dict()
         return results
     except DRMError:
         print('\tCannot read pages due to DRM Encryption')
@@ -239,3 +313,13 @@ def do_statistics_for_book(book_path, pages_algorithm, page_count_mode,
         traceback.print_exc()
         return results
 
+
+
+def _open_iterator(iterator, book_path, timings):
+    '''
+    Open the book with an EbookIterator if not already opened, recording the time taken
+    '''
+    if iterator is None:
+        with timings.stage(STAGE_OPEN):
+            iterator = open_epub_file(book_path)
+    return iterator
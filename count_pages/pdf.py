@@ -0,0 +1,345 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import mmap, os, re, zlib
+
+# Reading the page count of a PDF without loading the whole file into memory.
+# We memory-map the file and only touch the handful of bytes we need:
+#  - the linearization dictionary at the start of the file (if any), which
+#    directly states the number of pages
+#  - otherwise the startxref pointer at the end of the file, the cross-reference
+#    table(s) or stream(s) it points to, the trailer /Root catalog and finally
+#    the /Count of the root /Pages node of the page tree.
+# Anything unexpected raises PDFPageCountError so the caller can fall back to podofo.
+
+HEADER_SCAN_SIZE = 1024
+TRAILER_SCAN_SIZE = 2048
+MAX_OBJECT_SCAN_SIZE = 65536
+MAX_XREF_SECTIONS = 256
+
+RE_LINEARIZED = re.compile(br'<<[^>]*?/Linearized\s')
+RE_STARTXREF = re.compile(br'startxref\s+(\d+)')
+RE_OBJ_HEADER = re.compile(br'\s*(\d+)\s+(\d+)\s+obj\b')
+RE_XREF_SUBSECTION = re.compile(br'\s*(\d+)\s+(\d+)\s*[\r\n]')
+RE_XREF_ENTRY = re.compile(br'\s*(\d{10})\s(\d{5})\s([nf])')
+RE_FILTER = re.compile(br'/Filter\s*(?:(/\w+)|\[([^\]]*)\])')
+RE_INT_KEY = br'/%s\s+(\d+)\b(?!\s+\d+\s+R)'
+RE_REF_KEY = br'/%s\s+(\d+)\s+(\d+)\s+R'
+
+
+class PDFPageCountError(Exception):
+    pass
+
+
+def get_pdf_page_count_fast(book_path):
+    '''
+    Read the page count of a PDF straight from its cross-reference data
+    using a memory-mapped view of the file. Raises PDFPageCountError if the
+    file structure is not something we can handle.
+    '''
+    with open(book_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise PDFPageCountError('Empty file')
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            reader = PDFPageCountReader(mm)
+            page_count = reader.get_linearized_page_count()
+            if page_count is not None:
+                print('\tPDF page count using linearization hint:', page_count)
+                return page_count
+            page_count = reader.get_page_tree_count()
+            print('\tPDF page count using page tree root:', page_count)
+            return page_count
+        finally:
+            mm.close()
+
+
+class PDFPageCountReader(object):
+    '''
+    Minimal parser for just enough of the PDF object structure to find the
+    /Count of the page tree root.
+    '''
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+        self.xref = None
+        self.trailer = None
+        self._object_streams = {}
+
+    def get_linearized_page_count(self):
+        '''
+        A linearized PDF has a dictionary as its first object stating the
+        total number of pages (/N) and the file length (/L). If the file has
+        since been incrementally updated the length will no longer match, in
+        which case the hint cannot be trusted.
+        '''
+        header = self.data[:HEADER_SCAN_SIZE]
+        m = RE_LINEARIZED.search(header)
+        if not m:
+            return None
+        end = header.find(b'>>', m.start())
+        if end == -1:
+            return None
+        lin_dict = header[m.start():end]
+        length = _get_int(lin_dict, b'L')
+        pages = _get_int(lin_dict, b'N')
+        if length != self.size or not pages:
+            return None
+        return pages
+
+    def get_page_tree_count(self):
+        self._read_xref()
+        root_ref = _get_ref(self.trailer, b'Root')
+        if root_ref is None:
+            raise PDFPageCountError('No /Root in trailer')
+        catalog = self._get_object(root_ref)
+        pages_ref = _get_ref(catalog, b'Pages')
+        if pages_ref is None:
+            raise PDFPageCountError('No /Pages in catalog')
+        pages = self._get_object(pages_ref)
+        count = _get_int(pages, b'Count')
+        if count is None:
+            count_ref = _get_ref(pages, b'Count')
+            if count_ref is None:
+                raise PDFPageCountError('No /Count in page tree root')
+            count = _get_int(b'/Count ' + self._get_object(count_ref).strip(), b'Count')
+        if not count:
+            raise PDFPageCountError('Page tree root has no pages')
+        return count
+
+    def _read_xref(self):
+        tail = self.data[max(0, self.size - TRAILER_SCAN_SIZE):]
+        matches = list(RE_STARTXREF.finditer(tail))
+        if not matches:
+            raise PDFPageCountError('No startxref found')
+        offset = int(matches[-1].group(1))
+
+        self.xref = {}
+        seen = set()
+        while offset is not None:
+            if offset in seen or len(seen) > MAX_XREF_SECTIONS or offset >= self.size:
+                raise PDFPageCountError('Invalid xref chain')
+            seen.add(offset)
+            if self.data[offset:offset+4] == b'xref':
+                trailer = self._read_xref_table(offset)
+            else:
+                trailer = self._read_xref_stream(offset)
+            if self.trailer is None:
+                self.trailer = trailer
+            # Hybrid-reference files keep their xref stream in /XRefStm
+            xref_stm = _get_int(trailer, b'XRefStm')
+            if xref_stm is not None and xref_stm not in seen:
+                seen.add(xref_stm)
+                self._read_xref_stream(xref_stm)
+            offset = _get_int(trailer, b'Prev')
+
+    def _add_xref_entry(self, obj_num, entry):
+        # Newer sections are read first so must not be overwritten by older ones.
+        # Free entries are never recorded, which lets the /XRefStm of a hybrid
+        # file supply the compressed objects its classic table lists as free.
+        if obj_num not in self.xref:
+            self.xref[obj_num] = entry
+
+    def _read_xref_table(self, offset):
+        pos = offset + 4
+        while True:
+            m = RE_XREF_SUBSECTION.match(self.data, pos)
+            if not m:
+                break
+            start, count = int(m.group(1)), int(m.group(2))
+            pos = m.end()
+            for i in range(count):
+                e = RE_XREF_ENTRY.match(self.data, pos)
+                if not e:
+                    raise PDFPageCountError('Malformed xref table')
+                pos = e.end()
+                if e.group(3) == b'n':
+                    self._add_xref_entry(start + i, (1, int(e.group(1))))
+        trailer_pos = self.data.find(b'trailer', pos, pos + 64)
+        if trailer_pos == -1:
+            raise PDFPageCountError('No trailer after xref table')
+        return self._read_dict(trailer_pos + 7)
+
+    def _read_xref_stream(self, offset):
+        obj_dict, stream = self._read_stream_object(offset)
+        if b'/XRef' not in obj_dict:
+            raise PDFPageCountError('startxref does not point to an xref')
+        widths = _get_array(obj_dict, b'W')
+        if not widths or len(widths) != 3:
+            raise PDFPageCountError('Invalid /W in xref stream')
+        size = _get_int(obj_dict, b'Size')
+        index = _get_array(obj_dict, b'Index') or [0, size]
+        row_size = sum(widths)
+        row = 0
+        for i in range(0, len(index) - 1, 2):
+            start, count = index[i], index[i+1]
+            for obj_num in range(start, start + count):
+                data = stream[row * row_size:(row + 1) * row_size]
+                if len(data) < row_size:
+                    raise PDFPageCountError('Truncated xref stream')
+                row += 1
+                fields = []
+                pos = 0
+                for w in widths:
+                    fields.append(_bytes_to_int(data[pos:pos+w]))
+                    pos += w
+                # Type defaults to 1 when the field width is zero
+                entry_type = fields[0] if widths[0] else 1
+                if entry_type in (1, 2):
+                    self._add_xref_entry(obj_num, (entry_type, fields[1], fields[2]))
+        return obj_dict
+
+    def _get_object(self, ref):
+        obj_num = ref[0]
+        entry = self.xref.get(obj_num)
+        if entry is None:
+            raise PDFPageCountError('Object %d not in xref' % obj_num)
+        if entry[0] == 1:
+            m = RE_OBJ_HEADER.match(self.data, entry[1])
+            if not m or int(m.group(1)) != obj_num:
+                raise PDFPageCountError('Xref offset mismatch for object %d' % obj_num)
+            end = self.data.find(b'endobj', m.end(), m.end() + MAX_OBJECT_SCAN_SIZE)
+            if end == -1:
+                raise PDFPageCountError('Object %d is not terminated' % obj_num)
+            return self.data[m.end():end]
+        return self._get_compressed_object(obj_num, entry[1])
+
+    def _get_compressed_object(self, obj_num, stream_num):
+        objects = self._object_streams.get(stream_num)
+        if objects is None:
+            entry = self.xref.get(stream_num)
+            if entry is None or entry[0] != 1:
+                raise PDFPageCountError('Object stream %d not in xref' % stream_num)
+            obj_dict, stream = self._read_stream_object(entry[1])
+            n = _get_int(obj_dict, b'N')
+            first = _get_int(obj_dict, b'First')
+            if n is None or first is None:
+                raise PDFPageCountError('Invalid object stream %d' % stream_num)
+            header = [int(x) for x in stream[:first].split()]
+            offsets = [(header[i], first + header[i+1]) for i in range(0, 2 * n, 2)]
+            objects = {}
+            for i, (num, start) in enumerate(offsets):
+                end = offsets[i+1][1] if i + 1 < len(offsets) else len(stream)
+                objects[num] = stream[start:end]
+            self._object_streams[stream_num] = objects
+        if obj_num not in objects:
+            raise PDFPageCountError('Object %d not in object stream %d' % (obj_num, stream_num))
+        return objects[obj_num]
+
+    def _read_dict(self, pos):
+        start, end = self._find_dict(pos)
+        return self.data[start:end]
+
+    def _find_dict(self, pos):
+        start = self.data.find(b'<<', pos, pos + 64)
+        if start == -1:
+            raise PDFPageCountError('Expected dictionary at %d' % pos)
+        depth = 0
+        i = start
+        end = min(self.size, start + MAX_OBJECT_SCAN_SIZE)
+        while i < end - 1:
+            pair = self.data[i:i+2]
+            if pair == b'<<':
+                depth += 1
+                i += 2
+                continue
+            if pair == b'>>':
+                depth -= 1
+                i += 2
+                if depth == 0:
+                    return start, i
+                continue
+            i += 1
+        raise PDFPageCountError('Unterminated dictionary at %d' % pos)
+
+    def _read_stream_object(self, offset):
+        m = RE_OBJ_HEADER.match(self.data, offset)
+        if not m:
+            raise PDFPageCountError('No object at offset %d' % offset)
+        dict_start, dict_end = self._find_dict(m.end())
+        obj_dict = self.data[dict_start:dict_end]
+        stream_pos = self.data.find(b'stream', dict_end, dict_end + 64)
+        if stream_pos == -1:
+            raise PDFPageCountError('No stream for object at %d' % offset)
+        stream_pos += 6
+        if self.data[stream_pos:stream_pos+2] == b'\r\n':
+            stream_pos += 2
+        elif self.data[stream_pos:stream_pos+1] in (b'\r', b'\n'):
+            stream_pos += 1
+        length = _get_int(obj_dict, b'Length')
+        if length is None:
+            # An indirect /Length, look it up
+            length_ref = _get_ref(obj_dict, b'Length')
+            if length_ref is None or not self.xref or length_ref[0] not in self.xref:
+                raise PDFPageCountError('Cannot determine stream length at %d' % offset)
+            length = int(self._get_object(length_ref).split()[0])
+        raw = self.data[stream_pos:stream_pos+length]
+        return obj_dict, _decode_stream(obj_dict, raw)
+
+
+def _decode_stream(obj_dict, raw):
+    m = RE_FILTER.search(obj_dict)
+    if not m:
+        return raw
+    names = [m.group(1)] if m.group(1) else m.group(2).split()
+    if not names:
+        return raw
+    if names != [b'/FlateDecode']:
+        raise PDFPageCountError('Unsupported stream filter: %r' % names)
+    try:
+        data = zlib.decompress(raw)
+    except zlib.error:
+        raise PDFPageCountError('Corrupt compressed stream')
+    predictor = _get_int(obj_dict, b'Predictor')
+    if predictor and predictor >= 10:
+        columns = _get_int(obj_dict, b'Columns') or 1
+        data = _undo_png_predictor(data, columns)
+    elif predictor and predictor != 1:
+        raise PDFPageCountError('Unsupported predictor %d' % predictor)
+    return data
+
+
+def _undo_png_predictor(data, columns):
+    rows = []
+    prev = bytearray(columns)
+    row_size = columns + 1
+    data = bytearray(data)
+    for r in range(0, len(data) // row_size):
+        filter_type = data[r * row_size]
+        row = data[r * row_size + 1:(r + 1) * row_size]
+        if filter_type == 1:
+            for i in range(1, columns):
+                row[i] = (row[i] + row[i-1]) & 0xFF
+        elif filter_type == 2:
+            for i in range(columns):
+                row[i] = (row[i] + prev[i]) & 0xFF
+        elif filter_type != 0:
+            raise PDFPageCountError('Unsupported PNG filter %d' % filter_type)
+        rows.append(bytes(row))
+        prev = row
+    return b''.join(rows)
+
+
+def _bytes_to_int(data):
+    value = 0
+    for b in bytearray(data):
+        value = (value << 8) | b
+    return value
+
+
+def _get_int(obj_dict, key):
+    m = re.search(RE_INT_KEY % key, obj_dict)
+    return int(m.group(1)) if m else None
+
+
+def _get_ref(obj_dict, key):
+    m = re.search(RE_REF_KEY % key, obj_dict)
+    return (int(m.group(1)), int(m.group(2))) if m else None
+
+
+def _get_array(obj_dict, key):
+    m = re.search(br'/%s\s*\[([\d\s]*)\]' % key, obj_dict)
+    return [int(x) for x in m.group(1).split()] if m else None
+
@@ -0,0 +1,112 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import json, os, time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from calibre.constants import iswindows, isosx
+
+STAGE_COPY = 'copy'
+STAGE_DOWNLOAD = 'download'
+STAGE_OPEN = 'open'
+STAGE_PAGES = 'pages'
+STAGE_WORDS = 'words'
+STAGE_ANALYSIS = 'analysis'
+STAGE_CLEANUP = 'cleanup'
+ALL_STAGES = [STAGE_COPY, STAGE_DOWNLOAD, STAGE_OPEN, STAGE_PAGES, STAGE_WORDS, STAGE_ANALYSIS, STAGE_CLEANUP]
+
+# Key used to pass timings back from a child job within its results dictionary
+TIMINGS_RESULT_KEY = '_timings'
+TIMINGS_JSON_FILE = 'plugins/Count Pages Timings.json'
+
+
+class StageTimings(object):
+    '''
+    Accumulates the wall time spent in each stage of counting statistics for a book.
+    '''
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def as_dict(self):
+        return {'stages': dict(self.stages), 'peak_rss': get_peak_rss()}
+
+
+def get_peak_rss():
+    '''
+    Return the peak resident set size of this process in bytes, or None if it cannot be determined.
+    '''
+    try:
+        if iswindows:
+            import psutil
+            return psutil.Process().memory_info().peak_wset
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS reports in bytes, Linux in kilobytes
+        return peak if isosx else peak * 1024
+    except:
+        return None
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def summarise_timings(book_timings):
+    '''
+    Given a dict of book_id to timings dicts, return an ordered dict of stage
+    name to a dict of the count, p50, p95 and max seconds.
+    '''
+    summary = OrderedDict()
+    stage_names = ALL_STAGES + sorted(set(name for t in book_timings.values()
+                                          for name in t['stages'] if name not in ALL_STAGES))
+    for name in stage_names + ['peak_rss']:
+        if name == 'peak_rss':
+            values = [t['peak_rss'] for t in book_timings.values() if t.get('peak_rss')]
+        else:
+            values = [t['stages'][name] for t in book_timings.values() if name in t['stages']]
+        if not values:
+            continue
+        values = sorted(values)
+        summary[name] = {'count': len(values), 'p50': _percentile(values, 50),
+                         'p95': _percentile(values, 95), 'max': values[-1]}
+    return summary
+
+
+def print_timings_summary(summary):
+    print('-------------------------------')
+    print('Timing summary (seconds, peak RSS in MB):')
+    print('\t%-10s %6s %10s %10s %10s' % ('Stage', 'Books', 'p50', 'p95', 'max'))
+    for name, s in summary.items():
+        scale = 1024.0 * 1024.0 if name == 'peak_rss' else 1.0
+        print('\t%-10s %6d %10.3f %10.3f %10.3f' % (name, s['count'], s['p50'] / scale,
+                                                   s['p95'] / scale, s['max'] / scale))
+
+
+def export_timings_json(book_timings, summary):
+    from calibre.utils.config import config_dir
+    path = os.path.join(config_dir, TIMINGS_JSON_FILE)
+    data = {'books': dict((str(book_id), t) for book_id, t in book_timings.items()),
+            'summary': summary}
+    try:
+        with open(path, 'wb') as f:
+            f.write(json.dumps(data, indent=2).encode('utf-8'))
+        print('Timing report written to: %s' % path)
+    except:
+        print('Failed to write timing report to: %s' % path)
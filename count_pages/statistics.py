@@ -3,9 +3,10 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 __license__ = 'GPL v3'
 __copyright__ = '2011, Grant Drake'
 
-import re, os, shutil
+import re, os, shutil, traceback
 
 from six import text_type as unicode
+from six.moves.urllib.parse import unquote
 
 from calibre import prints
 from calibre.ebooks.BeautifulSoup import BeautifulSoup
@@ -14,16 +15,26 @@ from calibre.ebooks.oeb.iterator import EbookIterator
 from calibre.utils.ipc.simple_worker import fork_job, WorkerError
 
 from calibre_plugins.count_pages.nltk_lite.textanalyzer import TextAnalyzer
+from calibre_plugins.count_pages.pdf import get_pdf_page_count_fast
 
 RE_HTML_BODY = re.compile(u'<body[^>]*>(.*)</body>', re.UNICODE | re.DOTALL | re.IGNORECASE)
 RE_STRIP_MARKUP = re.compile(u'<[^>]+>', re.UNICODE)
 
+WORD_COUNT_CHUNK_SIZE = 64 * 1024
+
 def get_pdf_page_count(book_path):
     '''
-    Try to use podofo to parse the page count.
+    First try to read the page count directly from the PDF cross-reference data
+    without loading the whole file. If the PDF structure is not one we can handle
+    then try to use podofo to parse the page count.
     This apparently can file for badly formatted pdfs in which case fall back to
     trying to use pdfinfo (which some users have reported issues with).
     '''
+    try:
+        return get_pdf_page_count_fast(book_path)
+    except Exception as e:
+        print('\tFailed to get count from PDF xref (%s), trying podofo' % e)
+
     from calibre.utils.podofo import get_podofo
     podofo = get_podofo()
     try:
@@ -68,10 +79,22 @@ def get_page_count(iterator, book_path, page_algorithm, custom_chars_per_page=0)
     '''
     Given an iterator for the epub (if already opened/converted), estimate a page count
     '''
+    count = 0
+    if page_algorithm == 2 and iterator is None and book_path.lower().endswith('.epub'):
+        # The Adobe algorithm only needs the zip directory and the OPF spine, so
+        # avoid converting/extracting the book at all if we can.
+        try:
+            print('\tCalculating page count using Adobe Digital Editions algorithm from ePub archive')
+            count = _get_page_count_adobe_from_epub(book_path)
+            print('\tPage count:', count)
+            return iterator, count
+        except:
+            print('\tFailed to read ePub archive directly, falling back to opening the book')
+            traceback.print_exc()
+
     if iterator is None:
-        iterator = _open_epub_file(book_path)
+        iterator = open_epub_file(book_path)
 
-    count = 0
     if page_algorithm == 0:
         print('\tCalculating page count using APNX Accurate algorithm')
         count = _get_page_count_accurate(iterator)
@@ -96,7 +119,7 @@ def get_word_count(iterator, book_path, icu_wordcount):
     from calibre.utils.localization import get_lang
     
     if iterator is None:
-        iterator = _open_epub_file(book_path)
+        iterator = open_epub_file(book_path)
 
     lang = iterator.opf.language
     lang = get_lang() if not lang else lang
@@ -106,7 +129,7 @@ def get_word_count(iterator, book_path, icu_wordcount):
     return iterator, count
 
 
-def _open_epub_file(book_path, strip_html=False):
+def open_epub_file(book_path, strip_html=False):
     '''
     Given a path to an EPUB file, read the contents into a giant block of text
     '''
@@ -139,6 +162,46 @@ def _get_page_count_adobe(iterator, book_path):
     return pages
 
 
+def _get_page_count_adobe_from_epub(book_path):
+    '''
+    The same Adobe calculation as above, but reading container.xml, the OPF spine
+    and the compressed sizes straight from the zip without an EbookIterator.
+    '''
+    import math, posixpath
+    from lxml import etree
+    from calibre.utils.zipfile import ZipFile
+
+    with ZipFile(book_path, 'r') as zf:
+        csizes = {ci.filename: ci.compress_size for ci in zf.infolist()}
+        parser = etree.XMLParser(recover=True, no_network=True, resolve_entities=False)
+
+        container = etree.fromstring(zf.read('META-INF/container.xml'), parser=parser)
+        rootfiles = container.xpath('//*[local-name()="rootfile"]/@full-path')
+        if not rootfiles:
+            raise ValueError('No rootfile in container.xml: ' + book_path)
+        opf_name = rootfiles[0]
+        opf_raw = xml_to_unicode(zf.read(opf_name), strip_encoding_pats=True)[0]
+        opf = etree.fromstring(opf_raw.encode('utf-8'), parser=parser)
+
+    opf_dir = posixpath.dirname(opf_name)
+    manifest = {}
+    for item in opf.xpath('//*[local-name()="manifest"]/*[local-name()="item"]'):
+        href = item.get('href')
+        if item.get('id') and href:
+            name = posixpath.normpath(posixpath.join(opf_dir, unquote(href.partition('#')[0])))
+            manifest[item.get('id')] = name
+
+    pages = 0.0
+    spine_items = opf.xpath('//*[local-name()="spine"]/*[local-name()="itemref"]/@idref')
+    if not spine_items:
+        raise ValueError('No spine items in OPF: ' + book_path)
+    for idref in spine_items:
+        sz = csizes.get(manifest.get(idref))
+        if sz is not None:
+            pages += math.ceil(sz / 1024.0)
+    return pages
+
+
 def _get_page_count_calibre(book_path):
     '''
     This algorithm uses the ebook viewer page count.
@@ -271,35 +334,73 @@ def _get_epub_standard_word_count(iterator, lang='en', icu_wordcount=False):
     '''
     This algorithm counts individual words instead of pages
     '''
-
-    book_text = _read_epub_contents(iterator, strip_html=True)
-    
     wordcount = None
-    
+
     if icu_wordcount:
         try:
-            from calibre.spell.break_iterator import count_words
-            print('\tWord count using icu_wordcount - trying to count_words')
-            wordcount = count_words(book_text, lang)
-            print('\tWord count - used count_words:', wordcount)
+            # Feed the text to the break iterator a chunk at a time rather than
+            # building the whole book as one string.
+            counter = None
+            wordcount = 0
+            for chunk in _iter_epub_text_chunks(iterator):
+                if counter is None:
+                    counter, chunk_count = _get_icu_word_counter(chunk, lang)
+                else:
+                    chunk_count = counter(chunk)
+                wordcount += chunk_count
+            print('\tWord count - used icu_wordcount:', wordcount)
         except:
-            try: # The above method is new and no-one will have it as of 08/01/2016.
-                print('\tWord count using icu_wordcount - trying to import split_into_words_and_positions')
-                from calibre.spell.break_iterator import split_into_words_and_positions
-                print('\tWord count - trying split_into_words_and_positions:')
-                wordcount = len(split_into_words_and_positions(book_text, lang))
-                print('\tWord count - used split_into_words_and_positions:', wordcount)
-            except:
-                pass
+            wordcount = None
     if not wordcount: # If not using icu wordcount, or it failed, use the old method.
         from calibre.utils.wordcount import get_wordcount_obj
         print('\tWord count using older method - trying get_wordcount_obj')
+        book_text = _read_epub_contents(iterator, strip_html=True)
         wordcount = get_wordcount_obj(book_text)
         wordcount = wordcount.words
 
     return wordcount
 
 
+def _get_icu_word_counter(first_chunk, lang):
+    '''
+    Return a function counting the words in a piece of text using ICU, along
+    with the count of words in the first chunk of text it was tried on
+    '''
+    try:
+        from calibre.spell.break_iterator import count_words
+        print('\tWord count using icu_wordcount - trying to count_words')
+        count = count_words(first_chunk, lang)
+        return lambda text: count_words(text, lang), count
+    except:
+        # The above method is new and no-one will have it as of 08/01/2016.
+        print('\tWord count using icu_wordcount - trying to import split_into_words_and_positions')
+        from calibre.spell.break_iterator import split_into_words_and_positions
+        count = len(split_into_words_and_positions(first_chunk, lang))
+        return lambda text: len(split_into_words_and_positions(text, lang)), count
+
+
+def _iter_epub_text_chunks(iterator, chunk_size=WORD_COUNT_CHUNK_SIZE):
+    '''
+    Yield the stripped text of each spine file in chunks of roughly chunk_size
+    characters. Chunks are only ever split on a space so no word is broken
+    across two chunks, giving the same total as counting the whole text at once.
+    '''
+    for path in iterator.spine:
+        with open(path, 'rb') as f:
+            text = _get_body_text(f.read().decode('utf-8', 'replace'))
+        start = 0
+        while start < len(text):
+            end = start + chunk_size
+            if end < len(text):
+                boundary = text.rfind(' ', start, end)
+                if boundary <= start:
+                    # No space in this chunk (e.g. CJK text), extend to the next one
+                    boundary = text.find(' ', end)
+                end = boundary if boundary != -1 else len(text)
+            yield text[start:end]
+            start = end + 1
+
+
 def _read_epub_contents(iterator, strip_html=False):
     '''
     Given an iterator for an ePub file, read the contents into a giant block of text
@@ -367,7 +468,7 @@ def get_text_analysis(iterator, book_path, nltk_pickle):
     various official readability computations with.
     '''
     if iterator is None:
-        iterator = _open_epub_file(book_path)
+        iterator = open_epub_file(book_path)
 
     epub_html = _read_epub_contents(iterator, strip_html=True)
     # Lets ignore any html content files less than 500 characters to hopefully
@@ -22,7 +22,7 @@ import calibre_plugins.modify_epub.config as cfg
 from calibre_plugins.modify_epub import ActionModifyEpub
 from calibre_plugins.modify_epub.common_icons import set_plugin_icon_resources, get_icon
 from calibre_plugins.modify_epub.dialogs import (ModifyEpubDialog, QueueProgressDialog,
-                                                 AddBooksProgressDialog)
+                                                 AddBooksProgressDialog, BatchAddBooks)
 
 PLUGIN_ICONS = ['images/modify_epub.png']
 
@@ -72,18 +72,31 @@ class ModifyEpubAction(InterfaceAction):
             remove_dir(tdir)
             return
 
+        # Optionally add each batch of modified books to the library as the job writes it
+        batch_adder = None
+        if cfg.plugin_prefs[cfg.STORE_NAME].get(cfg.KEY_ADD_IN_BATCHES,
+                                                cfg.DEFAULT_STORE_VALUES[cfg.KEY_ADD_IN_BATCHES]):
+            batch_adder = BatchAddBooks(self.gui, tdir, self._refresh_library_view)
+
+        export_metrics = cfg.plugin_prefs[cfg.STORE_NAME].get(cfg.KEY_EXPORT_METRICS,
+                                                cfg.DEFAULT_STORE_VALUES[cfg.KEY_EXPORT_METRICS])
+
         func = 'arbitrary_n'
         cpus = self.gui.job_manager.server.pool_size
         args = ['calibre_plugins.modify_epub.jobs', 'do_modify_epubs',
-                (books_to_modify, options, cpus)]
+                (books_to_modify, options, cpus, tdir if batch_adder else None, export_metrics)]
         desc = 'Modify ePubs version ' + str(ActionModifyEpub.version)
         job = self.gui.job_manager.run_job(
                 self.Dispatcher(self._modify_completed), func, args=args,
                     description=desc)
         job._tdir = tdir
+        job._batch_adder = batch_adder
         self.gui.status_bar.show_message('Modifying %d books'%len(books_to_modify))
 
     def _modify_completed(self, job):
+        if job._batch_adder is not None:
+            # Any books modified before a failure have been or will be added
+            job._batch_adder.job_finished()
         if job.failed:
             self.gui.job_exception(job, dialog_title=_('Failed to modify ePubs'))
             return
@@ -97,6 +110,8 @@ class ModifyEpubAction(InterfaceAction):
             return error_dialog(self.gui, _("Modify ePub changed no files"), msg,
                                 show_copy_button=True, show=True,
                                 det_msg=job.details)
+        if job._batch_adder is not None:
+            return
 
         payload = (modified_epubs_map, job._tdir)
 
@@ -117,6 +132,9 @@ class ModifyEpubAction(InterfaceAction):
     def _proceed_with_updating_epubs(self, payload):
         modified_epubs_map, tdir = payload
         AddBooksProgressDialog(self.gui, modified_epubs_map, tdir)
+        self._refresh_library_view()
+
+    def _refresh_library_view(self):
         self.gui.tags_view.recount()
         if self.gui.current_view() is self.gui.library_view:
             current = self.gui.library_view.currentIndex()
@@ -7,9 +7,9 @@ import six
 __license__   = 'GPL v3'
 __copyright__ = '2012, Grant Drake'
 
-import sys, os, shutil, traceback
+import sys, os, shutil, traceback, glob, json, math
 
-from calibre.utils.logging import Log
+from calibre.utils.logging import Log, ANSIStream
 from calibre.ptempfile import PersistentTemporaryFile
 
 HELP_INFO = '''
@@ -17,6 +17,10 @@ To invoke this script:
  
   calibre-debug -e me.py "input_epub_path" ["output_epub_path"] args
 
+  or to modify many epubs in place:
+
+  calibre-debug -e me.py --batch "input_path" ["input_path" ...] args
+
     input_epub_path   - Mandatory. Path to the input epub to be modified. 
 
     output_epub_path  - Optional. Path to the output epub name after modification. 
@@ -25,6 +29,21 @@ To invoke this script:
     --quiet, --q      - Hide any debug or log output except for errors
 
     --help, --h       - Display the help listing available options
+
+    --batch           - Modify every epub found from the input paths in place. Each
+                        input path may be an epub, a folder searched for epubs
+                        or a wildcard pattern. A summary line of JSON is written
+                        for each book, giving whether it changed, the seconds taken
+                        in total and per option, and its size before and after.
+
+    --file_list "path"  - Batch mode, also modifying the epubs listed one per line
+                          in this text file.
+
+    --workers N       - Batch mode, the number of worker processes to modify the
+                        epubs in. Defaults to 1, which runs in this process.
+
+    --summary "path"  - Batch mode, write the JSON summary lines to this file
+                        rather than the output.
     
     args              - One or more of the following values:
     
@@ -79,12 +98,22 @@ e.g. To overwrite an epub in place replacing the cover image
 
 e.g. To write a new bar.epub after smartening punctuation and removing javascript 
     calibre-debug -e me.py foo.epub bar.epub --smarten_punctuation --remove_javascript
+
+e.g. To remove OS artifacts from every epub under a folder using 4 worker processes
+    calibre-debug -e me.py --batch "C:\\Books" --workers 4 --remove_os_artifacts --q
 '''
 
 
 UNSUPPORTED_OPTIONS = ['add_replace_jacket', 'update_metadata']
 QUIET_OPTIONS = ['q', 'quiet']
 HELP_OPTIONS = ['h', 'help']
+BATCH_VALUE_OPTIONS = ['file_list', 'workers', 'summary']
+# A cover is consumed by the book it is inserted into so cannot be shared by a batch
+UNSUPPORTED_BATCH_OPTIONS = ['insert_replace_cover']
+
+# Each worker process is given this many batches of books over a run,
+# trading the cost of starting a worker against balancing the load.
+BATCHES_PER_WORKER = 4
 
 
 def dump_help():
@@ -104,10 +133,14 @@ def parse_args(args):
     options = {}
     cover_path = None
     quiet = False
+    batch = None
+    input_paths = []
     
     from calibre_plugins.modify_epub.dialogs import ALL_OPTIONS
     for option_name, _t, _tt in ALL_OPTIONS:
         options[option_name] = False
+    batch_values = {'file_list': None, 'workers': '1', 'summary': None}
+    is_batch = False
     i = 0
     aborted = False
     while i < len(args):
@@ -123,6 +156,17 @@ def parse_args(args):
                 continue
             if option_name in QUIET_OPTIONS:
                 quiet = True
+            elif option_name == 'batch':
+                is_batch = True
+            elif option_name in BATCH_VALUE_OPTIONS:
+                if i >= len(args) or args[i].startswith('-'):
+                    print(('ERROR: --%s requires a value'%option_name))
+                    aborted = True
+                    break
+                batch_values[option_name] = args[i]
+                i += 1
+                if option_name == 'file_list':
+                    is_batch = True
             elif option_name in options:
                 if option_name == 'insert_replace_cover':
                     if i >= len(args) or args[i].startswith('-'):
@@ -138,14 +182,76 @@ def parse_args(args):
                 break
         else:
             # We have some other argument being a path - make it fully qualified
-            if epub_input_path is None:
-                epub_input_path = make_absolute_path(arg)
-            else:
-                epub_output_path = make_absolute_path(arg)
+            input_paths.append(make_absolute_path(arg))
+
+    if not aborted and is_batch:
+        batch = parse_batch_values(batch_values, input_paths, options)
+        aborted = batch is None
+    elif input_paths:
+        epub_input_path = input_paths[0]
+        if len(input_paths) > 1:
+            epub_output_path = input_paths[1]
     
     if aborted:
-        return None, None, None, None, None
-    return epub_input_path, epub_output_path, options, cover_path, quiet
+        return None, None, None, None, None, None
+    return epub_input_path, epub_output_path, options, cover_path, quiet, batch
+
+
+def parse_batch_values(batch_values, input_paths, options):
+    for option_name in UNSUPPORTED_BATCH_OPTIONS:
+        if options[option_name]:
+            print(('ERROR: --%s is not supported with --batch'%option_name))
+            return None
+    try:
+        workers = int(batch_values['workers'])
+    except ValueError:
+        workers = 0
+    if workers < 1:
+        print('ERROR: --workers requires a number of at least 1')
+        return None
+    if batch_values['file_list']:
+        with open(make_absolute_path(batch_values['file_list']), 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    input_paths.append(make_absolute_path(line))
+    summary_path = batch_values['summary']
+    if summary_path:
+        summary_path = make_absolute_path(summary_path)
+    return {
+        'epub_paths': find_epub_paths(input_paths),
+        'workers': workers,
+        'summary_path': summary_path
+    }
+
+
+def find_epub_paths(input_paths):
+    '''
+    Expand the folders and wildcard patterns in these input paths into the
+    list of epub paths they refer to, in order and without duplicates.
+    '''
+    epub_paths = []
+    seen = set()
+    def add_path(path):
+        if path not in seen:
+            seen.add(path)
+            epub_paths.append(path)
+
+    for input_path in input_paths:
+        if os.path.isdir(input_path):
+            for dirpath, dirnames, filenames in os.walk(input_path):
+                dirnames.sort()
+                for f in sorted(filenames):
+                    if f.lower().endswith('.epub'):
+                        add_path(os.path.join(dirpath, f))
+        elif os.path.isfile(input_path):
+            add_path(input_path)
+        elif any(c in input_path for c in '*?['):
+            for path in find_epub_paths(sorted(glob.glob(input_path))):
+                add_path(path)
+        else:
+            sys.stderr.write('WARNING: No epub found at: %s\n'%input_path)
+    return epub_paths
 
 
 def pump_debug_output(epub_input_path, epub_output_path, options, cover_path):
@@ -171,14 +277,72 @@ def copy_cover(cover_path):
     return cf.name
 
 
-def invoke_modify_epub(epub_path, options, cover_path, quiet):
+def invoke_modify_epub(epub_path, options, cover_path, quiet, output_path=None):
     from calibre_plugins.modify_epub.modify import modify_epub
     if quiet:
         log = Log(Log.ERROR)
     else:
         log = Log()
     title = os.path.basename(epub_path)
-    return modify_epub(log, title, epub_path, None, cover_path, options)
+    return modify_epub(log, title, epub_path, None, cover_path, options,
+                       output_path=output_path)
+
+
+def write_summary(out, summary):
+    out.write(json.dumps(summary, sort_keys=True) + '\n')
+    out.flush()
+
+
+def run_batch(epub_paths, options, workers, quiet, out):
+    '''
+    Modify each of these epubs in place, writing a JSON summary line for each.
+    With one worker the books are modified in this process, otherwise they are
+    split into batches for worker processes that each modify their whole batch.
+    '''
+    from calibre_plugins.modify_epub.jobs import modify_epub_with_summary
+    if workers == 1:
+        from calibre_plugins.modify_epub.modify import BookModifier
+        log = Log(Log.ERROR) if quiet else Log()
+        # Keep the output for the summary lines
+        log.outputs = [ANSIStream(sys.stderr)]
+        modifier = BookModifier(log)
+        for epub_path in epub_paths:
+            write_summary(out, modify_epub_with_summary(modifier, epub_path, options))
+        return
+
+    from calibre.utils.ipc.server import Server
+    from calibre.utils.ipc.job import ParallelJob
+    server = Server(pool_size=workers)
+    batch_size = int(math.ceil(len(epub_paths) / float(workers * BATCHES_PER_WORKER)))
+    batch_size = max(1, batch_size)
+    remaining = 0
+    for start in range(0, len(epub_paths), batch_size):
+        batch_paths = epub_paths[start:start+batch_size]
+        args = ['calibre_plugins.modify_epub.jobs', 'do_modify_epub_batch',
+                (batch_paths, options, quiet)]
+        job = ParallelJob('arbitrary', 'Modify ePub batch %d'%remaining, done=None, args=args)
+        job._epub_paths = batch_paths
+        server.add_job(job)
+        remaining += 1
+
+    try:
+        while remaining:
+            job = server.changed_jobs_queue.get()
+            job.update()
+            if not job.is_finished:
+                continue
+            remaining -= 1
+            if not quiet:
+                sys.stderr.write((job.details or '') + '\n')
+            if job.failed or job.result is None:
+                for epub_path in job._epub_paths:
+                    write_summary(out, {'path': epub_path, 'changed': False,
+                                        'error': 'Worker process failed'})
+            else:
+                for summary in job.result:
+                    write_summary(out, summary)
+    finally:
+        server.close()
 
 
 def main():
@@ -187,7 +351,16 @@ def main():
     args = sys.argv[1:]
     try:
         # Parse all the input arguments
-        epub_input_path, epub_output_path, options, cover_path, quiet = parse_args(args)
+        epub_input_path, epub_output_path, options, cover_path, quiet, batch = parse_args(args)
+
+        if batch is not None:
+            if batch['summary_path']:
+                with open(batch['summary_path'], 'w') as out:
+                    run_batch(batch['epub_paths'], options, batch['workers'], quiet, out)
+            else:
+                run_batch(batch['epub_paths'], options, batch['workers'], quiet, sys.stdout)
+            sys.stdout.flush()
+            return retcode
 
         if not epub_input_path:
             return 2
@@ -196,23 +369,23 @@ def main():
         if not quiet:
             pump_debug_output(epub_input_path, epub_output_path, options, cover_path)
         
-        # If an epub output path specified, copy our input epub there for modification
+        # If an epub output path specified, the modified epub is written there
+        # and the input epub is left untouched
         if epub_output_path is None:
             epub_output_path = epub_input_path
-        else:
-            shutil.copy(epub_input_path, epub_output_path)
-            
+
         # If a path to a cover specified, make a temporary copy as Modify ePub will delete it
         temp_cover_path = None
         if cover_path:
             temp_cover_path = copy_cover(cover_path)
 
         # Invoke the Modify ePub plugin
-        new_epub_path = invoke_modify_epub(epub_output_path, options, temp_cover_path, quiet)
+        new_epub_path = invoke_modify_epub(epub_input_path, options, temp_cover_path, quiet,
+                                           epub_output_path)
 
-        # If not modified but user specified an output path, remove the unchanged copy
+        # If not modified but user specified an output path, remove any unchanged copy
         if not new_epub_path:
-            if epub_input_path != epub_output_path:
+            if epub_input_path != epub_output_path and os.path.exists(epub_output_path):
                 os.remove(epub_output_path)
     except:
         print((traceback.format_exc()))
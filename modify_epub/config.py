@@ -23,9 +23,13 @@ HELP_URL = 'https://github.com/kiwidude68/calibre_plugins/wiki/Modify-ePub'
 STORE_SAVED_SETTINGS = 'SavedSettings'
 STORE_NAME = 'Options'
 KEY_ASK_FOR_CONFIRMATION = 'askForConfirmation'
+KEY_ADD_IN_BATCHES = 'addInBatches'
+KEY_EXPORT_METRICS = 'exportMetrics'
 
 DEFAULT_STORE_VALUES = {
-                        KEY_ASK_FOR_CONFIRMATION : True
+                        KEY_ASK_FOR_CONFIRMATION : True,
+                        KEY_ADD_IN_BATCHES : False,
+                        KEY_EXPORT_METRICS : False
                        }
 
 # This is where all preferences for this plugin will be stored
@@ -48,6 +52,8 @@ class ConfigWidget(QWidget):
         
         c = plugin_prefs[STORE_NAME]
         ask_for_confirmation = c.get(KEY_ASK_FOR_CONFIRMATION, DEFAULT_STORE_VALUES[KEY_ASK_FOR_CONFIRMATION])
+        add_in_batches = c.get(KEY_ADD_IN_BATCHES, DEFAULT_STORE_VALUES[KEY_ADD_IN_BATCHES])
+        export_metrics = c.get(KEY_EXPORT_METRICS, DEFAULT_STORE_VALUES[KEY_EXPORT_METRICS])
         
         other_group_box = QGroupBox(_('Other options:'), self)
         layout.addWidget(other_group_box)
@@ -60,6 +66,21 @@ class ConfigWidget(QWidget):
         self.ask_for_confirmation_checkbox.setChecked(ask_for_confirmation)
         other_group_box_layout.addWidget(self.ask_for_confirmation_checkbox, 0, 0, 1, 3)
 
+        self.add_in_batches_checkbox = QCheckBox(_('Add modified epubs to the library while modifying'), self)
+        self.add_in_batches_checkbox.setToolTip(_('Check this option to have each batch of modified epubs replace '
+                                                 'the versions in your library\nas soon as it is ready rather than '
+                                                 'once all books are modified.\nThe changes are applied without a '
+                                                 'confirmation dialog.'))
+        self.add_in_batches_checkbox.setChecked(add_in_batches)
+        other_group_box_layout.addWidget(self.add_in_batches_checkbox, 1, 0, 1, 3)
+
+        self.export_metrics_checkbox = QCheckBox(_('Save option timing report as CSV'), self)
+        self.export_metrics_checkbox.setToolTip(_('Check this option to write the time and files touched by each option\n'
+                                                 'for every book to "Modify ePub Metrics.csv" in the calibre plugins folder.\n'
+                                                 'A summary is always shown in the job details.'))
+        self.export_metrics_checkbox.setChecked(export_metrics)
+        other_group_box_layout.addWidget(self.export_metrics_checkbox, 2, 0, 1, 3)
+
         keyboard_shortcuts_button = QPushButton(_('Keyboard shortcuts')+'...', self)
         keyboard_shortcuts_button.setToolTip(_('Edit the keyboard shortcuts associated with this plugin'))
         keyboard_shortcuts_button.clicked.connect(self.edit_shortcuts)
@@ -73,6 +94,8 @@ class ConfigWidget(QWidget):
     def save_settings(self):
         new_prefs = {}
         new_prefs[KEY_ASK_FOR_CONFIRMATION] = self.ask_for_confirmation_checkbox.isChecked()
+        new_prefs[KEY_ADD_IN_BATCHES] = self.add_in_batches_checkbox.isChecked()
+        new_prefs[KEY_EXPORT_METRICS] = self.export_metrics_checkbox.isChecked()
         plugin_prefs[STORE_NAME] = new_prefs
 
     def edit_shortcuts(self):
@@ -8,7 +8,8 @@ from six import text_type as unicode
 from six.moves import range
 from polyglot.builtins import unicode_type, is_py3
 
-import os, posixpath, sys, re
+import io, itertools, os, posixpath, sys, re, shutil, zlib
+from collections import namedtuple
 import six.moves.urllib.request, six.moves.urllib.parse, six.moves.urllib.error
 
 from lxml import etree
@@ -16,14 +17,15 @@ from lxml.etree import XMLSyntaxError
 from six.moves.urllib.parse import urldefrag, urlparse, urlunparse
 from six.moves.urllib.parse import unquote as urlunquote
 
-from calibre import guess_type, prepare_string_for_xml
+from calibre import guess_type
 from calibre.ebooks.chardet import xml_to_unicode
 from calibre.ebooks.conversion.plugins.epub_input import (
     ADOBE_OBFUSCATION, IDPF_OBFUSCATION, decrypt_font)
 from calibre.ebooks.conversion.preprocess import HTMLPreProcessor
 from calibre.ebooks.oeb.base import urlnormalize, OEB_DOCS, XPath, SVG, XLINK
 from calibre.ebooks.oeb.parse_utils import RECOVER_PARSER, NotHTML, parse_html
-from calibre.utils.zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+from calibre.ptempfile import SpooledTemporaryFile
+from calibre.utils.zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED, BadZipfile
 
 exists, join = os.path.exists, os.path.join
 
@@ -35,9 +37,126 @@ IMAGE_FILES = ['.png','.jpg','.jpeg', '.gif', '.bmp', '.svg']
 FONT_FILES = ['.otf','.ttf']
 NON_HTML_FILES = IMAGE_FILES + FONT_FILES + ['.opf', '.xpgt', '.ncx', '.css']
 
+ITUNES_FILES = ['iTunesMetadata.plist', 'iTunesArtwork']
+BOOKMARKS_FILES = ['META-INF/calibre_bookmarks.txt']
+OS_FILES = ['.DS_Store', 'thumbs.db']
+ALL_ARTIFACTS = ITUNES_FILES + BOOKMARKS_FILES + OS_FILES
+
+# CSS url() references, and @import rules that give the url as a plain string
+RE_CSS_URL = re.compile(r'''url\(\s*(['"]?)(.*?)\1\s*\)''', re.IGNORECASE)
+RE_CSS_IMPORT = re.compile(r'''@import\s+(['"])(.*?)\1''', re.IGNORECASE)
+
+# The links from one html or css file to other files in the ePub, each held as a
+# list of (name, original href) tuples. Stylesheets and css_urls come from <link>
+# tags, and url() or @import references in stylesheets and inline styles.
+FileReferences = namedtuple('FileReferences', 'images links stylesheets css_urls')
+
+
+def _index_add(index, key, element):
+    if key is not None:
+        index.setdefault(key, []).append(element)
+
+
+def _index_remove(index, key, element):
+    elements = index.get(key)
+    if elements and element in elements:
+        elements.remove(element)
+        if not elements:
+            del index[key]
+
+
+class OpfIndex(object):
+    '''
+    The manifest items by id and href, spine itemrefs by idref and guide
+    references by href and type of an OPF, read in one pass so that finding
+    or removing an entry does not search the whole OPF again. Each list is in
+    document order when read, and is kept in step by the container methods
+    that add or remove these elements. The OPF is read again if it is set by
+    anything else.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.items_by_id = {}
+        self.items_by_href = {}
+        # Map of lower cased href to the number of items using it
+        self.lower_hrefs = {}
+        self.itemrefs_by_idref = {}
+        self.references_by_href = {}
+        self.references_by_type = {}
+        for item in root.xpath('//opf:manifest/opf:item', namespaces={'opf':OPF_NS}):
+            self.add_item(item)
+        for itemref in root.xpath('//opf:spine/opf:itemref', namespaces={'opf':OPF_NS}):
+            self.add_itemref(itemref)
+        for reference in root.xpath('//opf:guide/opf:reference', namespaces={'opf':OPF_NS}):
+            self.add_reference(reference)
+
+    def add_item(self, item):
+        _index_add(self.items_by_id, item.get('id'), item)
+        href = item.get('href')
+        _index_add(self.items_by_href, href, item)
+        if href is not None:
+            self.lower_hrefs[href.lower()] = self.lower_hrefs.get(href.lower(), 0) + 1
+
+    def remove_item(self, item):
+        _index_remove(self.items_by_id, item.get('id'), item)
+        href = item.get('href')
+        if href in self.items_by_href and item in self.items_by_href[href]:
+            _index_remove(self.items_by_href, href, item)
+            count = self.lower_hrefs.pop(href.lower(), 1) - 1
+            if count:
+                self.lower_hrefs[href.lower()] = count
+
+    def add_itemref(self, itemref):
+        _index_add(self.itemrefs_by_idref, itemref.get('idref'), itemref)
+
+    def remove_itemref(self, itemref):
+        _index_remove(self.itemrefs_by_idref, itemref.get('idref'), itemref)
+
+    def add_reference(self, reference):
+        _index_add(self.references_by_href, reference.get('href'), reference)
+        _index_add(self.references_by_type, reference.get('type'), reference)
+
+    def remove_reference(self, reference):
+        _index_remove(self.references_by_href, reference.get('href'), reference)
+        _index_remove(self.references_by_type, reference.get('type'), reference)
+
+
+class NcxIndex(object):
+    '''
+    The navPoints of an NCX by the lower cased name their content links to,
+    read in one pass and kept in step as navPoints are removed by the
+    container. The NCX is read again if it is set by anything else.
+    '''
+
+    def __init__(self, root, src_to_name):
+        self.root = root
+        self.src_to_name = src_to_name
+        self.navpoints_by_name = {}
+        # Whether the playOrder of the navPoints is known to be in sequence
+        self.is_playorder_fixed = False
+        for navpoint in root.xpath('//ncx:navPoint', namespaces={'ncx':NCX_NS}):
+            src = navpoint.xpath('ncx:content/@src', namespaces={'ncx':NCX_NS})
+            if len(src):
+                _index_add(self.navpoints_by_name, src_to_name(src[0]), navpoint)
+
+    def get_navpoints(self, name):
+        return list(self.navpoints_by_name.get(name.lower(), []))
+
+    def remove_navpoint(self, navpoint):
+        src = navpoint.xpath('ncx:content/@src', namespaces={'ncx':NCX_NS})
+        if len(src):
+            _index_remove(self.navpoints_by_name, self.src_to_name(src[0]), navpoint)
+
 class InvalidEpub(ValueError):
     pass
 
+class UnsupportedArchive(ValueError):
+    '''
+    The ePub zip cannot be served in memory, so must be extracted to disk
+    '''
+    pass
+
 class ParseError(ValueError):
 
     def __init__(self, name, desc):
@@ -67,20 +186,23 @@ class Container(object):
         self.root = os.path.abspath(path)
         self.log = log
         self.dirtied = set([])
+        # Names set or deleted since last cleared, for counting the files each option touches
+        self.touched_names = set()
         self.raw_data_map = {}
         self.etree_data_map = {}
+        self._opf_index = self._ncx_index = None
         self.mime_map = {}
         self.opf_name = None
         self.opf_dir = None
         self.html_preprocessor = HTMLPreProcessor()
 
-        if exists(join(self.root, 'mimetype')):
-            os.remove(join(self.root, 'mimetype'))
+        # Map of relative paths with '/' separators from root of unzipped ePub
+        # to absolute paths on filesystem with os-specific separators
+        self.name_path_map = self._read_name_path_map()
 
-        container_path = join(self.root, 'META-INF', 'container.xml')
-        if not exists(container_path):
+        if 'META-INF/container.xml' not in self.name_path_map:
             raise InvalidEpub('No META-INF/container.xml in epub')
-        self.container = etree.fromstring(open(container_path, 'rb').read())
+        self.container = etree.fromstring(self._read_bytes('META-INF/container.xml'))
         opf_files = self.container.xpath((
             r'child::ocf:rootfiles/ocf:rootfile'
             '[@media-type="%s" and @full-path]'%unicode_type(guess_type('a.opf')[0])
@@ -88,24 +210,13 @@ class Container(object):
         )
         if not opf_files:
             raise InvalidEpub('META-INF/container.xml contains no link to OPF file')
-        opf_path = os.path.join(self.root, *opf_files[0].get('full-path').split('/'))
-        if not exists(opf_path):
+        opf_name = posixpath.normpath(opf_files[0].get('full-path'))
+        if opf_name not in self.name_path_map:
             raise InvalidEpub('OPF file does not exist at location pointed to'
                     ' by META-INF/container.xml')
-
-        # Map of relative paths with '/' separators from root of unzipped ePub
-        # to absolute paths on filesystem with os-specific separators
-        self.name_path_map = {}
-        for dirpath, _dirnames, filenames in os.walk(self.root):
-            for f in filenames:
-                path = join(dirpath, f)
-                name = os.path.relpath(path, self.root).replace(os.sep, '/')
-                self.name_path_map[name] = path
-                # Special case if we have stumbled onto the opf manifest
-                if path == opf_path:
-                    self.opf_name = name
-                    self.opf_dir = posixpath.dirname(self.opf_name)
-                    self.mime_map[name] = guess_type('a.opf')[0]
+        self.opf_name = opf_name
+        self.opf_dir = posixpath.dirname(self.opf_name)
+        self.mime_map[opf_name] = guess_type('a.opf')[0]
 
         for item in self.opf.xpath(
                 '//opf:manifest/opf:item[@href and @media-type]',
@@ -125,6 +236,33 @@ class Container(object):
                     self.ncx = None
                 break
 
+    def _read_name_path_map(self):
+        if exists(join(self.root, 'mimetype')):
+            os.remove(join(self.root, 'mimetype'))
+        name_path_map = {}
+        for dirpath, _dirnames, filenames in os.walk(self.root):
+            for f in filenames:
+                path = join(dirpath, f)
+                name = os.path.relpath(path, self.root).replace(os.sep, '/')
+                name_path_map[name] = path
+        return name_path_map
+
+    def _name_to_path(self, name):
+        return join(self.root, *name.split('/'))
+
+    def _read_bytes(self, name):
+        with open(self.name_path_map[name], 'rb') as f:
+            return f.read()
+
+    def _read_raw(self, name):
+        path = self.name_path_map[name]
+        try:
+            with open(path, 'r') as f:
+                return f.read()
+        except:
+            with open(path, 'rb') as f:
+                return f.read()
+
     def manifest_worthy_names(self):
         for name in self.name_path_map:
             if name.endswith('.opf'): continue
@@ -134,14 +272,10 @@ class Container(object):
 
     def get_manifest_item_for_name(self, name):
         href = self.name_to_href(name)
-        q = prepare_string_for_xml(href, attribute=True)
-        existing = self.opf.xpath('//opf:manifest/opf:item[@href="%s"]'%q,
-                namespaces={'opf':OPF_NS})
+        existing = self.opf_index.items_by_href.get(href)
         if not existing:
             # Try again with unquoting special characters like %20
-            q = urlunquote(q)
-            existing = self.opf.xpath('//opf:manifest/opf:item[@href="%s"]'%q,
-                    namespaces={'opf':OPF_NS})
+            existing = self.opf_index.items_by_href.get(urlunquote(href))
         if not existing:
             return None
         return existing[0]
@@ -150,6 +284,22 @@ class Container(object):
     def opf(self):
         return self.get_parsed_etree(self.opf_name)
 
+    @property
+    def opf_index(self):
+        opf = self.opf
+        if self._opf_index is None or self._opf_index.root is not opf:
+            self._opf_index = OpfIndex(opf)
+        return self._opf_index
+
+    @property
+    def ncx_index(self):
+        if self._ncx_index is None or self._ncx_index.root is not self.ncx:
+            self._ncx_index = NcxIndex(self.ncx, self._toc_src_to_name)
+        return self._ncx_index
+
+    def _toc_src_to_name(self, src):
+        return self.abshref(src.partition('#')[0], self.ncx_name).lower()
+
     def href_to_name(self, href, rel_to_opf=True, base=''):
         '''
         Changed to fix a bug in the Calibre function which incorrectly
@@ -213,16 +363,14 @@ class Container(object):
         '''
         if name in self.raw_data_map:
             return self.raw_data_map[name]
-        path = self.name_path_map[name]
-        extension = name[name.lower().rfind('.'):].lower()
+        if name in self.dirtied and name in self.etree_data_map:
+            # Trees that have been set are only serialised when next needed
+            raw = unicode_type(etree.tostring(self.etree_data_map[name], encoding='unicode'))
+            self.raw_data_map[name] = raw
+            return raw
         # Defensive code: can't be sure that the file is text
         try:
-            try:
-                with open(path, 'r') as f:
-                    raw = f.read()
-            except:
-                with open(path, 'rb') as f:
-                    raw = f.read()
+            raw = self._read_raw(name)
         except:
             self.log('Exception in get_raw: name=', name)
             raise
@@ -235,7 +383,16 @@ class Container(object):
         '''
         if name in self.etree_data_map:
             return self.etree_data_map[name]
-        data = self.get_raw(name)
+        data = self.parse_raw(name, self.get_raw(name))
+        if hasattr(data, 'xpath'):
+            self.etree_data_map[name] = data
+        return data
+
+    def parse_raw(self, name, data):
+        '''
+        Parse this raw data for the named resource according to its media type,
+        returning it unchanged if that is not an html or xml type
+        '''
         if name in self.mime_map:
             mt = self.mime_map[name].lower()
             try:
@@ -246,8 +403,6 @@ class Container(object):
                     data = self._parse_xml(data)
             except XMLSyntaxError as err:
                 raise ParseError(name, unicode(err))
-        if hasattr(data, 'xpath'):
-            self.etree_data_map[name] = data
         return data
 
     def _parse_xml(self, data):
@@ -279,9 +434,8 @@ class Container(object):
         '''
         Return the guide reference element matching this type if specified.
         '''
-        references = self.opf.xpath('//opf:guide/opf:reference[@type="%s"]'%ref_type,
-                                    namespaces={'opf':OPF_NS})
-        if len(references):
+        references = self.opf_index.references_by_type.get(ref_type)
+        if references:
             return references[0]
         return None
 
@@ -289,9 +443,8 @@ class Container(object):
         '''
         Return the manifest item element matching this @id.
         '''
-        items = self.opf.xpath('//opf:manifest/opf:item[@id="%s"]'%id,
-                                    namespaces={'opf':OPF_NS})
-        if len(items) > 0:
+        items = self.opf_index.items_by_id.get(id)
+        if items:
             return items[0]
         return None
 
@@ -369,12 +522,12 @@ class WritableContainer(Container):
         just been inserted/appended
         '''
         parent = item.getparent()
-        idx = parent.index(item)
-        if idx == 0:
+        previous = item.getprevious()
+        if previous is None:
             item.tail = parent.text
             # If this is the only child of this parent element, we need a little extra work as we have
             # gone from a self-closing <foo /> element to <foo><item /></foo>
-            if len(parent) == 1:
+            if item.getnext() is None:
                 sibling = parent.getprevious()
                 if sibling is None:
                     # Give up!
@@ -382,9 +535,9 @@ class WritableContainer(Container):
                 parent.text = sibling.text
                 item.tail = sibling.tail
         else:
-            item.tail = parent[idx-1].tail
-            if idx == len(parent)-1:
-                parent[idx-1].tail = parent.text
+            item.tail = previous.tail
+            if item.getnext() is None:
+                previous.tail = parent.text
 
     def fix_tail_before_delete(self, item):
         '''
@@ -392,15 +545,15 @@ class WritableContainer(Container):
         is deleted
         '''
         parent = item.getparent()
-        idx = parent.index(item)
-        if idx == 0:
+        previous = item.getprevious()
+        if previous is None:
             # We are removing the first time - only care about adjusting
             # the tail if this was the only child
-            if len(parent) == 1:
+            if item.getnext() is None:
                 parent.text = item.tail
         else:
             # Make sure the preceding item has this tail
-            parent[idx-1].tail = item.tail
+            previous.tail = item.tail
 
     def add_name_to_manifest(self, name, mt=None):
         item = self.get_manifest_item_for_name(name)
@@ -417,11 +570,10 @@ class WritableContainer(Container):
         item.set('media-type', mt)
         manifest.append(item)
         self.fix_tail_after_insert(item)
+        self.opf_index.add_item(item)
 
     def generate_manifest_id(self):
-        items = self.opf.xpath('//opf:manifest/opf:item[@id]',
-                namespaces={'opf':OPF_NS})
-        ids = set([x.get('id') for x in items])
+        ids = self.opf_index.items_by_id
         # sys.maxsize returns a too-large integer on P2.7 64-bit systems.
         # Fortunately we don't need trillions of ids. Set the max to
         # something arbitrary such as 1 billion. :)
@@ -443,9 +595,7 @@ class WritableContainer(Container):
         Grant: Copied/modified from calibre.ebooks.oeb.base.Manifest
         '''
         if id is not None:
-            items = self.opf.xpath('//opf:manifest/opf:item[@id]',
-                    namespaces={'opf':OPF_NS})
-            ids = set([x.get('id') for x in items])
+            ids = self.opf_index.items_by_id
 
             base = id
             index = 1
@@ -453,14 +603,10 @@ class WritableContainer(Container):
                 id = base + str(index)
                 index += 1
         if href is not None:
-            items = self.opf.xpath('//opf:manifest/opf:item[@href]',
-                    namespaces={'opf':OPF_NS})
-            hrefs = set([x.get('href') for x in items])
-
             href = urlnormalize(href)
             base, ext = os.path.splitext(href)
             index = 1
-            lhrefs = set([x.lower() for x in hrefs])
+            lhrefs = self.opf_index.lower_hrefs
             while href.lower() in lhrefs:
                 href = base + str(index) + ext
                 index += 1
@@ -480,8 +626,9 @@ class WritableContainer(Container):
         item.set('media-type', mt)
         manifest.append(item)
         self.fix_tail_after_insert(item)
+        self.opf_index.add_item(item)
         self.log('\t  Manifest item added: %s (%s)'%(href, id))
-        self.set(self.opf_name, self.opf)
+        self._set_data(self.opf_name, self.opf)
 
     def add_to_spine(self, id, index=-1):
         '''
@@ -495,8 +642,9 @@ class WritableContainer(Container):
         else:
             spine.append(itemref)
         self.fix_tail_after_insert(itemref)
+        self.opf_index.add_itemref(itemref)
         self.log('\t  Spine item inserted: %s at pos: %d'%(id, index))
-        self.set(self.opf_name, self.opf)
+        self._set_data(self.opf_name, self.opf)
 
     def add_to_guide(self, href, title, ref_type):
         '''
@@ -517,8 +665,9 @@ class WritableContainer(Container):
                                      attrib=attrib, nsmap={'opf':OPF_NS})
         guide.append(reference)
         self.fix_tail_after_insert(reference)
+        self.opf_index.add_reference(reference)
         self.log('\t  Guide item inserted: %s:%s:%s'%(href,title,ref_type))
-        self.set(self.opf_name, self.opf)
+        self._set_data(self.opf_name, self.opf)
 
     def add_to_metadata(self, name, id, index=-1):
         '''
@@ -538,7 +687,7 @@ class WritableContainer(Container):
             metadata.append(meta)
         self.fix_tail_after_insert(meta)
         self.log('\t  Meta item inserted: %s:%s'%(name,id))
-        self.set(self.opf_name, self.opf)
+        self._set_data(self.opf_name, self.opf)
 
     def delete_name(self, name):
         '''
@@ -547,11 +696,22 @@ class WritableContainer(Container):
         '''
         if name in self.mime_map:
             self.mime_map.pop(name, None)
+        self.touched_names.add(name)
         if name in self.name_path_map:
-            path = self.name_path_map[name]
-            os.remove(path)
+            self._delete_file(name)
             self.name_path_map.pop(name)
 
+    def _delete_file(self, name):
+        os.remove(self.name_path_map[name])
+
+    def add_name(self, name, data):
+        '''
+        Add a new file to the ePub at this name, to be written along with
+        any other changes. Callers are responsible for the manifest entry.
+        '''
+        self.name_path_map[name] = self._name_to_path(name)
+        self.set(name, data)
+
     def delete_from_manifest(self, name, delete_from_toc=True):
         '''
         Remove this item from the manifest, spine, guide and TOC ncx if it exists
@@ -563,11 +723,11 @@ class WritableContainer(Container):
         item = self.get_manifest_item_for_name(name)
         if item is None:
             return
-        manifest = self.opf.xpath('//opf:manifest', namespaces={'opf':OPF_NS})[0]
         self.log('\t  Manifest item removed: %s (%s)'%(item.get('href'), item.get('id')))
         self.fix_tail_before_delete(item)
-        manifest.remove(item)
-        self.set(self.opf_name, self.opf)
+        item.getparent().remove(item)
+        self.opf_index.remove_item(item)
+        self._set_data(self.opf_name, self.opf)
 
         # Now remove the item from the spine if it exists
         self.delete_from_spine(item)
@@ -584,28 +744,40 @@ class WritableContainer(Container):
         Given a manifest item, remove it from the spine
         '''
         item_id = item.get('id')
-        itemrefs = self.opf.xpath('//opf:spine/opf:itemref[@idref="%s"]'%item_id,
-                namespaces={'opf':OPF_NS})
-        if len(itemrefs) > 0:
+        itemrefs = self.opf_index.itemrefs_by_idref.get(item_id)
+        if itemrefs:
             self.log('\t  Spine itemref removed:', item_id)
             itemref = itemrefs[0]
             self.fix_tail_before_delete(itemref)
             itemref.getparent().remove(itemref)
-            self.set(self.opf_name, self.opf)
+            self.opf_index.remove_itemref(itemref)
+            self._set_data(self.opf_name, self.opf)
 
     def delete_from_guide(self, item):
         '''
         Given a guide or manifest item, remove it from the guide
         '''
         item_href = item.get('href')
-        references = self.opf.xpath('//opf:guide/opf:reference[@href="%s"]'%item_href,
-                namespaces={'opf':OPF_NS})
-        if len(references):
+        if item.tag == '{%s}reference'%OPF_NS and item.getparent() is not None:
+            # The guide reference itself, whose href may have been changed since indexed
+            references = [item]
+        else:
+            references = self.opf_index.references_by_href.get(item_href)
+        if references:
             self.log('\t  Guide reference removed: %s'%item_href)
             reference = references[0]
             self.fix_tail_before_delete(reference)
             reference.getparent().remove(reference)
-            self.set(self.opf_name, self.opf)
+            self._remove_indexed_reference(reference)
+            self._set_data(self.opf_name, self.opf)
+
+    def _remove_indexed_reference(self, reference):
+        index = self.opf_index
+        index.remove_reference(reference)
+        for references in list(index.references_by_href.values()):
+            if reference in references:
+                # Indexed under an href it has since been changed from
+                _index_remove(index.references_by_href, references[0].get('href'), reference)
 
     def delete_from_metadata(self, meta_item):
         '''
@@ -614,23 +786,13 @@ class WritableContainer(Container):
         self.log('\t  Meta item removed: %s'%meta_item.get('name'))
         self.fix_tail_before_delete(meta_item)
         meta_item.getparent().remove(meta_item)
-        self.set(self.opf_name, self.opf)
+        self._set_data(self.opf_name, self.opf)
 
     def delete_from_toc(self, item=None, item_name=None):
         '''
         Given an item from the manifest or the name of an item,
         remove any matching entry from the TOC ncx file
         '''
-        def test_navpoint_for_removal(navpoint):
-            src = navpoint.xpath('ncx:content/@src', namespaces={'ncx':NCX_NS})
-            if len(src):
-                src = src[0].partition('#')[0]
-                src_name = self.abshref(src, self.ncx_name)
-                if src_name.lower() == item_name.lower():
-                    self.log('\t  TOC Navpoint removed of:', src)
-                    return True
-            return False
-
         if self.ncx_name is None:
             return
         if item is None and item_name is None:
@@ -638,20 +800,26 @@ class WritableContainer(Container):
         dirtied = False
         if item is not None:
             item_name = self.href_to_name(item.get('href'))
-        for navpoint in self.ncx.xpath('//ncx:navPoint', namespaces={'ncx':NCX_NS}):
-            if test_navpoint_for_removal(navpoint):
-                dirtied = True
-                p = navpoint.getparent()
-                idx = p.index(navpoint)
-                p.remove(navpoint)
-                for child in reversed(navpoint):
-                    if child.tag == '{%s}navPoint'%NCX_NS:
-                        self.log('\t  TOC Navpoint child promoted')
-                        p.insert(idx, child)
-        if self._fix_toc_playorder() or dirtied:
-            self._indent(self.ncx)
-            self.set(self.ncx_name, self.ncx)
+        ncx_index = self.ncx_index
+        for navpoint in ncx_index.get_navpoints(item_name):
+            src = navpoint.xpath('ncx:content/@src', namespaces={'ncx':NCX_NS})[0]
+            self.log('\t  TOC Navpoint removed of:', src.partition('#')[0])
             dirtied = True
+            ncx_index.remove_navpoint(navpoint)
+            p = navpoint.getparent()
+            idx = p.index(navpoint)
+            p.remove(navpoint)
+            for child in reversed(navpoint):
+                if child.tag == '{%s}navPoint'%NCX_NS:
+                    self.log('\t  TOC Navpoint child promoted')
+                    p.insert(idx, child)
+        # The playOrder only needs checking again once navPoints are removed
+        if dirtied or not ncx_index.is_playorder_fixed:
+            if self._fix_toc_playorder() or dirtied:
+                self._indent(self.ncx)
+                self._set_data(self.ncx_name, self.ncx)
+                dirtied = True
+            ncx_index.is_playorder_fixed = True
 
     def _fix_toc_playorder(self):
         playorder_changed = False
@@ -682,46 +850,115 @@ class WritableContainer(Container):
                 elem.tail = i
 
     def set(self, name, val):
+        # The OPF or NCX may have been changed other than by the methods
+        # keeping their indexes in step, so they must be indexed again.
+        if name == self.opf_name:
+            self._opf_index = None
+        elif name == self.ncx_name:
+            self._ncx_index = None
+        self._set_data(name, val)
+
+    def _set_data(self, name, val):
         if hasattr(val, 'xpath'):
+            # The tree is serialised when next read or written, so a tree
+            # set after each of many changes is only serialised once.
             self.etree_data_map[name] = val
-            val = unicode_type(etree.tostring(val, encoding='unicode'))
+            self.raw_data_map.pop(name, None)
         else:
             # If we have modified the raw text directly then it invalidates
             # any etree we may have stored, so clear from the cache.
             if name in self.etree_data_map:
                 self.etree_data_map.pop(name)
-        self.raw_data_map[name] = val
+            self.raw_data_map[name] = val
         self.dirtied.add(name)
+        self.touched_names.add(name)
 
-    def write(self, path):
+    def write(self, path, source_path=None):
         '''
         Overridden to change how the zip file is assembled as found
-        issues with the add_dir function as it was written
+        issues with the add_dir function as it was written.
+
+        When path, or source_path if given, is the ePub this container was
+        extracted from, any file that is unchanged since extraction has its
+        compressed bytes copied straight from the original zip, so only
+        changed or added files are compressed again. Returns the number
+        of files copied and compressed.
         '''
         #self.log('Writing epub contents back to zipfile:', path)
+        written = set(self.dirtied)
         for name in self.dirtied:
-            raw = self.raw_data_map[name]
+            raw = self.get_raw(name)
             #self.log('  Updating file:', self.name_path_map[name])
-            if is_py3:
+            if isinstance(raw, bytes):
+                with open(self.name_path_map[name], 'wb') as f:
+                    f.write(raw)
+            elif is_py3:
                 with open(self.name_path_map[name], 'w', newline='') as f:
                     f.write(raw)
             else:
                 with open(self.name_path_map[name], 'w') as f:
                     f.write(raw)
         self.dirtied.clear()
-        with ZipFile(path, 'w', compression=ZIP_DEFLATED) as zf:
-            # Write mimetype
-            zf.writestr('mimetype', guess_type('a.epub')[0], compression=ZIP_STORED)
-            # Write everything else
-            exclude_files = ['.DS_Store','mimetype']
-            for root, _dirs, files in os.walk(self.root):
-                for fn in files:
-                    if fn in exclude_files:
-                        continue
-                    absfn = os.path.join(root, fn)
-                    zfn = os.path.relpath(absfn,
-                            self.root).replace(os.sep, '/')
-                    zf.write(absfn, zfn)
+
+        source = None
+        if source_path is None:
+            source_path = path
+        if exists(source_path):
+            try:
+                source = ZipFile(source_path, 'r')
+            except BadZipfile:
+                source = None
+        source_infos = {}
+        if source is not None:
+            source_infos = dict((info.filename, info) for info in source.infolist())
+        copied = compressed = 0
+        try:
+            with SpooledTemporaryFile(max_size=100*1024*1024) as temp:
+                with ZipFile(temp, 'w', compression=ZIP_DEFLATED) as zf:
+                    # Write mimetype
+                    zf.writestr('mimetype', guess_type('a.epub')[0], compression=ZIP_STORED)
+                    # Write everything else
+                    exclude_files = ['.DS_Store','mimetype']
+                    for root, _dirs, files in os.walk(self.root):
+                        for fn in files:
+                            if fn in exclude_files:
+                                continue
+                            absfn = os.path.join(root, fn)
+                            zfn = os.path.relpath(absfn,
+                                    self.root).replace(os.sep, '/')
+                            info = source_infos.get(zfn)
+                            if info is not None and zfn not in written and self._is_unchanged(absfn, info):
+                                zf.writestr(info, source.read_raw(info), raw_bytes=True)
+                                copied += 1
+                            else:
+                                zf.write(absfn, zfn)
+                                compressed += 1
+                if source is not None:
+                    source.close()
+                    source = None
+                temp.seek(0)
+                with open(path, 'wb') as f:
+                    shutil.copyfileobj(temp, f)
+        finally:
+            if source is not None:
+                source.close()
+        self.log('\t  Zip rewritten: %d files copied unchanged, %d files compressed'%(copied, compressed))
+        return copied, compressed
+
+    def _is_unchanged(self, path, info):
+        '''
+        Whether the file at path has the same size and CRC as this zip entry
+        '''
+        if os.path.getsize(path) != info.file_size:
+            return False
+        crc = 0
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(64*1024)
+                if not block:
+                    break
+                crc = zlib.crc32(block, crc)
+        return (crc & 0xffffffff) == info.CRC
 
 class ExtendedContainer(WritableContainer):
     '''
@@ -729,11 +966,25 @@ class ExtendedContainer(WritableContainer):
     that assist with working with sets of content specific to Modify ePub
     '''
 
+    def __init__(self, path, log):
+        # Map of html or css name to its FileReferences, read when first asked for
+        # and dropped whenever that file is set or deleted
+        self.references_map = {}
+        WritableContainer.__init__(self, path, log)
+
+    def set(self, name, val):
+        self.references_map.pop(name, None)
+        WritableContainer.set(self, name, val)
+
+    def delete_name(self, name):
+        self.references_map.pop(name, None)
+        WritableContainer.delete_name(self, name)
+
     def is_drm_encrypted(self):
         for name in self.name_path_map.keys():
             if name.lower().endswith('encryption.xml'):
                 try:
-                    root = etree.fromstring(open(name, 'rb').read())
+                    root = etree.fromstring(self._read_bytes(name))
                     for em in root.xpath('//*[local-name()="EncryptionMethod" and @Algorithm]'):
                         alg = em.get('Algorithm')
                         if alg not in {ADOBE_OBFUSCATION, IDPF_OBFUSCATION}:
@@ -852,11 +1103,65 @@ class ExtendedContainer(WritableContainer):
             href = urlunquote(href_link.get('href')).partition('#')[0]
             yield self.abshref(href, html_name), href, href_link
 
+    def get_file_references(self, name):
+        '''
+        Return the FileReferences of this html or css file, parsing it only
+        the first time it is asked for since it was last changed
+        '''
+        references = self.references_map.get(name)
+        if references is not None:
+            return references
+        if name not in self.name_path_map:
+            return FileReferences([], [], [], [])
+        if name.lower().endswith('.css'):
+            references = FileReferences([], [], [], self._get_css_urls(self.get_raw(name), name))
+        else:
+            data = self.get_parsed_etree(name)
+            images = [(image_name, href) for image_name, href, _node
+                      in self.get_page_image_names(name, data)]
+            links = [(link_name, href) for link_name, href, _node
+                     in self.get_page_href_names(name, data)]
+            stylesheets, css_urls = [], []
+            try:
+                for link in XPath('//h:link[@href]')(data):
+                    if 'stylesheet' in (link.get('rel') or '').lower():
+                        href = urlunquote(link.get('href'))
+                        stylesheets.append((self.abshref(href, name), href))
+                for style in XPath('//h:style')(data):
+                    css_urls.extend(self._get_css_urls(style.text or '', name))
+                for node in XPath('//*[@style]')(data):
+                    css_urls.extend(self._get_css_urls(node.get('style'), name))
+            except:
+                pass
+            references = FileReferences(images, links, stylesheets, css_urls)
+        self.references_map[name] = references
+        return references
+
+    def _get_css_urls(self, css, base_name):
+        urls = []
+        for expression in (RE_CSS_URL, RE_CSS_IMPORT):
+            for match in expression.finditer(css):
+                href = urlunquote(match.group(2).strip()).partition('#')[0]
+                if href and not urlparse(href).scheme:
+                    urls.append((self.abshref(href, base_name), href))
+        return urls
+
+    def get_referenced_names(self):
+        '''
+        Return the lower cased names of every file linked to from any html page
+        or stylesheet, as images, links, stylesheets or css urls
+        '''
+        referenced_names = set()
+        for name in itertools.chain(self.get_html_names(), self.get_css_names()):
+            for references in self.get_file_references(name):
+                referenced_names.update(ref_name.lower() for ref_name, _href in references)
+        return referenced_names
+
     def remove_unused_images(self, image_names):
         '''
         Given a list of "name" objects (paths to images relative to the root)
-        look across all html content to see if the image is linked from
-        anywhere and if not then remove it.
+        look across all html and css content to see if the image is linked
+        from anywhere and if not then remove it.
         '''
         if not image_names:
             return False
@@ -865,14 +1170,10 @@ class ExtendedContainer(WritableContainer):
         missing_map = {image_name.lower() : image_name for image_name in image_names}
         #self.log('Potential missing images:', missing_map)
 
-        for html_name in self.get_html_names():
-            for image_name, _orig_href, _node in self.get_page_image_names(html_name):
-                if image_name.lower() in missing_map:
-                    missing_map.pop(image_name.lower())
-                if not missing_map:
-                    break
-            if not missing_map:
-                break
+        referenced_names = self.get_referenced_names()
+        for image_name in list(missing_map.keys()):
+            if image_name in referenced_names:
+                missing_map.pop(image_name)
 
         # Any images we have left are unreferenced so remove from ePub.
         if missing_map:
@@ -968,4 +1269,111 @@ class ExtendedContainer(WritableContainer):
             self._indent(self.ncx)
             self.set(self.ncx_name, self.ncx)
             dirtied = True
-        return dirtied
\ No newline at end of file
+        return dirtied
+
+class InMemoryContainer(ExtendedContainer):
+    '''
+    An ExtendedContainer served directly from the ePub zip rather than from
+    a copy extracted to disk. Files are read from the zip on first use, any
+    changes are held in memory, and the ePub is rewritten from the zip plus
+    those changes, avoiding creating and deleting a temporary file for every
+    file in the book. Here root is the path to the ePub and name_path_map
+    maps each name to its zip member name.
+    '''
+
+    def __init__(self, path, log):
+        self.archive = ZipFile(path, 'r')
+        try:
+            ExtendedContainer.__init__(self, path, log)
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+    def _read_name_path_map(self):
+        name_path_map = {}
+        for info in self.archive.infolist():
+            name = info.filename
+            if name.endswith('/') or name == 'mimetype':
+                continue
+            if info.flag_bits & 0x1:
+                raise UnsupportedArchive('Encrypted zip member: %s'%name)
+            if '\\' in name or name.startswith('/') or posixpath.normpath(name) != name:
+                # Leave it to zip extraction to sanitise unusual names
+                raise UnsupportedArchive('Unusual zip member name: %s'%name)
+            name_path_map[name] = name
+        return name_path_map
+
+    def _name_to_path(self, name):
+        return name
+
+    def _read_bytes(self, name):
+        return self.archive.read(self.name_path_map[name])
+
+    def _read_raw(self, name):
+        data = self._read_bytes(name)
+        if not is_py3:
+            return data
+        # Decode the same way as reading the extracted file in text mode would
+        try:
+            return io.TextIOWrapper(io.BytesIO(data)).read()
+        except UnicodeDecodeError:
+            return data
+
+    def _delete_file(self, name):
+        pass
+
+    def _encode(self, raw):
+        if isinstance(raw, bytes):
+            return raw
+        if not is_py3:
+            return raw.encode('utf-8')
+        # Encode the same way as writing the extracted file in text mode would
+        buf = io.BytesIO()
+        f = io.TextIOWrapper(buf, newline='')
+        f.write(raw)
+        f.flush()
+        f.detach()
+        return buf.getvalue()
+
+    def write(self, path):
+        '''
+        Rewrite the ePub from the original zip, copying the compressed bytes
+        of every unchanged file and compressing only the changed or added ones.
+        Returns the number of files copied and compressed.
+        '''
+        written = set(self.dirtied)
+        for name in written:
+            if name in self.name_path_map:
+                # Serialise any trees set since they were last read
+                self.get_raw(name)
+        self.dirtied.clear()
+        source_infos = dict((info.filename, info) for info in self.archive.infolist())
+        copied = compressed = 0
+        with SpooledTemporaryFile(max_size=100*1024*1024) as temp:
+            with ZipFile(temp, 'w', compression=ZIP_DEFLATED) as zf:
+                # Write mimetype
+                zf.writestr('mimetype', guess_type('a.epub')[0], compression=ZIP_STORED)
+                # Write everything else
+                exclude_files = ['.DS_Store','mimetype']
+                for name, zfn in list(self.name_path_map.items()):
+                    if posixpath.basename(zfn) in exclude_files:
+                        continue
+                    info = source_infos.get(zfn)
+                    if info is not None and name not in written:
+                        zf.writestr(info, self.archive.read_raw(info), raw_bytes=True)
+                        copied += 1
+                    else:
+                        zf.writestr(zfn, self._encode(self.get_raw(name)))
+                        compressed += 1
+            # The ePub being written is normally the one still open for reading
+            self.close()
+            temp.seek(0)
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(temp, f)
+        self.log('\t  Zip rewritten: %d files copied unchanged, %d files compressed'%(copied, compressed))
+        return copied, compressed
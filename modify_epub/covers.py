@@ -247,7 +247,7 @@ class CoverUpdater(object):
         # Iterate through the spine (it's likely the first or last if any!)
         for manifest_item in self.container.get_spine_items():
             html_name = self.container.href_to_name(manifest_item.get('href'))
-            for image_name, _orig_href, _node in self.container.get_page_image_names(html_name):
+            for image_name, _orig_href in self.container.get_file_references(html_name).images:
                 if image_name.lower() == cover_image_name:
                     self.log('\t  Found this cover page:', html_name)
                     return manifest_item
@@ -299,7 +299,7 @@ class CoverUpdater(object):
     def _create_new_cover(self, existing_cover_path):
         '''
         Generate a calibre cover page using specified image.
-        Returns path to html titlepage and image
+        Returns names of the html titlepage and image
         '''
         self.log('\t...Writing new cover image and titlepage html')
 
@@ -311,10 +311,8 @@ class CoverUpdater(object):
         cname = 'cover.jpeg'
         if self.images_folder:
             cname = self.images_folder + '/' + cname
-        cover_path = self._get_unique_filename(cname)
-        with open(cover_path, 'wb') as f:
-            f.write(cover_data)
-        cover_name = os.path.relpath(cover_path, self.container.root).replace(os.sep, '/')
+        cover_name = self._get_unique_name(cname)
+        self.container.add_name(cover_name, cover_data)
         self.log('\t  New cover image written to: %s'%cover_name)
 
         # Generate our new titlepage.
@@ -323,17 +321,16 @@ class CoverUpdater(object):
 
         return titlepage_name, cover_name
 
-    def _get_unique_filename(self, preferred_name):
-        base_dir = self.container.root
-        fname = os.path.normpath(posixpath.join(base_dir, preferred_name))
-        base, ext = posixpath.splitext(fname)
+    def _get_unique_name(self, preferred_name):
+        name = posixpath.normpath(preferred_name)
+        base, ext = posixpath.splitext(name)
         c = 0
         while True:
-            if not posixpath.exists(fname):
-                return fname
+            if name not in self.container.name_path_map:
+                return name
             c += 1
             suffix = '_u%d'%c
-            fname = base + suffix + ext
+            name = base + suffix + ext
 
     def _create_titlepage(self, cover_href, width, height):
         from calibre.ebooks.oeb.transforms.cover import CoverManager
@@ -341,7 +338,7 @@ class CoverUpdater(object):
         tname = 'titlepage.xhtml'
         if self.text_folder:
             tname = self.text_folder + '/' + tname
-        titlepage_path = self._get_unique_filename(tname)
+        titlepage_name = self._get_unique_name(tname)
 
         # Prepare template based on users default options
         if width is None or height is None:
@@ -361,9 +358,7 @@ class CoverUpdater(object):
         rel_cover_href = os.path.normpath(rel_path).replace('\\','/')
         tp = templ%unquote(rel_cover_href)
 
-        with open(titlepage_path, 'w') as f:
-            f.write(tp)
-        titlepage_name = os.path.relpath(titlepage_path, self.container.root).replace(os.sep, '/')
+        self.container.add_name(titlepage_name, tp)
         return titlepage_name
 
     def _rescale_cover(self, raw):
@@ -441,6 +436,9 @@ class CoverUpdater(object):
         '''
         self.log('\t...Looking for inline links to removed cover page:', removed_html_name)
         for html_name in self.container.get_html_names():
+            links = self.container.get_file_references(html_name).links
+            if not any(href_name.lower() == removed_html_name.lower() for href_name, _href in links):
+                continue
             data = self.container.get_parsed_etree(html_name)
             for href_name, href, node in self.container.get_page_href_names(html_name, data):
                 if href_name.lower() == removed_html_name.lower():
@@ -472,6 +470,8 @@ class CoverUpdater(object):
             self.log.exception('Something went wrong while trying to'
                     ' workaround Nook cover bug, ignoring')
             self.log.exception('ERROR: ', ex)
+        # The workaround changes ids directly, so the container must index them again
+        self.container.set(self.container.opf_name, root)
 
         # Second workaround ensures the manifest item for cover img is placed first
         # Inlining this fix because calibre code makes a mess of the formatting
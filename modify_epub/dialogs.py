@@ -8,11 +8,11 @@ import os, traceback
 try:
     from qt.core import (QVBoxLayout, QLabel, QCheckBox, QGridLayout,
                       QGroupBox, Qt, QDialogButtonBox, QWidget,
-                      QProgressDialog, QTimer, QScrollArea)
+                      QProgressDialog, QTimer, QScrollArea, QObject)
 except ImportError:
     from PyQt5.Qt import (QVBoxLayout, QLabel, QCheckBox, QGridLayout,
                       QGroupBox, Qt, QDialogButtonBox, QWidget,
-                      QProgressDialog, QTimer, QScrollArea)
+                      QProgressDialog, QTimer, QScrollArea, QObject)
 
 try:
     load_translations()
@@ -219,17 +219,25 @@ class QueueProgressDialog(QProgressDialog):
         self.i += 1
 
         try:
-            mi, opf_file = create_opf_file(self.db, book_id)
-            self.setLabelText(_('Queueing')+' '+mi.title)
-            cover_file = create_cover_file(self.db, book_id)
-            cover_file_name = cover_file.name if cover_file else None
+            title = self.db.title(book_id, index_is_id=True)
+            self.setLabelText(_('Queueing')+' '+title)
+            # Only options using calibre metadata or the cover need copies of them
+            opf_file_name = cover_file_name = None
+            if self.options['update_metadata'] or self.options['add_replace_jacket']:
+                _mi, opf_file = create_opf_file(self.db, book_id)
+                opf_file_name = opf_file.name
+            if self.options['update_metadata'] or self.options['insert_replace_cover']:
+                cover_file = create_cover_file(self.db, book_id)
+                cover_file_name = cover_file.name if cover_file else None
             authors = authors_to_string(self._authors_to_list(self.db, book_id))
-            # Copy the book to the temp directory, using book id as filename
-            epub_file = os.path.join(self.tdir, '%d.epub'%book_id)
-            with open(epub_file, 'w+b') as f:
-                self.db.copy_format_to(book_id, 'EPUB', f, index_is_id=True)
-            self.books_to_modify.append((book_id, mi.title, authors, epub_file,
-                                         opf_file.name, cover_file_name))
+            # The book is read from the library, and only written to the temp
+            # directory using book id as filename if it is changed
+            epub_file = self.db.format_abspath(book_id, 'EPUB', index_is_id=True)
+            if not epub_file:
+                raise ValueError('No ePub file found for book: %d'%book_id)
+            output_file = os.path.join(self.tdir, '%d.epub'%book_id)
+            self.books_to_modify.append((book_id, title, authors, epub_file, output_file,
+                                         opf_file_name, cover_file_name))
         except:
             traceback.print_exc()
             self.bad.append(book_id)
@@ -268,6 +276,15 @@ class QueueProgressDialog(QProgressDialog):
         return []
 
 
+def add_modified_epub(db, book_id, epub_path):
+    formats = db.formats(book_id, index_is_id=True)
+    if tweaks['save_original_format_when_polishing'] and 'ORIGINAL_EPUB' not in formats:
+        db.save_original_format(book_id, 'EPUB', notify=False)
+    # Add the epub back, causing the size information to be updated
+    with open(epub_path, 'rb') as f:
+        db.add_format(book_id, 'EPUB', f, index_is_id=True)
+
+
 class AddBooksProgressDialog(QProgressDialog):
 
     def __init__(self, gui, modified_epubs, tdir):
@@ -296,11 +313,7 @@ class AddBooksProgressDialog(QProgressDialog):
         title = self.db.title(book_id, index_is_id=True)
         self.setLabelText(_('Adding')+': '+title)
 
-        formats = self.db.formats(book_id, index_is_id=True)
-        if tweaks['save_original_format_when_polishing'] and 'ORIGINAL_EPUB' not in formats:
-            self.db.save_original_format(book_id, 'EPUB', notify=False)
-        # Add the epub back, causing the size information to be updated
-        self.db.add_format(book_id, 'EPUB', open(epub_path, 'rb'), index_is_id=True)
+        add_modified_epub(self.db, book_id, epub_path)
         self.setValue(self.i)
 
         QTimer.singleShot(0, self.do_book_check)
@@ -312,3 +325,71 @@ class AddBooksProgressDialog(QProgressDialog):
         self.gui.status_bar.show_message(_('ePub files updated'), 3000)
         self.gui = None
         self.db = None
+
+
+class BatchAddBooks(QObject):
+    '''
+    Adds the modified ePubs of a running job to the library a batch at a time
+    as the job writes each batch file, removing each temporary ePub once added
+    so the temp directory only holds the books not yet added.
+    '''
+
+    POLL_INTERVAL = 2000
+
+    def __init__(self, gui, tdir, refresh_library):
+        QObject.__init__(self, gui)
+        self.gui, self.tdir, self.refresh_library = gui, tdir, refresh_library
+        self.db = self.gui.current_db
+        self.pending, self.batch_book_ids = [], []
+        self.added_count = 0
+        self.is_adding = self.is_job_finished = False
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.check_batches)
+        self.timer.start(self.POLL_INTERVAL)
+
+    def check_batches(self):
+        from calibre_plugins.modify_epub.jobs import read_modified_batches
+        for batch_path, modified_epubs in read_modified_batches(self.tdir):
+            os.remove(batch_path)
+            self.pending.extend(sorted(modified_epubs.items()))
+        if self.pending and not self.is_adding:
+            self.is_adding = True
+            QTimer.singleShot(0, self.do_book)
+        elif not self.is_adding and self.is_job_finished:
+            self.do_close()
+
+    def do_book(self):
+        book_id, epub_path = self.pending.pop(0)
+        try:
+            add_modified_epub(self.db, book_id, epub_path)
+            os.remove(epub_path)
+            self.batch_book_ids.append(book_id)
+            self.added_count += 1
+        except:
+            traceback.print_exc()
+        if self.pending:
+            return QTimer.singleShot(0, self.do_book)
+        self.is_adding = False
+        if self.batch_book_ids:
+            self.db.update_last_modified(self.batch_book_ids)
+            self.batch_book_ids = []
+            self.refresh_library()
+        self.gui.status_bar.show_message(_('Modify ePub updated %d ePub files')%self.added_count, 3000)
+        if self.is_job_finished:
+            self.check_batches()
+
+    def job_finished(self):
+        '''
+        Add any batches not yet added, then clean up once they are all done
+        '''
+        self.is_job_finished = True
+        self.timer.stop()
+        self.check_batches()
+
+    def do_close(self):
+        if self.gui is None:
+            return
+        remove_dir(self.tdir)
+        self.gui.status_bar.show_message(_('ePub files updated'), 3000)
+        self.gui = None
+        self.db = None
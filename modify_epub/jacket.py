@@ -3,7 +3,6 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake'
 
-import os
 from calibre.ebooks.oeb.transforms.jacket import render_jacket
 
 def add_replace_jacket(container, log, mi, output_profile, jacket_end_book):
@@ -15,15 +14,12 @@ def add_replace_jacket(container, log, mi, output_profile, jacket_end_book):
     # unrelated existing files.
 
     id, href = container.generate_unique('calibre_jacket', 'jacket.xhtml')
-    opf_path = os.path.dirname(container.name_path_map[container.opf_name])
 
     # That href will have been generated assuming same directory as opf
-    path = os.path.join(opf_path, href)
-    name = href
+    name = container.href_to_name(href)
 
     # Put the data in our container data cache to ensure included when ePub rebuilt
-    container.name_path_map[name] = path
-    container.set(name, jacket_data)
+    container.add_name(name, jacket_data)
 
     # Now we need to add to the manifest
     container.add_to_manifest(id, href)
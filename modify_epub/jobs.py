@@ -3,23 +3,58 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake'
 
+import os, time, glob, json
+
 from calibre.utils.ipc.server import Server
 from calibre.utils.ipc.job import ParallelJob
 from calibre.utils.logging import Log
 
-from calibre_plugins.modify_epub.modify import modify_epub
+from calibre_plugins.modify_epub.modify import modify_epub, BookModifier
+from calibre_plugins.modify_epub.profiling import (summarise_metrics, print_metrics_summary,
+                                                   export_metrics_csv)
+
+# Number of modified books written to each batch file when adding in batches
+ADD_BATCH_SIZE = 25
+BATCH_FILE_PATTERN = 'batch_%06d.json'
 
 
-def do_modify_epubs(books_to_modify, options, cpus, notification=lambda x,y:x):
+def write_modified_batch(batch_dir, batch_number, modified_epubs):
+    '''
+    Write a batch of modified book ids and ePub paths for the GUI to add to the
+    library, renaming it into place so it is never read half written.
     '''
-    Master job, to launch child jobs to modify each ePub
+    batch_path = os.path.join(batch_dir, BATCH_FILE_PATTERN%batch_number)
+    with open(batch_path + '.tmp', 'w') as f:
+        json.dump(dict((str(book_id), path) for book_id, path in modified_epubs.items()), f)
+    os.rename(batch_path + '.tmp', batch_path)
+
+
+def read_modified_batches(batch_dir):
+    '''
+    Yield the path and map of book id to modified ePub path of each batch
+    written so far, in the order they were written
+    '''
+    for batch_path in sorted(glob.glob(os.path.join(batch_dir, 'batch_*.json'))):
+        with open(batch_path, 'r') as f:
+            modified_epubs = json.load(f)
+        yield batch_path, dict((int(book_id), path) for book_id, path in modified_epubs.items())
+
+
+def do_modify_epubs(books_to_modify, options, cpus, batch_dir=None, export_metrics=False,
+                    notification=lambda x,y:x):
+    '''
+    Master job, to launch child jobs to modify each ePub. If batch_dir is given
+    the modified books are also written to batch files in it as they complete,
+    so they can be added to the library while the remaining books are modified.
+    A summary of the time taken by each option is printed to the job details,
+    and also written as CSV if export_metrics is set.
     '''
     server = Server(pool_size=cpus)
 
     # Queue all the jobs
-    for book_id, title, authors, epub_file, opf_file, cover_file in books_to_modify:
+    for book_id, title, authors, epub_file, output_file, opf_file, cover_file in books_to_modify:
         args = ['calibre_plugins.modify_epub.jobs', 'do_modify_epub',
-                (title, epub_file, opf_file, cover_file, options)]
+                (title, epub_file, opf_file, cover_file, options, output_file)]
         job = ParallelJob('arbitrary', str(book_id), done=None, args=args)
         job._book_id = book_id
         job._title = title
@@ -34,6 +69,13 @@ def do_modify_epubs(books_to_modify, options, cpus, notification=lambda x,y:x):
     total = len(books_to_modify)
     count = 0
     modified_epubs_map = dict()
+    unbatched_epubs_map = dict()
+    batch_count = 0
+    # Map of option to [books it could change, books planned] across all books
+    plan_counts = dict()
+    # Map of book id to the metrics of modifying it
+    book_metrics = dict()
+    titles = dict()
     while True:
         job = server.changed_jobs_queue.get()
         # A job can 'change' when it is not finished, for example if it
@@ -42,27 +84,86 @@ def do_modify_epubs(books_to_modify, options, cpus, notification=lambda x,y:x):
         if not job.is_finished:
             continue
         # A job really finished. Get the information.
-        modified_epub_path = job.result
+        modified_epub_path, plan_hits, metrics = job.result or (None, {}, None)
         book_id = job._book_id
+        if metrics:
+            book_metrics[book_id] = metrics
+            titles[book_id] = job._title
         if modified_epub_path:
             modified_epubs_map[book_id] = modified_epub_path
+            unbatched_epubs_map[book_id] = modified_epub_path
+        for option, hit in plan_hits.items():
+            counts = plan_counts.setdefault(option, [0, 0])
+            counts[0] += int(hit)
+            counts[1] += 1
         count += 1
         notification(float(count)/total, 'Modifying ePubs')
         # Add this job's output to the current log
         print(('Logfile for book ID %d (%s / %s)'%(book_id, job._title, job._authors)))
         print('Job details', (job.details))
+        if batch_dir and unbatched_epubs_map and \
+                (len(unbatched_epubs_map) >= ADD_BATCH_SIZE or count >= total):
+            batch_count += 1
+            write_modified_batch(batch_dir, batch_count, unbatched_epubs_map)
+            unbatched_epubs_map = dict()
         if count >= total:
             # All done!
             break
 
     server.close()
+    if plan_counts:
+        print('Planned option hits (books the option could change / books planned):')
+        for option in sorted(plan_counts):
+            print('  %s: %d / %d'%(option, plan_counts[option][0], plan_counts[option][1]))
+    if book_metrics:
+        print_metrics_summary(summarise_metrics(book_metrics), book_metrics)
+        if export_metrics:
+            export_metrics_csv(book_metrics, titles)
     # return the map as the job result
     return modified_epubs_map
 
 
-def do_modify_epub(title, epub_file, opf_file, cover_file, options):
+def do_modify_epub(title, epub_file, opf_file, cover_file, options, output_file=None):
+    '''
+    Child job, to modify this specific book. When output_file is given the
+    book is read from epub_file, which is left untouched, and only written
+    to output_file if it changes.
+    '''
+    plan_hits = {}
+    metrics = {}
+    modified_epub_path = modify_epub(Log(), title, epub_file, opf_file, cover_file,
+                                     options, plan_hits, output_file, metrics)
+    return modified_epub_path, plan_hits, metrics
+
+
+def do_modify_epub_batch(epub_paths, options, quiet):
     '''
-    Child job, to modify this specific book
+    Child job, to modify a batch of books in place using a single BookModifier,
+    returning a summary of the changes made to each book
     '''
-    return modify_epub(Log(), title, epub_file, opf_file, cover_file, options)
+    log = Log(Log.ERROR) if quiet else Log()
+    modifier = BookModifier(log)
+    return [modify_epub_with_summary(modifier, epub_path, options) for epub_path in epub_paths]
+
 
+def modify_epub_with_summary(modifier, epub_path, options):
+    '''
+    Modify this book in place with an existing BookModifier, returning a dict
+    of whether it changed, the time taken in total and for each option and
+    the size of the ePub before and after.
+    '''
+    start_time = time.time()
+    new_book_path = modifier.process_book(os.path.basename(epub_path), epub_path,
+                                          None, None, options)
+    metrics = modifier.get_metrics(time.time() - start_time)
+    options_metrics = metrics['options']
+    return {
+        'path': epub_path,
+        'changed': bool(new_book_path),
+        'seconds': round(metrics['seconds'], 3),
+        'option_seconds': dict((option, round(m['seconds'], 3))
+                               for option, m in options_metrics.items()),
+        'option_files': dict((option, m['files']) for option, m in options_metrics.items()),
+        'bytes_before': metrics['bytes_in'],
+        'bytes_after': metrics['bytes_out'],
+    }
@@ -4,10 +4,9 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake'
 
 import six
-import os, time, traceback, re
+import os, shutil, time, traceback, re
 
 from calibre import CurrentDir, guess_type
-from calibre.ebooks.chardet import strip_encoding_declarations
 from calibre.ebooks.conversion.plumber import OptionValues
 from calibre.ebooks.metadata.opf2 import OPF
 from calibre.ebooks.metadata.meta import set_metadata
@@ -15,29 +14,37 @@ from calibre.ebooks.oeb.base import XPath
 from calibre.customize.ui import apply_null_metadata
 from calibre.libunzip import extract as zipextract
 from calibre.ptempfile import TemporaryDirectory
+from calibre.utils.zipfile import BadZipfile
 
-from calibre_plugins.modify_epub.container import ExtendedContainer, OPF_NS
+from calibre_plugins.modify_epub.container import (ExtendedContainer, InMemoryContainer,
+                                                   UnsupportedArchive, OPF_NS, ITUNES_FILES,
+                                                   BOOKMARKS_FILES, OS_FILES, ALL_ARTIFACTS)
 from calibre_plugins.modify_epub.covers import CoverUpdater
 from calibre_plugins.modify_epub.css import CSSUpdater
 from calibre_plugins.modify_epub.jacket import (remove_legacy_jackets, remove_all_jackets,
                                                 add_replace_jacket)
 from calibre_plugins.modify_epub.margins import MarginsUpdater
-
-ITUNES_FILES = ['iTunesMetadata.plist', 'iTunesArtwork']
-BOOKMARKS_FILES = ['META-INF/calibre_bookmarks.txt']
-OS_FILES = ['.DS_Store', 'thumbs.db']
-ALL_ARTIFACTS = ITUNES_FILES + BOOKMARKS_FILES + OS_FILES
-
-class TAG:
-    content = ''    #actual content
-    pair = 0        #tag pair
-    e_type = 0      #1=OPEN 2=CLOSE 3=CONTAINED 4=TEXT OR CR/LF 9=REMOVE-EMPTY-SPAN
-
-def modify_epub(log, title, epub_path, calibre_opf_path, cover_path, options):
+from calibre_plugins.modify_epub.planner import BookChangePlan
+from calibre_plugins.modify_epub.profiling import WRITE_OPTION
+from calibre_plugins.modify_epub.transforms import HtmlTransformer, HTML_TRANSFORM_OPTIONS
+
+def modify_epub(log, title, epub_path, calibre_opf_path, cover_path, options, plan_hits=None,
+                output_path=None, metrics=None):
+    '''
+    Modify the ePub, returning the path of the modified ePub if it was changed.
+    If output_path is given the ePub is left untouched and only a changed ePub is
+    written, to output_path. If plan_hits is a dict it is updated with whether
+    each option planned for this book could change it, and if metrics is a dict
+    it is updated with the time and files touched by each option.
+    '''
     start_time = time.time()
     modifier = BookModifier(log)
     new_book_path = modifier.process_book(title, epub_path, calibre_opf_path,
-                                          cover_path, options)
+                                          cover_path, options, output_path)
+    if plan_hits is not None and modifier.plan is not None:
+        plan_hits.update(modifier.plan.hits)
+    if metrics is not None:
+        metrics.update(modifier.get_metrics(time.time() - start_time))
     if new_book_path:
         log('ePub updated in %.2f seconds'%(time.time() - start_time))
     else:
@@ -49,10 +56,36 @@ class BookModifier(object):
 
     def __init__(self, log):
         self.log = log
-
-    def process_book(self, title, epub_path, calibre_opf_path, cover_path, options):
+        self.plan = None
+        self.container = None
+        self.option_timings = {}
+        self.option_files = {}
+        self.bytes_in = self.bytes_out = 0
+
+    def process_book(self, title, epub_path, calibre_opf_path, cover_path, options,
+                     output_path=None):
+        '''
+        Modify the ePub in place, or when output_path is given write the ePub
+        there only if it changes. Returns the path written to if changed.
+        '''
         self.log('  Modifying: ', epub_path)
+        self.plan = None
+        self.option_timings = {}
+        self.option_files = {}
+        self.bytes_in = self.bytes_out = 0
+        if output_path is None:
+            output_path = epub_path
+        is_copy = output_path != epub_path
         try:
+            self.bytes_in = self.bytes_out = os.path.getsize(epub_path)
+            # Skip books that none of the selected options could change before
+            # going to the expense of opening a container for them.
+            if not options['update_metadata']:
+                self.plan = self._plan_changes(epub_path, options)
+                if self.plan is not None and not self.plan.may_change:
+                    self.log('\tNo selected options apply to this ePub')
+                    return
+
             self._restore_metadata_from_opf(calibre_opf_path, cover_path)
             self._setup_user_options()
 
@@ -61,31 +94,107 @@ class BookModifier(object):
             # run before we have written any container changes to disk below.
             is_metadata_updated = False
             if options['update_metadata']:
-                is_metadata_updated = self._update_metadata_and_cover(epub_path)
-
-            # Extract the epub into a temp directory
-            with TemporaryDirectory('_modify-epub') as tdir:
-                with CurrentDir(tdir):
-                    zipextract(epub_path, tdir)
-
-                    # Use our own simplified wrapper around an ePub that will
-                    # preserve the file structure and css
-                    container = ExtendedContainer(tdir, self.log)
+                # The metadata is updated in place, so the book is always written
+                if is_copy:
+                    shutil.copyfile(epub_path, output_path)
+                    epub_path = output_path
+                is_metadata_updated = self._run_option('update_metadata', self._update_metadata_and_cover, epub_path)
+
+            # Use our own simplified wrapper around an ePub that will
+            # preserve the file structure and css, served from the zip itself
+            container = self._open_in_memory_container(epub_path)
+            if container is not None:
+                try:
                     is_modified = self._process_book(container, options)
                     if is_modified:
-                        container.write(epub_path)
+                        self._write_container(container, output_path)
+                finally:
+                    container.close()
+            else:
+                # Extract the epub into a temp directory
+                with TemporaryDirectory('_modify-epub') as tdir:
+                    with CurrentDir(tdir):
+                        zipextract(epub_path, tdir)
+                        container = ExtendedContainer(tdir, self.log)
+                        is_modified = self._process_book(container, options)
+                        if is_modified:
+                            self._write_container(container, output_path, epub_path)
 
             # Only return path to the ePub if we have changed it
             if is_metadata_updated or is_modified:
-                return epub_path
+                self.bytes_out = os.path.getsize(output_path)
+                return output_path
         except:
             self.log.exception('%s - ERROR: %s' %(title, traceback.format_exc()))
+            # Do not leave a partly written copy of the ePub behind
+            if is_copy and os.path.exists(output_path):
+                os.remove(output_path)
         finally:
+            self.container = None
             if calibre_opf_path and os.path.exists(calibre_opf_path):
                 os.remove(calibre_opf_path)
             if cover_path and os.path.exists(cover_path):
                 os.remove(cover_path)
 
+    def _run_option(self, option, func, *args, **kwargs):
+        '''
+        Call the function applying this option, adding the time it took to
+        option_timings and the number of files it set or deleted in the
+        container to option_files for the book being processed.
+        '''
+        if self.container is not None:
+            self.container.touched_names.clear()
+        start_time = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._add_option_time(option, time.time() - start_time)
+            if self.container is not None:
+                self._add_option_files(option, len(self.container.touched_names))
+
+    def _add_option_time(self, option, seconds):
+        self.option_timings[option] = self.option_timings.get(option, 0) + seconds
+
+    def _add_option_files(self, option, count):
+        self.option_files[option] = self.option_files.get(option, 0) + count
+
+    def _write_container(self, container, *args):
+        _copied, compressed = self._run_option(WRITE_OPTION, container.write, *args)
+        self._add_option_files(WRITE_OPTION, compressed)
+
+    def get_metrics(self, seconds):
+        '''
+        Return a dict of the seconds and files touched by each option applied
+        to the last book processed, with its total time and size before and after
+        '''
+        options = dict((option, {'seconds': option_seconds,
+                                 'files': self.option_files.get(option, 0)})
+                       for option, option_seconds in self.option_timings.items())
+        return {'seconds': seconds, 'options': options,
+                'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out}
+
+    def _plan_changes(self, epub_path, options):
+        try:
+            plan = BookChangePlan(epub_path, options)
+        except:
+            self.log('\t  Unable to plan changes, applying all options: %s'%traceback.format_exc())
+            return None
+        hits = [option for option, hit in sorted(plan.hits.items()) if hit]
+        if hits:
+            self.log('\tPlanned options that may apply:', ', '.join(hits))
+        return plan
+
+    def _open_in_memory_container(self, epub_path):
+        '''
+        Open a container reading from and writing to the ePub zip directly, or
+        return None if the zip needs to be extracted to disk to be modified.
+        '''
+        try:
+            return InMemoryContainer(epub_path, self.log)
+        except (BadZipfile, UnsupportedArchive) as e:
+            self.log('\t  Extracting ePub to disk: %s'%e)
+            return None
+
     def _restore_metadata_from_opf(self, calibre_opf_path, cover_path):
         '''
         Create an mi object from our copy of the latest Calibre metadata
@@ -115,81 +224,78 @@ class BookModifier(object):
         return True # Going to "assume" it did something
 
     def _process_book(self, container, options):
+        self.container = container
         is_changed = False
 
         # MANIFEST OPTIONS
         if options['remove_missing_files']:
-            is_changed |= self._remove_missing_files(container)
+            is_changed |= self._run_option('remove_missing_files', self._remove_missing_files, container)
         if options['add_unmanifested_files']:
-            is_changed |= self._process_unmanifested_files(container, add=True)
+            is_changed |= self._run_option('add_unmanifested_files', self._process_unmanifested_files, container, add=True)
         elif options['remove_unmanifested_files']:
-            is_changed |= self._process_unmanifested_files(container, add=False)
+            is_changed |= self._run_option('remove_unmanifested_files', self._process_unmanifested_files, container, add=False)
         if options['flatten_toc']:
-            is_changed |= self._flatten_toc(container)
+            is_changed |= self._run_option('flatten_toc', self._flatten_toc, container)
         if options['remove_broken_ncx_links']:
-            is_changed |= self._remove_broken_ncx_links(container)
+            is_changed |= self._run_option('remove_broken_ncx_links', self._remove_broken_ncx_links, container)
 
         # ADOBE OPTIONS
         if options['zero_xpgt_margins'] and not options['remove_xpgt_files']:
-            is_changed |= self._zero_xpgt_margins(container)
+            is_changed |= self._run_option('zero_xpgt_margins', self._zero_xpgt_margins, container)
         if options['remove_xpgt_files']:
-            is_changed |= self._remove_xpgt_files(container)
+            is_changed |= self._run_option('remove_xpgt_files', self._remove_xpgt_files, container)
         if options['remove_page_map']:
-            is_changed |= self._remove_pagemaps(container)
+            is_changed |= self._run_option('remove_page_map', self._remove_pagemaps, container)
         if options['remove_gp_page_map']:
-            is_changed |= self._remove_gp_pagemaps(container)
+            is_changed |= self._run_option('remove_gp_page_map', self._remove_gp_pagemaps, container)
         if options['remove_drm_meta_tags']:
-            is_changed |= self._remove_drm_meta_tags(container)
+            is_changed |= self._run_option('remove_drm_meta_tags', self._remove_drm_meta_tags, container)
 
         # JACKET OPTIONS
         if options['remove_legacy_jackets'] and not options['remove_all_jackets']:
-            is_changed |= remove_legacy_jackets(container, self.log)
+            is_changed |= self._run_option('remove_legacy_jackets', remove_legacy_jackets, container, self.log)
         if options['remove_all_jackets']:
-            is_changed |= remove_all_jackets(container, self.log)
+            is_changed |= self._run_option('remove_all_jackets', remove_all_jackets, container, self.log)
         if options['add_replace_jacket']:
             if options['jacket_end_book']:
                 jacket_end_book = True
             else:
                 jacket_end_book = False
-            is_changed |= add_replace_jacket(container, self.log, self.mi, self.opts.output_profile, jacket_end_book)
+            is_changed |= self._run_option('add_replace_jacket', add_replace_jacket, container, self.log, self.mi, self.opts.output_profile, jacket_end_book)
 
         # METADATA/COVER OPTIONS
         if options['remove_broken_covers']:
-            is_changed |= self._remove_broken_covers(container)
+            is_changed |= self._run_option('remove_broken_covers', self._remove_broken_covers, container)
         if options['remove_cover'] and not options['insert_replace_cover']:
-            is_changed |= self._remove_cover(container)
+            is_changed |= self._run_option('remove_cover', self._remove_cover, container)
         if options['remove_non_dc_elements']:
-            is_changed |= self._remove_non_dc_elements(container)
+            is_changed |= self._run_option('remove_non_dc_elements', self._remove_non_dc_elements, container)
 
         # HTML/STYLE OPTIONS
-        if options['encode_html_utf8']:
-            is_changed |= self._encode_html_utf8(container)
         if options['remove_embedded_fonts']:
-            is_changed |= self._remove_embedded_fonts(container)
+            is_changed |= self._run_option('remove_embedded_fonts', self._remove_embedded_fonts, container)
         if options['rewrite_css_margins']:
-            is_changed |= self._rewrite_css_margins(container)
+            is_changed |= self._run_option('rewrite_css_margins', self._rewrite_css_margins, container)
         if options['append_extra_css']:
-            is_changed |= self._append_extra_css(container)
+            is_changed |= self._run_option('append_extra_css', self._append_extra_css, container)
         if options['remove_javascript']:
-            is_changed |= self._remove_javascript(container)
-        if options['smarten_punctuation']:
-            is_changed |= self._smarten_punctuation(container)
+            is_changed |= self._run_option('remove_javascript', self._remove_javascript_files, container)
 
         # FILE OPTIONS
         if options['strip_kobo']:
-            is_changed |= self._strip_kobo(container)
+            is_changed |= self._run_option('strip_kobo', self._remove_kobo_files, container)
         if options['remove_itunes_files']:
-            is_changed |= self._remove_files_if_exist(container, ITUNES_FILES)
+            is_changed |= self._run_option('remove_itunes_files', self._remove_files_if_exist, container, ITUNES_FILES)
         if options['remove_calibre_bookmarks']:
-            is_changed |= self._remove_files_if_exist(container, BOOKMARKS_FILES)
+            is_changed |= self._run_option('remove_calibre_bookmarks', self._remove_files_if_exist, container, BOOKMARKS_FILES)
         if options['remove_os_artifacts']:
-            is_changed |= self._remove_files_if_exist(container, OS_FILES)
+            is_changed |= self._run_option('remove_os_artifacts', self._remove_files_if_exist, container, OS_FILES)
         if options['remove_unused_images']:
-            is_changed |= self._remove_unused_images(container)
-        if options['strip_spans']:
-            is_changed |= self._strip_spans(container)
-        if options['unpretty']:
-            is_changed |= self._unpretty(container)
+            is_changed |= self._run_option('remove_unused_images', self._remove_unused_images, container)
+
+        # Options rewriting the html of each page are applied together, so
+        # each page is read and set back in the container only once.
+        is_changed |= self._transform_html(container, options)
 
         # WARNING: This must be the very last option run, because afterwards
         # the container object may not be perfectly synchronised with changes
@@ -197,7 +303,7 @@ class BookModifier(object):
         # Rather than re-initialising all the internal dictionaries etc. for
         # now will get away with it by running no modifications after it.
         if options['insert_replace_cover']:
-            is_changed |= self._insert_replace_cover(container)
+            is_changed |= self._run_option('insert_replace_cover', self._insert_replace_cover, container)
 
         return is_changed
 
@@ -459,119 +565,6 @@ class BookModifier(object):
                 self.log('\t  Removed @font-face from:', name)
         return dirtied
 
-    def _encode_html_utf8(self, container):
-        self.log('\tLooking for html files to remove charset meta tags/encode to utf-8')
-        if container.is_drm_encrypted():
-            self.log('ERROR - cannot switch a DRM encrypted book to UTF-8 encoding')
-            return False
-
-        dirtied = False
-        for name in container.get_html_names():
-            html = container.get_raw(name)
-            try:
-                new_html = strip_encoding_declarations(html)
-                #new_html = new_html.encode('utf-8')
-                if not new_html.strip().startswith('<?xml'):
-                    new_html = '<?xml version="1.0" encoding="utf-8"?>'+new_html
-                    new_html = re.sub(r'<\?xml([^\?]*?)\?><', r'<?xml\1?>\n<', new_html)
-                if new_html != html:
-                    dirtied = True
-                    container.set(name, new_html)
-                    self.log('\t  Switched to UTF-8 encoding for:', name)
-            except:
-                pass
-        return dirtied
-
-    def _smarten_punctuation(self, container):
-        from calibre.utils.smartypants import smartyPants
-        from calibre.ebooks.chardet import substitute_entites
-        from calibre.ebooks.conversion.utils import HeuristicProcessor
-        from uuid import uuid4
-        dirtied = False
-        self.log('\tApplying smarten punctuation')
-        if container.is_drm_encrypted():
-            self.log('ERROR - cannot smarten punctuation in DRM encrypted book')
-            return False
-
-        def smarten_punctuation_for_page(html):
-            preprocessor = HeuristicProcessor(None, self.log)
-            start = 'calibre-smartypants-'+str(uuid4())
-            stop = 'calibre-smartypants-'+str(uuid4())
-            html = html.replace('<!--', start)
-            html = html.replace('-->', stop)
-            html = preprocessor.fix_nbsp_indents(html)
-            html = smartyPants(html)
-            html = html.replace(start, '<!--')
-            html = html.replace(stop, '-->')
-            # convert ellipsis to entities to prevent wrapping
-            html = re.sub(r'(?u)(?<=\w)\s?(\.\s?){2}\.', '&hellip;', html)
-            # convert double dashes to em-dash
-            html = re.sub(r'\s--\s', u'\u2014', html)
-            return substitute_entites(html)
-
-        for name in container.get_html_names():
-            html = container.get_raw(name)
-            new_html = smarten_punctuation_for_page(html)
-            if html != new_html:
-                dirtied = True
-                container.set(name, new_html)
-                self.log('\t  Smartened punctuation in:', name)
-        return dirtied
-
-    def _unpretty(self, container):
-        dirtied = False
-        self.log('\tUnprettying files')
-        if container.is_drm_encrypted():
-            self.log('ERROR - cannot de-indent a DRM encrypted book')
-            return False
-
-        def unpretty_for_page(html_text):
-            if re.search(r'<pre\s*([^>]*?)>', html_text, re.I):
-                self.log('\t  Skipped:', name, ' - not safe to unpretty files which contain PRE elements.');
-            else:
-                html_text = re.sub(r'\r\n?', r'\n', html_text)
-                html_text = re.sub(r'<!--([\s\S]*?)-->', r'', html_text)
-                html_text = re.sub(r'</(b|h)r>', r'', html_text)
-                html_text = re.sub(r'!DOCTYPE([^>]*?)\n([^>]*?)>', r'!DOCTYPE\1 \2>', html_text)
-                html_text = re.sub(r'!DOCTYPE([^>]*?)>\s*', r'!DOCTYPE\1>\n', html_text)
-                html_text = re.sub(r'>\n\s+<', r'>\n<', html_text)
-                html_text = re.sub(r'\s+</([^>]+)>', r'</\1> ', html_text)
-                html_text = re.sub(r'[^\S\n]+\n', r'\n', html_text)
-                html_text = re.sub(r'<(\S+)([^/>]*?) style="display: ?none;?"([^/>]*?)></\1>', r'', html_text)
-                html_text = re.sub(r'>\s*<(html|head|title|meta|link|style|body|h\d|ul|ol|li|p|div|section|nav|tr|td)([^>]*?)(/?)>', r'>\n<\1\2\3>', html_text)
-                html_text = re.sub(r'<(h\d|li|p|div|section|nav|td)([^/>]*?)>\s*<(span|b|i|a|small)', r'<\1\2><\3', html_text)
-                html_text = re.sub(r'<(span|b|i|a|u|em|strong|small)([^>]*?)> <(span|b|i|a|u|em|strong|small)', r' <\1\2><\3', html_text)
-                html_text = re.sub(r'>\s+<(span|b|i|a|u|em|strong|big|small)', r'> <\1', html_text)
-                html_text = re.sub(r'\s*<(section|nav|div)([^>]*?)>', r'\n<\1\2>', html_text)
-                html_text = re.sub(r'<(section|nav|div)([^>]*?)>\s*', r'<\1\2>\n', html_text)
-                html_text = re.sub(r'\s*</(title|body|html)>\s*', r'</\1>\n', html_text)
-                html_text = re.sub(r'\s*</(h\d|ul|ol|p|table|tr)>\s*', r'</\1>\n\n', html_text)
-                html_text = re.sub(r'\s*<(b|h)r([^>]*?)/?>\s*', r'<\1r\2/>\n', html_text)
-                html_text = re.sub(r'<(meta|link)([^>]*?)/?>\s*', r'<\1\2/>\n', html_text)
-                html_text = re.sub(r'>\n*<(body|h\d|ul|ol|p|hr|table)( ?)', r'>\n\n<\1\2', html_text)
-                html_text = re.sub(r'<(body|table|tr)([^>]*?)>\n*', r'<\1\2>\n', html_text)
-                html_text = re.sub(r'<td([^>]*?)>\n+', r'<td\1>\n', html_text)
-                html_text = re.sub(r'\n+</td>', r'\n</td>', html_text)
-                html_text = re.sub(r'\s*</(div|section|nav|table|tr|ul|ol|body)>', r'\n</\1>', html_text)
-                html_text = re.sub(r'\s*</head>\s*', r'\n</head>\n\n', html_text)
-                html_text = re.sub(r'\s*</(body|style)>', r'\n</\1>', html_text)
-                html_text = re.sub(r'/html>\s+', r'/html>', html_text)
-                html_text = re.sub(r' +', r' ', html_text)
-            return html_text
-
-        for name in container.get_html_names():
-            orig_html = container.get_raw(name)
-            html = orig_html
-            new_html = unpretty_for_page(html)
-            while html != new_html:
-                dirtied = True
-                html = new_html;
-                new_html = unpretty_for_page(html)
-            if orig_html != new_html:
-                container.set(name, new_html)
-                self.log('\t  De-indented:', name)
-        return dirtied
-
     def _remove_pagemaps(self, container):
         self.log('\tLooking for pagemaps')
         if container.is_drm_encrypted():
@@ -624,107 +617,12 @@ class BookModifier(object):
                     dirtied = True
         return dirtied
 
-    def _strip_spans(self, container):
+    def _remove_kobo_files(self, container):
         dirtied = False
-        self.log('\tStripping spans')
-        if container.is_drm_encrypted():
-            self.log('ERROR - cannot strip spans in DRM encrypted book')
-            return False
-
-        def strip_span_for_page(html_text):
-            HTML_ENTITY = []
-
-            html_text = re.sub(r'<(\S+)([^/>]*?) style="display: ?none;"([^/>]*?)></\1>', r'', html_text)
-            html_text = re.sub(r'<(\S+)([^/>]*?)></\1>', r'<\1\2/>', html_text)
-            html_text = re.sub(r'<([^>]*?)(\s+?)/>', r'<\1/>', html_text)
-            html_text = re.sub(r'</(b|h)r>', r'', html_text)
-            html_text = re.sub(r'<(b|h)r([^/>]*?)/?>', r'<\1r\2/>', html_text)
-            html_text = re.sub(r'<(b|i|u|a|em|strong|span|big|small)/>', r'', html_text)
-            html_text = re.sub(r'<\?dp([^>]*?)\?>\n?', r'', html_text)
-
-            entities = re.split(r'(<.+?>)', html_text)
-
-            total = 0
-            for entity in entities:
-                if entity:
-                    entity = container.decode(entity)
-                    total += 1
-                    this_entity = TAG()
-                    this_entity.content = entity
-                    if entity == u'<span>':
-                        this_entity.e_type = 9
-                    elif entity[-2:] == u'/>':
-                        this_entity.e_type = 3
-                    elif entity[0] != u'<':
-                        this_entity.e_type = 4
-                    elif entity[:2] == u'</':
-                        this_entity.e_type = 2
-                    else:
-                        this_entity.e_type = 1
-                    HTML_ENTITY.append(this_entity)
-
-            pos = -1
-            PAIR = 0
-            while pos < total-1:
-                pos+=1
-                if HTML_ENTITY[pos].e_type == 2:
-                    PAIR += 1
-                    HTML_ENTITY[pos].pair = PAIR
-                    pair_pos = pos
-                    while True:
-                        pair_pos += -1
-                        if pair_pos<0 : break
-                        e_type = HTML_ENTITY[pair_pos].e_type
-                        if e_type == 1 or e_type==9:
-                            if HTML_ENTITY[pair_pos].pair == 0:
-                                HTML_ENTITY[pair_pos].pair = PAIR
-                                if e_type == 9: HTML_ENTITY[pos].e_type = 9
-                                break
-
-            output = []
-            for entry in HTML_ENTITY:
-                if entry.e_type < 9:
-                    output.append(entry.content)
-
-            out_text = ''.join(output)
-            return out_text
-
-        for name in container.get_html_names():
-            orig_html = container.get_raw(name)
-            html = orig_html
-            new_html = strip_span_for_page(html)
-            while html != new_html:
-                dirtied = True
-                html = new_html;
-                new_html = strip_span_for_page(html)
-            if orig_html != new_html:
-                container.set(name, new_html)
-                self.log('\t  Stripped spans in:', name)
-        return dirtied
-
-    def _strip_kobo(self, container):
-        dirtied = False
-        self.log('\tStripping Kobo remnants')
+        self.log('\tLooking for Kobo files to remove')
         if container.is_drm_encrypted():
             self.log('ERROR - cannot strip Kobo remnants in DRM encrypted book')
             return False
-
-        RE_KOBO_META1 = re.compile(r'\s*<!-- kobo-style -->', re.UNICODE | re.IGNORECASE)
-        RE_KOBO_META2 = re.compile(r'\s*<script[^>]*? src="[^"]*?js/kobo(|-android)\.js"(/|></script)>', re.UNICODE | re.IGNORECASE)
-        RE_KOBO_META3 = re.compile(r'\s*<style[^>]*? id="kobo[\s\S]*?</style>', re.UNICODE | re.IGNORECASE)
-        RE_KOBO_META4 = re.compile(r'\s*<link[^>]*? href="[^"]*?css/kobo(|-android)\.css"[\s\S]*?(/|></link)>', re.UNICODE | re.IGNORECASE)
-        dirtied = False
-        for name in container.get_html_names():
-            html = container.get_raw(name)
-            new_html = RE_KOBO_META1.sub('', html)
-            new_html = RE_KOBO_META2.sub('', new_html)
-            new_html = RE_KOBO_META3.sub('', new_html)
-            new_html = RE_KOBO_META4.sub('', new_html)
-            if html != new_html:
-                dirtied = True
-                container.set(name, new_html)
-                self.log('\t  Removed Kobo HEAD elements from:', name)
-
         for name in list(container.name_path_map.keys()):
             if name.lower().endswith('js/kobo.js'):
                 self.log('\t  Removed kobo.js file:', name)
@@ -738,93 +636,14 @@ class BookModifier(object):
                 self.log('\t  Removed rights.xml file:', name)
                 container.delete_from_manifest(name)
                 dirtied = True
-
-        def strip_kobo_for_page(html_text):
-            HTML_ENTITY = []
-
-            html_text = re.sub(r'<(\S+)([^/>]*?)></\1>', r'<\1\2/>', html_text)
-            html_text = re.sub(r'<([^>]*?)(\s+?)/>', r'<\1/>', html_text)
-            html_text = re.sub(r'<span([^>]+?) id="kobo([^"]+?)"', r'<span id="kobo\2"\1', html_text)
-            html_text = re.sub(r'</(b|h)r>', r'', html_text)
-            html_text = re.sub(r'<(b|h)r([^/>]*?)/?>', r'<\1r\2/>', html_text)
-            html_text = re.sub(r'<(b|i|u|a|em|strong|span|big|small)/>', r'', html_text)
-
-            entities = re.split(r'(<.+?>)', html_text)
-
-            total = 0
-            for entity in entities:
-                if entity:
-                    entity = container.decode(entity)
-                    total += 1
-                    this_entity = TAG()
-                    this_entity.content = entity
-                    if entity[:15] == u'<span id="kobo.':
-                        this_entity.e_type = 9
-                    elif entity[-2:] == u'/>':
-                        this_entity.e_type = 3
-                    elif entity[0] != u'<':
-                        this_entity.e_type = 4
-                    elif entity[:2] == u'</':
-                        this_entity.e_type = 2
-                    else:
-                        this_entity.e_type = 1
-                    HTML_ENTITY.append(this_entity)
-
-            pos = -1
-            PAIR = 0
-            while pos < total-1:
-                pos+=1
-                if HTML_ENTITY[pos].e_type == 2:
-                    PAIR += 1
-                    HTML_ENTITY[pos].pair = PAIR
-                    pair_pos = pos
-                    while True:
-                        pair_pos += -1
-                        if pair_pos<0 : break
-                        e_type = HTML_ENTITY[pair_pos].e_type
-                        if e_type == 1 or e_type==9:
-                            if HTML_ENTITY[pair_pos].pair == 0:
-                                HTML_ENTITY[pair_pos].pair = PAIR
-                                if e_type == 9: HTML_ENTITY[pos].e_type = 9
-                                break
-
-            output = []
-            for entry in HTML_ENTITY:
-                if entry.e_type < 9:
-                    output.append(entry.content)
-
-            out_text = ''.join(output)
-            return out_text
-
-        for name in container.get_html_names():
-            html = container.get_raw(name)
-            new_html = strip_kobo_for_page(html)
-            if html != new_html:
-                dirtied = True
-                container.set(name, new_html)
-                self.log('\t  Stripped Kobo spans in:', name)
         return dirtied
 
-    def _remove_javascript(self, container):
+    def _remove_javascript_files(self, container):
         dirtied = False
-        self.log('\tLooking for inline javascript blocks to remove')
+        self.log('\tLooking for .js files to remove')
         if container.is_drm_encrypted():
             self.log('ERROR - cannot remove javascript from DRM encrypted book')
             return False
-        for name in container.get_html_names():
-            html = container.get_parsed_etree(name)
-            try:
-                scripts = XPath('//h:script[@type="text/javascript"]')(html)
-            except:
-                scripts = []
-            if scripts:
-                for script in scripts:
-                    script.getparent().remove(script)
-                    self.log('\t  Removed script block from:', name)
-                dirtied = True
-                container.set(name, html)
-
-        self.log('\tLooking for .js files to remove')
         for name in list(container.name_path_map.keys()):
             if name.lower().endswith('.js'):
                 self.log('\t  Found .js file to remove:', name)
@@ -832,6 +651,21 @@ class BookModifier(object):
                 dirtied = True
         return dirtied
 
+    def _transform_html(self, container, options):
+        transforms = [option for option in HTML_TRANSFORM_OPTIONS if options[option]]
+        if not transforms:
+            return False
+        if container.is_drm_encrypted():
+            self.log('ERROR - cannot modify the html of a DRM encrypted book')
+            return False
+        ht = HtmlTransformer(self.log, container)
+        try:
+            return ht.transform(transforms)
+        finally:
+            for option, seconds in ht.timings.items():
+                self._add_option_time(option, seconds)
+                self._add_option_files(option, ht.files_changed.get(option, 0))
+
     def _remove_broken_covers(self, container):
         dirtied = False
         self.log('\tLooking for html pages containing only broken image links')
@@ -847,7 +681,7 @@ class BookModifier(object):
 
         for html_name in container.get_html_names():
             delete_candidate = False
-            for image_name, orig_href, _node in container.get_page_image_names(html_name):
+            for image_name, orig_href in container.get_file_references(html_name).images:
                 if image_name.lower() in avail_image_names:
                     # This page has at least one valid link
                     delete_candidate = False
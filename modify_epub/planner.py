@@ -0,0 +1,178 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import posixpath
+import six
+
+from lxml import etree
+
+from calibre import guess_type
+from calibre.ebooks.chardet import xml_to_unicode
+from calibre.ebooks.oeb.parse_utils import RECOVER_PARSER
+from calibre.utils.zipfile import ZipFile
+
+from calibre_plugins.modify_epub.container import (OCF_NS, OPF_NS, IMAGE_FILES, FONT_FILES,
+                                                   ITUNES_FILES, BOOKMARKS_FILES, OS_FILES)
+
+# Options which only qualify how another option is applied
+QUALIFIER_OPTIONS = ['jacket_end_book']
+
+# Lower cased fragments of the manifest media types of Adobe files
+PAGE_TEMPLATE_MIME = b'page-template'
+PAGE_MAP_MIME = b'oebps-page-map+xml'
+
+
+class BookChangePlan(object):
+    '''
+    A quick look at an ePub, deciding for each selected option whether it
+    could change the book, using only the zip directory and byte searches of
+    the files that option would look at. An option is only ruled out when it
+    certainly would not change anything, and options with no cheap test are
+    listed as unplanned, so a book is only skipped when it cannot be changed.
+    '''
+
+    def __init__(self, epub_path, options):
+        self.hits = {}
+        self.unplanned = []
+        self._lower_data = {}
+        with ZipFile(epub_path, 'r') as zf:
+            self.zf = zf
+            self.names = [n for n in zf.namelist() if not n.endswith('/') and n != 'mimetype']
+            self.opf_name = self._find_opf_name()
+            for option in sorted(options):
+                if not options[option] or option in QUALIFIER_OPTIONS:
+                    continue
+                check = getattr(self, '_check_'+option, None)
+                if check is None:
+                    self.unplanned.append(option)
+                else:
+                    self.hits[option] = check()
+            self.zf = None
+
+    @property
+    def may_change(self):
+        return bool(self.unplanned) or any(six.itervalues(self.hits))
+
+    def _find_opf_name(self):
+        if 'META-INF/container.xml' not in self.names:
+            return None
+        try:
+            container = etree.fromstring(self.zf.read('META-INF/container.xml'))
+        except etree.XMLSyntaxError:
+            return None
+        opf_files = container.xpath((
+            r'child::ocf:rootfiles/ocf:rootfile'
+            '[@media-type="%s" and @full-path]'%guess_type('a.opf')[0]
+            ), namespaces={'ocf':OCF_NS}
+        )
+        if not opf_files:
+            return None
+        opf_name = posixpath.normpath(opf_files[0].get('full-path'))
+        if opf_name not in self.names:
+            return None
+        return opf_name
+
+    def _read_lower(self, name):
+        '''
+        Return the lower cased bytes of this file, or None if it is not in an
+        encoding that can be searched for ascii text
+        '''
+        if name not in self._lower_data:
+            data = self.zf.read(name)
+            if data[:2] in (b'\xff\xfe', b'\xfe\xff') or b'\x00' in data[:1024]:
+                self._lower_data[name] = None
+            else:
+                self._lower_data[name] = data.lower()
+        return self._lower_data[name]
+
+    def _contains(self, names, fragments):
+        for name in names:
+            data = self._read_lower(name)
+            if data is None:
+                return True
+            for fragment in fragments:
+                if fragment in data:
+                    return True
+        return False
+
+    def _opf_contains(self, fragment):
+        if self.opf_name is None:
+            return True
+        return self._contains([self.opf_name], [fragment])
+
+    def _text_names(self):
+        '''
+        The names of all files that could be css or html content
+        '''
+        for name in self.names:
+            extension = name[name.lower().rfind('.'):].lower()
+            if extension not in IMAGE_FILES and extension not in FONT_FILES:
+                yield name
+
+    def _has_files(self, files):
+        files = [f.lower() for f in files]
+        for name in self.names:
+            if name.lower() in files:
+                return True
+            for f in files:
+                if name.lower().endswith('/'+f):
+                    return True
+        return False
+
+    def _has_extensions(self, extensions):
+        for name in self.names:
+            if name.lower().endswith(extensions):
+                return True
+        return False
+
+    def _check_remove_itunes_files(self):
+        return self._has_files(ITUNES_FILES)
+
+    def _check_remove_calibre_bookmarks(self):
+        return self._has_files(BOOKMARKS_FILES)
+
+    def _check_remove_os_artifacts(self):
+        return self._has_files(OS_FILES)
+
+    def _check_zero_xpgt_margins(self):
+        return self._opf_contains(PAGE_TEMPLATE_MIME)
+
+    def _check_remove_xpgt_files(self):
+        return self._opf_contains(PAGE_TEMPLATE_MIME) or \
+                self._contains(self._text_names(), [b'.xpgt'])
+
+    def _check_remove_page_map(self):
+        return self._opf_contains(PAGE_MAP_MIME)
+
+    def _check_remove_gp_page_map(self):
+        return self._opf_contains(PAGE_MAP_MIME)
+
+    def _check_remove_drm_meta_tags(self):
+        return self._contains(self._text_names(), [b'adept.'])
+
+    def _check_remove_embedded_fonts(self):
+        return self._has_extensions(('.ttf', '.otf')) or \
+                self._contains(self._text_names(), [b'@font-face'])
+
+    def _check_remove_javascript(self):
+        return self._has_extensions(('.js',)) or \
+                self._contains(self._text_names(), [b'text/javascript'])
+
+    def _check_remove_non_dc_elements(self):
+        if self.opf_name is None:
+            return True
+        try:
+            data = xml_to_unicode(self.zf.read(self.opf_name), strip_encoding_pats=True,
+                                  assume_utf8=True, resolve_entities=True)[0].strip()
+            opf = etree.fromstring(data, parser=RECOVER_PARSER)
+            metadata = opf.xpath('//opf:metadata', namespaces={'opf':OPF_NS})[0]
+        except Exception:
+            return True
+        for child in metadata:
+            # Comments and processing instructions have no string tag
+            tag = child.tag
+            if not isinstance(tag, six.string_types) or not tag.startswith('{http://purl.org/dc/'):
+                return True
+        return False
@@ -0,0 +1,94 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import csv, math, os
+from collections import OrderedDict
+
+from polyglot.builtins import is_py3
+
+# Pseudo option recording the time spent writing the modified ePub zip
+WRITE_OPTION = 'write_epub'
+METRICS_CSV_FILE = 'plugins/Modify ePub Metrics.csv'
+METRICS_CSV_COLUMNS = ['book_id', 'title', 'option', 'seconds', 'files', 'bytes_in', 'bytes_out']
+
+
+def _option_summary(seconds, files):
+    '''
+    Summarise the seconds an option took across books, using the nearest rank
+    for the percentiles, together with the total files it touched.
+    '''
+    seconds = sorted(seconds)
+    count = len(seconds)
+
+    def nearest_rank(pct):
+        return seconds[max(int(math.ceil(pct * count / 100.0)) - 1, 0)]
+
+    return {'count': count, 'p50': nearest_rank(50), 'p95': nearest_rank(95),
+            'max': seconds[-1], 'files': files}
+
+
+def summarise_metrics(book_metrics):
+    '''
+    Given a dict of book_id to metrics dicts, return an ordered dict of option
+    name to a dict of the count of books, p50, p95 and max seconds and the
+    total files touched, followed by the total seconds per book.
+    '''
+    option_seconds = {}
+    option_files = {}
+    for m in book_metrics.values():
+        for option, option_metrics in m['options'].items():
+            option_seconds.setdefault(option, []).append(option_metrics['seconds'])
+            option_files[option] = option_files.get(option, 0) + option_metrics['files']
+    # List the options alphabetically, with writing the ePub last as it happens last
+    option_names = sorted(option_seconds, key=lambda option: (option == WRITE_OPTION, option))
+    summary = OrderedDict()
+    for option in option_names:
+        summary[option] = _option_summary(option_seconds[option], option_files[option])
+    if book_metrics:
+        summary['total'] = _option_summary([m['seconds'] for m in book_metrics.values()], 0)
+    return summary
+
+
+def print_metrics_summary(summary, book_metrics):
+    print('-------------------------------')
+    print('Option timing summary (seconds):')
+    print('\t%-26s %6s %10s %10s %10s %8s' % ('Option', 'Books', 'p50', 'p95', 'max', 'Files'))
+    for option, s in summary.items():
+        print('\t%-26s %6d %10.3f %10.3f %10.3f %8d' % (option, s['count'], s['p50'],
+                                                         s['p95'], s['max'], s['files']))
+    bytes_in = sum(m['bytes_in'] for m in book_metrics.values())
+    bytes_out = sum(m['bytes_out'] for m in book_metrics.values())
+    print('\tePub size before: %.1f MB, after: %.1f MB' % (bytes_in / (1024.0 * 1024.0),
+                                                          bytes_out / (1024.0 * 1024.0)))
+
+
+def export_metrics_csv(book_metrics, titles):
+    '''
+    Write a row for each option applied to each book, plus a total row per book
+    holding its size before and after, to a CSV file in the calibre config folder.
+    '''
+    from calibre.utils.config import config_dir
+    path = os.path.join(config_dir, METRICS_CSV_FILE)
+    try:
+        if is_py3:
+            f = open(path, 'w', newline='', encoding='utf-8')
+        else:
+            f = open(path, 'wb')
+        with f:
+            writer = csv.writer(f)
+            writer.writerow(METRICS_CSV_COLUMNS)
+            for book_id in sorted(book_metrics):
+                m = book_metrics[book_id]
+                title = titles.get(book_id, '')
+                if not is_py3:
+                    title = title.encode('utf-8')
+                for option in sorted(m['options']):
+                    writer.writerow([book_id, title, option, '%.3f' % m['options'][option]['seconds'],
+                                     m['options'][option]['files'], '', ''])
+                writer.writerow([book_id, title, 'total', '%.3f' % m['seconds'], '',
+                                 m['bytes_in'], m['bytes_out']])
+        print('Option metrics written to: %s' % path)
+    except EnvironmentError as e:
+        print('Failed to write option metrics to: %s - %s' % (path, e))
@@ -0,0 +1,285 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import re, time
+
+from lxml import etree
+from polyglot.builtins import unicode_type
+
+from calibre.ebooks.chardet import strip_encoding_declarations
+from calibre.ebooks.oeb.base import XPath
+
+# The options that rewrite the html of each page, in the order they are applied
+HTML_TRANSFORM_OPTIONS = ['encode_html_utf8', 'remove_javascript', 'smarten_punctuation',
+                          'strip_kobo', 'strip_spans', 'unpretty']
+
+RE_XML_DECLARATION = re.compile(r'<\?xml([^\?]*?)\?><')
+RE_ELLIPSIS = re.compile(r'(?u)(?<=\w)\s?(\.\s?){2}\.')
+RE_DOUBLE_DASH = re.compile(r'\s--\s')
+RE_PRE = re.compile(r'<pre\s*([^>]*?)>', re.I)
+RE_TAG = re.compile(r'(<.+?>)')
+
+RE_KOBO_META1 = re.compile(r'\s*<!-- kobo-style -->', re.UNICODE | re.IGNORECASE)
+RE_KOBO_META2 = re.compile(r'\s*<script[^>]*? src="[^"]*?js/kobo(|-android)\.js"(/|></script)>', re.UNICODE | re.IGNORECASE)
+RE_KOBO_META3 = re.compile(r'\s*<style[^>]*? id="kobo[\s\S]*?</style>', re.UNICODE | re.IGNORECASE)
+RE_KOBO_META4 = re.compile(r'\s*<link[^>]*? href="[^"]*?css/kobo(|-android)\.css"[\s\S]*?(/|></link)>', re.UNICODE | re.IGNORECASE)
+
+# Substitutions applied in turn by each option, as (pattern, replacement)
+UNPRETTY_SUBS = [
+    (re.compile(r'\r\n?'), r'\n'),
+    (re.compile(r'<!--([\s\S]*?)-->'), r''),
+    (re.compile(r'</(b|h)r>'), r''),
+    (re.compile(r'!DOCTYPE([^>]*?)\n([^>]*?)>'), r'!DOCTYPE\1 \2>'),
+    (re.compile(r'!DOCTYPE([^>]*?)>\s*'), r'!DOCTYPE\1>\n'),
+    (re.compile(r'>\n\s+<'), r'>\n<'),
+    (re.compile(r'\s+</([^>]+)>'), r'</\1> '),
+    (re.compile(r'[^\S\n]+\n'), r'\n'),
+    (re.compile(r'<(\S+)([^/>]*?) style="display: ?none;?"([^/>]*?)></\1>'), r''),
+    (re.compile(r'>\s*<(html|head|title|meta|link|style|body|h\d|ul|ol|li|p|div|section|nav|tr|td)([^>]*?)(/?)>'), r'>\n<\1\2\3>'),
+    (re.compile(r'<(h\d|li|p|div|section|nav|td)([^/>]*?)>\s*<(span|b|i|a|small)'), r'<\1\2><\3'),
+    (re.compile(r'<(span|b|i|a|u|em|strong|small)([^>]*?)> <(span|b|i|a|u|em|strong|small)'), r' <\1\2><\3'),
+    (re.compile(r'>\s+<(span|b|i|a|u|em|strong|big|small)'), r'> <\1'),
+    (re.compile(r'\s*<(section|nav|div)([^>]*?)>'), r'\n<\1\2>'),
+    (re.compile(r'<(section|nav|div)([^>]*?)>\s*'), r'<\1\2>\n'),
+    (re.compile(r'\s*</(title|body|html)>\s*'), r'</\1>\n'),
+    (re.compile(r'\s*</(h\d|ul|ol|p|table|tr)>\s*'), r'</\1>\n\n'),
+    (re.compile(r'\s*<(b|h)r([^>]*?)/?>\s*'), r'<\1r\2/>\n'),
+    (re.compile(r'<(meta|link)([^>]*?)/?>\s*'), r'<\1\2/>\n'),
+    (re.compile(r'>\n*<(body|h\d|ul|ol|p|hr|table)( ?)'), r'>\n\n<\1\2'),
+    (re.compile(r'<(body|table|tr)([^>]*?)>\n*'), r'<\1\2>\n'),
+    (re.compile(r'<td([^>]*?)>\n+'), r'<td\1>\n'),
+    (re.compile(r'\n+</td>'), r'\n</td>'),
+    (re.compile(r'\s*</(div|section|nav|table|tr|ul|ol|body)>'), r'\n</\1>'),
+    (re.compile(r'\s*</head>\s*'), r'\n</head>\n\n'),
+    (re.compile(r'\s*</(body|style)>'), r'\n</\1>'),
+    (re.compile(r'/html>\s+'), r'/html>'),
+    (re.compile(r' +'), r' '),
+]
+
+STRIP_SPANS_SUBS = [
+    (re.compile(r'<(\S+)([^/>]*?) style="display: ?none;"([^/>]*?)></\1>'), r''),
+    (re.compile(r'<(\S+)([^/>]*?)></\1>'), r'<\1\2/>'),
+    (re.compile(r'<([^>]*?)(\s+?)/>'), r'<\1/>'),
+    (re.compile(r'</(b|h)r>'), r''),
+    (re.compile(r'<(b|h)r([^/>]*?)/?>'), r'<\1r\2/>'),
+    (re.compile(r'<(b|i|u|a|em|strong|span|big|small)/>'), r''),
+    (re.compile(r'<\?dp([^>]*?)\?>\n?'), r''),
+]
+
+STRIP_KOBO_SUBS = [
+    (re.compile(r'<(\S+)([^/>]*?)></\1>'), r'<\1\2/>'),
+    (re.compile(r'<([^>]*?)(\s+?)/>'), r'<\1/>'),
+    (re.compile(r'<span([^>]+?) id="kobo([^"]+?)"'), r'<span id="kobo\2"\1'),
+    (re.compile(r'</(b|h)r>'), r''),
+    (re.compile(r'<(b|h)r([^/>]*?)/?>'), r'<\1r\2/>'),
+    (re.compile(r'<(b|i|u|a|em|strong|span|big|small)/>'), r''),
+]
+
+class TAG:
+    content = ''    #actual content
+    pair = 0        #tag pair
+    e_type = 0      #1=OPEN 2=CLOSE 3=CONTAINED 4=TEXT OR CR/LF 9=REMOVE-EMPTY-SPAN
+
+def apply_subs(subs, html_text):
+    for pattern, replacement in subs:
+        html_text = pattern.sub(replacement, html_text)
+    return html_text
+
+
+class HtmlTransformer(object):
+    '''
+    Applies the options which rewrite the html of each page as a single pass
+    over the pages. The text of each page is read once, passed through every
+    selected transform in turn and only set back in the container once, so it
+    is serialised and re-parsed at most once however many options are selected.
+    '''
+
+    def __init__(self, log, container):
+        self.log = log
+        self.container = container
+        self.preprocessor = None
+        # Map of option to the total seconds spent applying it to the pages
+        self.timings = {}
+        # Map of option to the number of pages it changed
+        self.files_changed = {}
+
+    def transform(self, options):
+        '''
+        Apply the named options from HTML_TRANSFORM_OPTIONS to every html page
+        '''
+        transforms = [(option, getattr(self, option)) for option in options]
+        self.log('\tApplying html options:', ', '.join(options))
+        dirtied = False
+        for name in self.container.get_html_names():
+            orig_html = html = self.container.get_raw(name)
+            if isinstance(html, bytes):
+                # A page that could not be read as text is decoded the same way
+                # as when it is parsed, and only set back if a transform changes it
+                orig_html = html = self.container.decode(html)
+            for option, transform in transforms:
+                start_time = time.time()
+                new_html = transform(name, html)
+                self.timings[option] = self.timings.get(option, 0) + time.time() - start_time
+                if new_html is not html and new_html != html:
+                    self.files_changed[option] = self.files_changed.get(option, 0) + 1
+                html = new_html
+            if html != orig_html:
+                dirtied = True
+                self.container.set(name, html)
+        return dirtied
+
+    def encode_html_utf8(self, name, html):
+        try:
+            new_html = strip_encoding_declarations(html)
+            #new_html = new_html.encode('utf-8')
+            if not new_html.strip().startswith('<?xml'):
+                new_html = '<?xml version="1.0" encoding="utf-8"?>'+new_html
+                new_html = RE_XML_DECLARATION.sub(r'<?xml\1?>\n<', new_html)
+            if new_html != html:
+                self.log('\t  Switched to UTF-8 encoding for:', name)
+                return new_html
+        except:
+            pass
+        return html
+
+    def remove_javascript(self, name, html):
+        # Only parse pages that could contain a script element
+        if 'script' not in html.lower():
+            return html
+        data = self.container.parse_raw(name, html)
+        try:
+            scripts = XPath('//h:script[@type="text/javascript"]')(data)
+        except:
+            scripts = []
+        if not scripts:
+            return html
+        for script in scripts:
+            script.getparent().remove(script)
+            self.log('\t  Removed script block from:', name)
+        return unicode_type(etree.tostring(data, encoding='unicode'))
+
+    def smarten_punctuation(self, name, html):
+        from calibre.utils.smartypants import smartyPants
+        from calibre.ebooks.chardet import substitute_entites
+        from uuid import uuid4
+        if self.preprocessor is None:
+            from calibre.ebooks.conversion.utils import HeuristicProcessor
+            self.preprocessor = HeuristicProcessor(None, self.log)
+
+        start = 'calibre-smartypants-'+str(uuid4())
+        stop = 'calibre-smartypants-'+str(uuid4())
+        new_html = html.replace('<!--', start)
+        new_html = new_html.replace('-->', stop)
+        new_html = self.preprocessor.fix_nbsp_indents(new_html)
+        new_html = smartyPants(new_html)
+        new_html = new_html.replace(start, '<!--')
+        new_html = new_html.replace(stop, '-->')
+        # convert ellipsis to entities to prevent wrapping
+        new_html = RE_ELLIPSIS.sub('&hellip;', new_html)
+        # convert double dashes to em-dash
+        new_html = RE_DOUBLE_DASH.sub(u'\u2014', new_html)
+        new_html = substitute_entites(new_html)
+        if new_html != html:
+            self.log('\t  Smartened punctuation in:', name)
+        return new_html
+
+    def strip_kobo(self, name, html):
+        new_html = RE_KOBO_META1.sub('', html)
+        new_html = RE_KOBO_META2.sub('', new_html)
+        new_html = RE_KOBO_META3.sub('', new_html)
+        new_html = RE_KOBO_META4.sub('', new_html)
+        if html != new_html:
+            self.log('\t  Removed Kobo HEAD elements from:', name)
+            html = new_html
+
+        new_html = apply_subs(STRIP_KOBO_SUBS, html)
+        new_html = self._remove_unpaired_tags(new_html,
+                        lambda entity: entity[:15] == u'<span id="kobo.')
+        if html != new_html:
+            self.log('\t  Stripped Kobo spans in:', name)
+        return new_html
+
+    def strip_spans(self, name, html):
+        def strip_span_for_page(html_text):
+            html_text = apply_subs(STRIP_SPANS_SUBS, html_text)
+            return self._remove_unpaired_tags(html_text, lambda entity: entity == u'<span>')
+
+        new_html = html
+        while True:
+            next_html = strip_span_for_page(new_html)
+            if next_html == new_html:
+                break
+            new_html = next_html
+        if html != new_html:
+            self.log('\t  Stripped spans in:', name)
+        return new_html
+
+    def unpretty(self, name, html):
+        if RE_PRE.search(html):
+            self.log('\t  Skipped:', name, ' - not safe to unpretty files which contain PRE elements.');
+            return html
+
+        new_html = html
+        while True:
+            next_html = apply_subs(UNPRETTY_SUBS, new_html)
+            if next_html == new_html:
+                break
+            new_html = next_html
+        if html != new_html:
+            self.log('\t  De-indented:', name)
+        return new_html
+
+    def _remove_unpaired_tags(self, html_text, is_removable):
+        '''
+        Split the html into tags and text, pair each closing tag with its opening
+        tag and drop the removable opening tags along with their closing tags.
+        '''
+        HTML_ENTITY = []
+
+        entities = RE_TAG.split(html_text)
+
+        total = 0
+        for entity in entities:
+            if entity:
+                entity = self.container.decode(entity)
+                total += 1
+                this_entity = TAG()
+                this_entity.content = entity
+                if is_removable(entity):
+                    this_entity.e_type = 9
+                elif entity[-2:] == u'/>':
+                    this_entity.e_type = 3
+                elif entity[0] != u'<':
+                    this_entity.e_type = 4
+                elif entity[:2] == u'</':
+                    this_entity.e_type = 2
+                else:
+                    this_entity.e_type = 1
+                HTML_ENTITY.append(this_entity)
+
+        pos = -1
+        PAIR = 0
+        while pos < total-1:
+            pos+=1
+            if HTML_ENTITY[pos].e_type == 2:
+                PAIR += 1
+                HTML_ENTITY[pos].pair = PAIR
+                pair_pos = pos
+                while True:
+                    pair_pos += -1
+                    if pair_pos<0 : break
+                    e_type = HTML_ENTITY[pair_pos].e_type
+                    if e_type == 1 or e_type==9:
+                        if HTML_ENTITY[pair_pos].pair == 0:
+                            HTML_ENTITY[pair_pos].pair = PAIR
+                            if e_type == 9: HTML_ENTITY[pos].e_type = 9
+                            break
+
+        output = []
+        for entry in HTML_ENTITY:
+            if entry.e_type < 9:
+                output.append(entry.content)
+
+        return ''.join(output)
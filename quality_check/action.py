@@ -43,6 +43,7 @@ class QualityCheckAction(InterfaceAction):
         self.menu = QMenu(self.gui)
         self.last_menu_key = None
         self.last_menu_cat = None
+        self.force_rescan = False
 
         # Build the list of plugin icons from the configuration menus
         plugin_icons = set([DEFAULT_ICON])
@@ -120,8 +121,12 @@ class QualityCheckAction(InterfaceAction):
         self.repeat_check_menu = create_menu_action_unique(self, m, _('Repeat last check'), image='images/repeat_check.png',
                          tooltip=self._get_last_action_description(),
                          triggered=self.repeat_check)
+        self.rescan_check_menu = create_menu_action_unique(self, m, _('Repeat last check (full rescan)'), image='images/repeat_check.png',
+                         tooltip=_('Repeat the last Quality Check menu action, ignoring any cached results'),
+                         triggered=self.rescan_check)
         if not self.last_menu_key:
             self.repeat_check_menu.setEnabled(False)
+            self.rescan_check_menu.setEnabled(False)
         m.addSeparator()
 
         search_menu = m.addMenu(_('Search scope'))
@@ -188,8 +193,10 @@ class QualityCheckAction(InterfaceAction):
         self.repeat_check_menu.setStatusTip(description)
         self.repeat_check_menu.setWhatsThis(description)
         self.repeat_check_menu.setEnabled(True)
+        self.rescan_check_menu.setEnabled(True)
 
         check.menu_key = menu_key
+        check.force_rescan = self.force_rescan
         check.perform_check(menu_key)
 
     def _get_last_action_description(self):
@@ -202,6 +209,14 @@ class QualityCheckAction(InterfaceAction):
         if self.last_menu_key:
             self.perform_check(self.last_menu_key, self.last_menu_cat)
 
+    def rescan_check(self):
+        if self.last_menu_key:
+            self.force_rescan = True
+            try:
+                self.perform_check(self.last_menu_key, self.last_menu_cat)
+            finally:
+                self.force_rescan = False
+
     def exclude_add(self):
         rows = self.gui.library_view.selectionModel().selectedRows()
         if not rows or len(rows) == 0:
@@ -3,6 +3,9 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake'
 
+import hashlib, json, os, threading, traceback
+from six import text_type as unicode
+
 from calibre.utils.logging import GUILog
 
 try:
@@ -13,16 +16,115 @@ except NameError:
 import calibre_plugins.quality_check.config as cfg
 from calibre_plugins.quality_check.dialogs import QualityProgressDialog, ResultsSummaryDialog
 
+
+class BookLogRecorder(object):
+    '''
+    Stands in for the check log while a book is evaluated on a worker thread,
+    recording each line so it can be written to the real log from the GUI
+    thread in book order.
+    '''
+    def __init__(self):
+        self.lines = []
+
+    def __call__(self, *args, **kwargs):
+        self.lines.append(('info', args))
+
+    def debug(self, *args, **kwargs):
+        self.lines.append(('debug', args))
+
+    def info(self, *args, **kwargs):
+        self.lines.append(('info', args))
+
+    def warn(self, *args, **kwargs):
+        self.lines.append(('warn', args))
+    warning = warn
+
+    def error(self, *args, **kwargs):
+        self.lines.append(('error', args))
+
+    def exception(self, *args, **kwargs):
+        self.lines.append(('error', args + (traceback.format_exc(),)))
+
+    def replay(self, log):
+        for level, args in self.lines:
+            getattr(log, level)(*args)
+
+    def serialize(self):
+        return [[level, [unicode(a) for a in args]] for level, args in self.lines]
+
+    @classmethod
+    def deserialize(cls, lines):
+        recorder = cls()
+        recorder.lines = [(level, tuple(args)) for level, args in lines]
+        return recorder
+
+
+class ResolvedBookData(object):
+    '''
+    The subset of the legacy database API used by the file based checks,
+    resolved up front on the GUI thread so that books can be evaluated on
+    worker threads without touching the live database.
+    '''
+    def __init__(self, db, book_ids, formats):
+        api = db.new_api
+        self.library_path = db.library_path
+        self._titles = api.all_field_for('title', book_ids)
+        self._authors = api.all_field_for('authors', book_ids)
+        self._paths = api.all_field_for('path', book_ids)
+        self._covers = api.all_field_for('cover', book_ids)
+        self._format_paths = {}
+        for book_id, book_formats in api.all_field_for('formats', book_ids).items():
+            for fmt in book_formats or ():
+                if fmt.upper() in formats:
+                    self._format_paths[(book_id, fmt.upper())] = api.format_abspath(book_id, fmt)
+
+    def title(self, book_id, index_is_id=True):
+        return self._titles.get(book_id)
+
+    def authors(self, book_id, index_is_id=True):
+        authors = self._authors.get(book_id)
+        if authors:
+            return ','.join(a.replace(',', '|') for a in authors)
+
+    def path(self, book_id, index_is_id=True):
+        return self._paths.get(book_id)
+
+    def has_cover(self, book_id):
+        return bool(self._covers.get(book_id))
+
+    def has_format(self, book_id, fmt, index_is_id=True):
+        return (book_id, fmt.upper()) in self._format_paths
+
+    def format_abspath(self, book_id, fmt, index_is_id=True):
+        return self._format_paths.get((book_id, fmt.upper()))
+
+
 class BaseCheck(object):
     '''
     Base class for all quality check implementations
     '''
+    # Formats to resolve up front for checks that can evaluate books on worker
+    # threads. None means the check needs the live database so runs on the GUI thread.
+    WORKER_FORMATS = None
+
     def __init__(self, gui, initial_search=''):
         self.gui = gui
-        self.log = GUILog()
+        self._log = GUILog()
+        self._thread_state = threading.local()
         self.menu_key = None
         self.book_ids = []
         self.initial_search = initial_search
+        # When set to a list, check_all_files() will append the evaluation
+        # function to it rather than running it, so a suite of checks can
+        # be evaluated in a single pass.
+        self.collected_checks = None
+        # Set to ignore any cached results from previous runs of this check
+        self.force_rescan = False
+
+    @property
+    def log(self):
+        # Books evaluated on a worker thread log to a recorder for that book
+        return getattr(self._thread_state, 'log', None) or self._log
 
     def perform_check(self, menu_key):
         '''
@@ -35,41 +137,207 @@ class BaseCheck(object):
         self.book_ids = book_ids
 
     def check_all_files(self, callback_fn, status_msg_type='books',
-                        no_match_msg=None, show_matches=True, marked_text='true'):
+                        no_match_msg=None, show_matches=True, marked_text='true',
+                        cache_options=None):
         '''
         Performs the quality check in a threaded fashion with progress dialog
+
+        :param cache_options: Any options the check result depends on besides
+                              the book files, for invalidating cached results
+        '''
+        if self.collected_checks is not None:
+            self.collected_checks.append((self.menu_key, callback_fn, marked_text, cache_options))
+            return 0, [], ''
+
+        self.book_ids = self.get_book_ids_to_check(self.menu_key)
+
+        new_results = {}
+        callback_fn = self.cached_evaluator(self.menu_key, callback_fn, cache_options,
+                                            self.book_ids, new_results)
+        d = self.run_progress_dialog(self.book_ids, callback_fn, status_msg_type)
+        self.save_cached_results(self.menu_key, new_results)
+        cancelled_msg = ''
+        if d.wasCanceled():
+            cancelled_msg = _(' (cancelled)')
+        if show_matches:
+            self.show_results(d.total_count, d.result_ids, cancelled_msg, no_match_msg, marked_text)
+        return d.total_count, d.result_ids, cancelled_msg
+
+    def check_all_metadata(self, fields, callback_fn, no_match_msg=None, marked_text='true'):
+        '''
+        Performs a metadata only quality check. Each field is fetched for all
+        books at once, and callback_fn(book_id, *field_values) is called for
+        each book with the values of the fields in the order given.
+        '''
+        book_ids, columns = self.get_metadata_columns(fields)
+        result_ids = [book_id for book_id in book_ids
+                      if callback_fn(book_id, *[column.get(book_id) for column in columns])]
+        self.show_results(len(book_ids), result_ids, '', no_match_msg, marked_text)
+        return len(book_ids), result_ids, ''
+
+    def get_metadata_columns(self, fields):
+        '''
+        Return the book ids to check and a list of maps of book id to value
+        for each of the fields given, read from the database in one call per field.
+        '''
+        self.book_ids = self.get_book_ids_to_check(self.menu_key)
+        api = self.gui.current_db.new_api
+        return self.book_ids, [api.all_field_for(field, self.book_ids) for field in fields]
+
+    def show_results(self, total_count, result_ids, cancelled_msg, no_match_msg=None, marked_text='true'):
+        if len(result_ids) > 0:
+            self.show_invalid_rows(result_ids, marked_text)
+            if self.log.plain_text:
+                sd = ResultsSummaryDialog(self.gui, _('Quality Check'),
+                                         _('%d matches found%s, see log for details')%(len(result_ids), cancelled_msg),
+                                         self.log)
+                sd.exec_()
+        if no_match_msg:
+            msg = _('Checked %d books, found %d matches%s') %(total_count, len(result_ids), cancelled_msg)
+            self.gui.status_bar.showMessage(msg)
+            if len(result_ids) == 0:
+                sd = ResultsSummaryDialog(self.gui, _('No Matches'), no_match_msg, self.log)
+                sd.exec_()
+
+    def get_cache_paths(self, book_id, db):
+        '''
+        Return the paths of the files this check evaluates for the book
+        '''
+        paths = []
+        for fmt in self.WORKER_FORMATS or []:
+            if db.has_format(book_id, fmt, index_is_id=True):
+                path = db.format_abspath(book_id, fmt, index_is_id=True)
+                if path:
+                    paths.append(path)
+        return paths
+
+    def get_cache_key(self, book_id, db, options_hash):
+        key = [options_hash]
+        for path in self.get_cache_paths(book_id, db):
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            key.append([path, st.st_size, st.st_mtime])
+        # Nothing on disk to compare against means nothing worth caching
+        if len(key) == 1:
+            return None
+        return key
+
+    def cached_evaluator(self, menu_key, callback_fn, cache_options, book_ids, new_results):
+        '''
+        Wrap the evaluation function of a file based check so that books whose
+        files are unchanged since the last run with the same options report
+        their cached result and log lines instead of being evaluated again.
+        Results of books that are evaluated are added to new_results.
+        '''
+        if self.WORKER_FORMATS is None or not menu_key:
+            return callback_fn
+        if not cfg.plugin_prefs[cfg.STORE_OPTIONS].get(cfg.KEY_CACHE_RESULTS, True):
+            return callback_fn
+        from calibre_plugins.quality_check import ActionQualityCheck
+        options_hash = hashlib.sha1(json.dumps([menu_key, ActionQualityCheck.version, cache_options],
+                                               sort_keys=True).encode('utf-8')).hexdigest()
+        cached_results = {}
+        if not self.force_rescan:
+            cached_results = self.gui.current_db.new_api.get_custom_book_data(
+                                cfg.RESULT_CACHE_PREFIX + menu_key, book_ids, default=None)
+
+        def evaluate_book(book_id, db):
+            key = self.get_cache_key(book_id, db, options_hash)
+            cached = cached_results.get(book_id)
+            if key is not None and cached and cached.get('key') == key:
+                BookLogRecorder.deserialize(cached['log']).replay(self.log)
+                return cached['matched']
+
+            outer_log = getattr(self._thread_state, 'log', None)
+            recorder = BookLogRecorder()
+            self._thread_state.log = recorder
+            try:
+                matched = callback_fn(book_id, db)
+            finally:
+                self._thread_state.log = outer_log
+            recorder.replay(self.log)
+            if key is not None:
+                new_results[book_id] = {'key': key, 'matched': bool(matched), 'log': recorder.serialize()}
+            return matched
+
+        return evaluate_book
+
+    def save_cached_results(self, menu_key, new_results):
+        if new_results:
+            self.gui.current_db.new_api.add_custom_book_data(cfg.RESULT_CACHE_PREFIX + menu_key, new_results)
+
+    def get_worker_count(self):
+        if self.WORKER_FORMATS is None:
+            return 1
+        c = cfg.plugin_prefs[cfg.STORE_OPTIONS]
+        return max(1, c.get(cfg.KEY_WORKER_THREADS, cfg.DEFAULT_STORE_VALUES[cfg.KEY_WORKER_THREADS]))
+
+    def run_progress_dialog(self, book_ids, callback_fn, status_msg_type='books'):
+        '''
+        Evaluate the books with a progress dialog, on worker threads if this
+        check supports it and the user has configured more than one.
+        '''
+        db = self.gui.current_db
+        worker_count = self.get_worker_count()
+        if worker_count <= 1 or len(book_ids) <= 1:
+            return QualityProgressDialog(self.gui, book_ids, callback_fn, db, status_msg_type)
+
+        def evaluate_book(book_id, db):
+            recorder = BookLogRecorder()
+            self._thread_state.log = recorder
+            try:
+                return callback_fn(book_id, db), recorder
+            except:
+                recorder.error('ERROR evaluating book: ', book_id)
+                recorder(traceback.format_exc())
+                return False, recorder
+            finally:
+                self._thread_state.log = None
+
+        def apply_result(book_id, result):
+            matched, recorder = result
+            recorder.replay(self.log)
+            return matched
+
+        resolved_db = ResolvedBookData(db, book_ids, self.WORKER_FORMATS)
+        return QualityProgressDialog(self.gui, book_ids, evaluate_book, resolved_db, status_msg_type,
+                                     worker_count=worker_count, result_fn=apply_result)
+
+    def get_book_ids_to_check(self, menu_key=None):
+        '''
+        Return the book ids in the search scope, less any excluded for this check
         '''
         # If scope is limited to selected book ids this set will have been set.
         if not self.book_ids:
             self.gui.search.clear()
             self.book_ids = self.gui.current_db.search(self.initial_search, return_matches=True)
+        book_ids = self.book_ids
         # Exclude any books that have exclusions for this check
-        if self.menu_key:
-            excluded_ids = cfg.get_valid_excluded_books(self.gui.current_db, self.menu_key)
+        if menu_key:
+            excluded_ids = cfg.get_valid_excluded_books(self.gui.current_db, menu_key)
             if excluded_ids:
                 excluded_map = dict((i, True) for i in excluded_ids)
-                self.book_ids = [i for i in self.book_ids if i not in excluded_map]
+                book_ids = [i for i in book_ids if i not in excluded_map]
+        return book_ids
 
-        d = QualityProgressDialog(self.gui, self.book_ids, callback_fn, self.gui.current_db,
-                                  status_msg_type)
-        cancelled_msg = ''
-        if d.wasCanceled():
-            cancelled_msg = _(' (cancelled)')
-        if show_matches:
-            if len(d.result_ids) > 0:
-                self.show_invalid_rows(d.result_ids, marked_text)
-                if self.log.plain_text:
-                    sd = ResultsSummaryDialog(self.gui, _('Quality Check'),
-                                             _('%d matches found%s, see log for details')%(len(d.result_ids), cancelled_msg),
-                                             self.log)
-                    sd.exec_()
-            if no_match_msg:
-                msg = _('Checked %d books, found %d matches%s') %(d.total_count, len(d.result_ids), cancelled_msg)
-                self.gui.status_bar.showMessage(msg)
-                if len(d.result_ids) == 0:
-                    sd = ResultsSummaryDialog(self.gui, _('No Matches'), no_match_msg, self.log)
-                    sd.exec_()
-        return d.total_count, d.result_ids, cancelled_msg
+    def collect_checks(self, menu_keys):
+        '''
+        Perform the checks for each of the menu keys, returning a list of
+        (menu_key, callback_fn, marked_text) tuples for evaluation by the
+        caller rather than running each check across the library in turn.
+        '''
+        suite_menu_key = self.menu_key
+        self.collected_checks = []
+        try:
+            for menu_key in menu_keys:
+                self.menu_key = menu_key
+                self.perform_check(menu_key)
+            return self.collected_checks
+        finally:
+            self.collected_checks = None
+            self.menu_key = suite_menu_key
 
     def show_invalid_rows(self, result_ids, marked_text='true'):
         marked_ids = dict.fromkeys(result_ids, marked_text)
@@ -9,17 +9,19 @@ except NameError:
     pass # load_translations() added in calibre 1.9
 
 import os
-from PIL import Image
 from calibre.gui2 import error_dialog
 
 from calibre_plugins.quality_check.check_base import BaseCheck
 from calibre_plugins.quality_check.dialogs import CoverOptionsDialog, ResultsSummaryDialog
+from calibre_plugins.quality_check.image_size import get_image_dimensions
 
 
 class CoverCheck(BaseCheck):
     '''
     All checks related to working with covers.
     '''
+    WORKER_FORMATS = []
+
     def perform_check(self, menu_key):
         if menu_key == 'check_covers':
             self.check_covers()
@@ -28,6 +30,11 @@ class CoverCheck(BaseCheck):
                                 _('Unknown menu key for %s of \'%s\'')%('CoverCheck', menu_key),
                                 show=True, show_copy_button=False)
 
+    def get_cache_paths(self, book_id, db):
+        if not db.has_cover(book_id):
+            return []
+        return [os.path.join(db.library_path, db.path(book_id, index_is_id=True), 'cover.jpg')]
+
     def check_covers(self):
         d = CoverOptionsDialog(self.gui)
         d.exec_()
@@ -66,11 +73,10 @@ class CoverCheck(BaseCheck):
                     mark_book = True
             else:
                 try:
-                    im = Image.open(cover_path)
+                    (cover_width, cover_height) = get_image_dimensions(cover_path)
                 except IOError:
                     self.log(_('Failed to identify cover:'), cover_path)
                 else:
-                    (cover_width, cover_height) = im.size
                     if check_type == _('less than'):
                         if cover_width < min_image_width:
                             mark_book = True
@@ -99,9 +105,14 @@ class CoverCheck(BaseCheck):
                                 mark_book = True
             return mark_book
 
+        if is_file_size_check:
+            cache_options = [check_type, min_file_size]
+        else:
+            cache_options = [check_type, min_image_width, min_image_height]
         total_count, result_ids, cancelled_msg = self.check_all_files(evaluate_book,
                                                                   marked_text='cover_check',
-                                                                  status_msg_type=_('books for covers'))
+                                                                  status_msg_type=_('books for covers'),
+                                                                  cache_options=cache_options)
 
         msg = _('Checked %d books, found %d cover matches%s') % (total_count, len(result_ids), cancelled_msg)
         self.gui.status_bar.showMessage(msg)
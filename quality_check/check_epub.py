@@ -12,11 +12,14 @@ from polyglot.builtins import unicode_type, is_py3
 from six import text_type as unicode
 from six.moves.urllib.parse import unquote as urlunquote
 import traceback, os, posixpath, six.moves.urllib.request, six.moves.urllib.parse, six.moves.urllib.error, re
+import threading
+from collections import namedtuple
 try:
     from cgi import escape as esc
 except:
     from html import escape as esc
 
+from io import BytesIO
 from lxml import etree
 
 from calibre import guess_type
@@ -28,9 +31,14 @@ from calibre.ebooks.oeb.base import XPath
 from calibre.ebooks.oeb.parse_utils import RECOVER_PARSER, NotHTML, parse_html
 from calibre.utils.zipfile import ZipFile, BadZipfile
 
+import calibre_plugins.quality_check.config as cfg
 from calibre_plugins.quality_check.check_base import BaseCheck
-from calibre_plugins.quality_check.dialogs import SearchEpubDialog
+from calibre_plugins.quality_check.dialogs import (SearchEpubDialog, EpubCheckSuiteDialog,
+                                                   ResultsSummaryDialog)
+from calibre_plugins.quality_check.css_summary import BookCssSummary
 from calibre_plugins.quality_check.helpers import get_title_authors_text
+from calibre_plugins.quality_check.search_index import EpubTextIndex, required_literals
+from calibre_plugins.quality_check.search_stream import get_stream_match_width, iter_stream_matches
 
 META_INF = {
         'container.xml' : True,
@@ -70,14 +78,229 @@ OPF_NS = 'http://www.idpf.org/2007/opf'
 class InvalidEpub(ValueError):
     pass
 
+
+class EpubBookContext(object):
+    '''
+    Read-only view of an ePub zip that caches the namelist, infolist, member
+    contents and any parsed results (such as the OPF) for the book. When shared
+    across a suite of checks the archive is opened and parsed once per book
+    rather than once per check.
+    '''
+    UNCACHED_EXTENSIONS = IMAGE_FILES + FONT_FILES + EPUB_FILES
+
+    def __init__(self, path_to_book, shared=False):
+        self.path_to_book = path_to_book
+        self.shared = shared
+        self.zf = ZipFile(path_to_book, 'r')
+        self._namelist = None
+        self._infolist = None
+        self._data = {}
+        self._text = {}
+        self._memo = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        # A shared context is closed by whoever created it once all checks are done
+        if not self.shared:
+            self.close()
+
+    def close(self):
+        self.zf.close()
+        self._data.clear()
+        self._text.clear()
+        self._memo.clear()
+
+    def namelist(self):
+        if self._namelist is None:
+            self._namelist = self.zf.namelist()
+        return self._namelist
+
+    def infolist(self):
+        if self._infolist is None:
+            self._infolist = self.zf.infolist()
+        return self._infolist
+
+    def read(self, name):
+        if not isinstance(name, six.string_types):
+            # A ZipInfo, as used when testing the integrity of every member
+            return self.zf.read(name)
+        data = self._data.get(name)
+        if data is None:
+            data = self.zf.read(name)
+            if name[name.rfind('.'):].lower() not in self.UNCACHED_EXTENSIONS:
+                self._data[name] = data
+        return data
+
+    def open(self, name):
+        '''
+        Return a file object for this member, which is decompressed as it is read
+        unless its contents are already cached
+        '''
+        data = self._data.get(name)
+        if data is not None:
+            return BytesIO(data)
+        return self.zf.open(name)
+
+    def read_text(self, name):
+        text = self._text.get(name)
+        if text is None:
+            text = self.read(name)
+            if is_py3:
+                text = text.decode('utf-8', errors='replace')
+            self._text[name] = text
+        return text
+
+    def memo(self, key, fn):
+        '''
+        Return the cached result of fn() for this book, calling it on first use
+        '''
+        if key not in self._memo:
+            self._memo[key] = fn()
+        return self._memo[key]
+
+
+class OpfModel(object):
+    '''
+    The OPF of an ePub and the lookups derived from it, each built on first use
+    and kept while the book is open, so that the container.xml, OPF, NCX and guide
+    are parsed at most once per book however many checks use them.
+    '''
+    def __init__(self, check, zf):
+        self.check = check
+        self.zf = zf
+        self._cache = {}
+
+    def _cached(self, key, fn):
+        if key not in self._cache:
+            self._cache[key] = fn()
+        return self._cache[key]
+
+    @property
+    def names(self):
+        '''The set of all names in the zip'''
+        return self._cached('names', lambda: frozenset(self.zf.namelist()))
+
+    @property
+    def name(self):
+        '''The name of the OPF in the zip, raising InvalidEpub if it cannot be found'''
+        return self._cached('name', lambda: self.check._read_opf_name(self.zf.path_to_book, self.zf))
+
+    @property
+    def dir(self):
+        return posixpath.dirname(self.name)
+
+    @property
+    def tree(self):
+        return self._cached('tree', lambda: self.check._parse_opf_tree(self.zf, self.name))
+
+    @property
+    def manifest_items(self):
+        return self._cached('manifest_items', lambda: self.tree.xpath(r'child::opf:manifest/opf:item[@href]',
+                                                                      namespaces={'opf':OPF_NS}))
+
+    @property
+    def spine_ids(self):
+        return self._cached('spine_ids', lambda: frozenset(self.tree.xpath(r'child::opf:spine/opf:itemref/@idref',
+                                                                           namespaces={'opf':OPF_NS})))
+
+    @property
+    def guide_refs(self):
+        return self._cached('guide_refs', lambda: self.tree.xpath(r'child::opf:guide/opf:reference[@href]',
+                                                                  namespaces={'opf':OPF_NS}))
+
+    @property
+    def ncx_names(self):
+        '''The names of any NCX files, in zip order'''
+        return self._cached('ncx_names', lambda: [name for name in self.check._manifest_worthy_names(self.zf)
+                                                  if name.endswith('.ncx')])
+
+    def get_ncx_tree(self, ncx_name):
+        return self._cached(('ncx_tree', ncx_name),
+                            lambda: self.check._parse_xml(self.check.zf_read(self.zf, ncx_name)))
+
+    def href_to_name(self, href):
+        return self.check._href_to_name(href, self.dir)
+
+    def items_map(self, rebase_href=True, spine_only=False):
+        '''
+        Return a map of the zip name (or the raw href if not rebase_href) of each
+        manifest item to its element, optionally only for items in the spine.
+        '''
+        def build():
+            items_map = {}
+            spine_ids = self.spine_ids if spine_only else None
+            for item in self.manifest_items:
+                if spine_only and item.attrib['id'] not in spine_ids:
+                    continue
+                if rebase_href:
+                    items_map[self.href_to_name(item.attrib['href'])] = item
+                else:
+                    items_map[item.attrib['href']] = item
+            return items_map
+        return self._cached(('items_map', rebase_href, spine_only), build)
+
+    def get_item_name(self, xpath):
+        '''
+        Return the zip name of the first OPF element matching xpath, if it exists in the zip
+        '''
+        def find():
+            items = self.tree.xpath(xpath, namespaces={'opf':OPF_NS})
+            if len(items):
+                item_name = self.href_to_name(items[0].attrib['href'])
+                if item_name in self.names:
+                    return item_name
+        return self._cached(('item_name', xpath), find)
+
+
+ManifestEntry = namedtuple('ManifestEntry', 'filename file_size compress_size CRC encrypted')
+
+
+class ArchiveManifest(object):
+    '''
+    The zip central directory of an ePub, plus whether its container.xml locates
+    the OPF and whether any member fails to decompress, as cached per book so that
+    structural checks need not open the zip. Offers the namelist() and infolist()
+    of a zip file, with ManifestEntry tuples in place of ZipInfo.
+    '''
+    def __init__(self, data):
+        if data['zip_error']:
+            raise BadZipfile(data['zip_error'])
+        self.data = data
+        self._entries = [ManifestEntry(*e) for e in data['entries']]
+
+    def namelist(self):
+        return [e.filename for e in self._entries]
+
+    def infolist(self):
+        return self._entries
+
+    @property
+    def opf_error(self):
+        return self.data['opf_error']
+
+    @property
+    def corrupt(self):
+        return self.data['corrupt']
+
+
 class EpubCheck(BaseCheck):
     '''
     All checks related to working with ePub formats.
     '''
+    WORKER_FORMATS = ['EPUB']
+
     def __init__(self, gui):
         BaseCheck.__init__(self, gui, 'formats:epub')
         self.html_preprocessor = HTMLPreProcessor()
         self.input_encoding = 'utf-8'
+        # Map of path to the EpubBookContext shared by a suite of checks
+        self.shared_contexts = {}
+        # Cached archive manifests of the books being checked, loaded on first use
+        self.archive_manifests = None
+        self.new_archive_manifests = {}
+        self.manifest_lock = threading.Lock()
 
     def perform_check(self, menu_key):
         if menu_key == 'check_epub_jacket':
@@ -180,6 +403,8 @@ class EpubCheck(BaseCheck):
 
         elif menu_key == 'search_epub':
             self.search_epub()
+        elif menu_key == 'check_epub_suite':
+            self.check_epub_suite()
 
         else:
             return error_dialog(self.gui, _('Quality Check failed'),
@@ -187,10 +412,92 @@ class EpubCheck(BaseCheck):
                                 show=True, show_copy_button=False)
 
     def zf_read(self, zf, name):
-        data = zf.read(name)
-        if is_py3:
-            return data.decode('utf-8', errors='replace')
-        return data
+        return zf.read_text(name)
+
+    def _open_epub(self, path_to_book):
+        if path_to_book in self.shared_contexts:
+            context = self.shared_contexts[path_to_book]
+            if context is None:
+                context = self.shared_contexts[path_to_book] = EpubBookContext(path_to_book, shared=True)
+            return context
+        return EpubBookContext(path_to_book)
+
+    def check_all_files(self, *args, **kwargs):
+        try:
+            return BaseCheck.check_all_files(self, *args, **kwargs)
+        finally:
+            self._save_archive_manifests()
+
+    def check_epub_suite(self):
+        '''
+        Run a selection of ePub checks together, opening each ePub only once
+        and sharing the parsed zip contents and OPF between the checks.
+        '''
+        d = EpubCheckSuiteDialog(self.gui)
+        d.exec_()
+        if d.result() != d.Accepted:
+            return
+
+        checks = self.collect_checks(d.selected_checks)
+        if not checks:
+            return
+        book_ids = self.book_ids = self.get_book_ids_to_check()
+        excluded_maps = {}
+        evaluators = {}
+        new_results = {}
+        for menu_key, callback_fn, marked_text, cache_options in checks:
+            excluded_maps[menu_key] = set(cfg.get_valid_excluded_books(self.gui.current_db, menu_key))
+            new_results[menu_key] = {}
+            evaluators[menu_key] = self.cached_evaluator(menu_key, callback_fn, cache_options,
+                                                         book_ids, new_results[menu_key])
+        check_results = dict((menu_key, []) for menu_key in evaluators)
+
+        def evaluate_book(book_id, db):
+            path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
+            if path_to_book:
+                # Opened on first use, so books with every result cached are not read
+                self.shared_contexts[path_to_book] = None
+            try:
+                matched = False
+                for menu_key, callback_fn, marked_text, cache_options in checks:
+                    if book_id in excluded_maps[menu_key]:
+                        continue
+                    if evaluators[menu_key](book_id, db):
+                        check_results[menu_key].append(book_id)
+                        matched = True
+                return matched
+            finally:
+                context = self.shared_contexts.pop(path_to_book, None)
+                if context is not None:
+                    context.close()
+
+        d = self.run_progress_dialog(book_ids, evaluate_book, _('ePub books for check suite'))
+        for menu_key, results in new_results.items():
+            self.save_cached_results(menu_key, results)
+        self._save_archive_manifests()
+        cancelled_msg = ''
+        if d.wasCanceled():
+            cancelled_msg = _(' (cancelled)')
+
+        db = self.gui.current_db
+        self.log('*** '+_('Check suite results')+' ***')
+        for menu_key, callback_fn, marked_text, cache_options in checks:
+            # Books may have been evaluated out of order on worker threads
+            matched_ids = set(check_results[menu_key])
+            result_ids = [i for i in d.result_ids if i in matched_ids]
+            self.log('<b>%s</b>: %d %s <span style="color:darkgray">(marked:%s)</span>'%(
+                        cfg.PLUGIN_MENUS[menu_key]['name'], len(result_ids), _('matches'), marked_text))
+            for book_id in result_ids:
+                self.log('\t%s'%get_title_authors_text(db, book_id))
+
+        msg = _('Checked %d books, found %d matches%s') %(d.total_count, len(d.result_ids), cancelled_msg)
+        self.gui.status_bar.showMessage(msg)
+        if d.result_ids:
+            self.show_invalid_rows(d.result_ids, 'epub_check_suite')
+        sd = ResultsSummaryDialog(self.gui, _('Quality Check'),
+                                  _('%d matches found%s, see log for details')%(len(d.result_ids), cancelled_msg),
+                                  self.log)
+        sd.exec_()
 
     def search_epub(self):
         '''
@@ -207,6 +514,21 @@ class EpubCheck(BaseCheck):
             re_options |= re.IGNORECASE
         self.log('*** Searching for expression: <span style="color:blue"><b>%s</b></span> ***' % esc(self.search_opts['previous_finds'][0]))
         self.search_expression = re.compile(self.search_opts['previous_finds'][0], re_options)
+        # Characters of context either side of each match shown in the log
+        CHARS = 25
+        stream_width = get_stream_match_width(self.search_expression)
+
+        # The text index only holds the plain body text, so is used only when that is the sole scope
+        self.search_index = candidate_ids = None
+        if self.search_opts.get('use_index', False) and self.search_opts['scope_plaintext'] and \
+                not any(self.search_opts[k] for k in ['scope_css', 'scope_opf', 'scope_ncx', 'scope_zip']):
+            self.search_index = EpubTextIndex.open(self.gui.current_db)
+            if self.search_index is None:
+                self.log.warn(_('The text index is not supported by this version of SQLite, searching every ePub'))
+            else:
+                literals = required_literals(self.search_opts['previous_finds'][0], re_options)
+                if literals:
+                    candidate_ids = self.search_index.find_candidate_books(literals)
 
         def evaluate_book(book_id, db):
             path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
@@ -214,70 +536,99 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
 
+            def format_match(text, m):
+                # Get the previous and following characters
+                start = m.start()
+                end = start + len(m.group())
+                if start >= CHARS:
+                    prefix = text[start-CHARS:start]
+                else:
+                    prefix = text[0:start]
+                if end + CHARS <= len(text):
+                    suffix = text[end:end+CHARS]
+                else:
+                    suffix = text[end:len(text)]
+                prefix = RE_WHITESPACE.sub(' ', prefix)
+                suffix = RE_WHITESPACE.sub(' ', suffix)
+                return '\t<span style="color:darkgray">%s</span> <span style="color:green">...%s<span style="color:orange"><b>%s</b></span>%s...</span>'%(
+                            resource_name, esc(prefix), esc(m.group()), esc(suffix))
+
             def search_for_match(text, show_all_matches):
                 matches = []
                 text = text.replace('&nbsp;', ' ')
                 for m in self.search_expression.finditer(text):
-                    # Get the previous and following characters
-                    CHARS = 25
-                    prefix = suffix = ''
-                    start = m.start()
-                    end = start + len(m.group())
-                    if start >= CHARS:
-                        prefix = text[start-CHARS:start]
-                    else:
-                        prefix = text[0:start]
-                    if end + CHARS <= len(text):
-                        suffix = text[end:end+CHARS]
-                    else:
-                        suffix = text[end:len(text)]
-                    prefix = RE_WHITESPACE.sub(' ', prefix)
-                    suffix = RE_WHITESPACE.sub(' ', suffix)
-                    matches.append('\t<span style="color:darkgray">%s</span> <span style="color:green">...%s<span style="color:orange"><b>%s</b></span>%s...</span>'%(
-                                resource_name, esc(prefix), esc(m.group()), esc(suffix)))
+                    matches.append(format_match(text, m))
                     if not show_all_matches:
                         break
                 if matches:
                     log_lines.extend(matches)
                 return bool(matches)
 
+            def search_stream_for_match(f, show_all_matches):
+                matches = [format_match(text, m) for text, m in iter_stream_matches(f, self.search_expression,
+                                    stream_width, CHARS, stop_at_first=not show_all_matches)]
+                if matches:
+                    log_lines.extend(matches)
+                return bool(matches)
+
             try:
                 show_all_matches = self.search_opts['show_all_matches']
-                with ZipFile(path_to_book, 'r') as zf:
-                    contents = zf.namelist()
-                    log_lines = []
-                    for resource_name in contents:
-                        extension = resource_name[resource_name.rfind('.'):].lower()
-                        check_file = extract_body_text = False
-                        if extension not in NON_HTML_FILES:
-                            extract_body_text = self.search_opts['scope_plaintext']
-                            check_file = self.search_opts['scope_html'] or extract_body_text
-                        elif extension in CSS_FILES:
-                            check_file = self.search_opts['scope_css']
-                        elif extension in OPF_FILES:
-                            check_file = self.search_opts['scope_opf']
-                        elif extension in NCX_FILES:
-                            check_file = self.search_opts['scope_ncx']
-                        if check_file:
-                            content = zf.read(resource_name).decode('utf-8',errors='replace')
-                            if extract_body_text:
-                                content = self._extract_body_text(content)
-                            if search_for_match(content, show_all_matches):
-                                if not show_all_matches:
-                                    break
-                        if self.search_opts['scope_zip']:
-                            filename = os.path.basename(resource_name)
-                            if search_for_match(filename, show_all_matches):
-                                if not show_all_matches:
-                                    break
-                    if log_lines:
-                        if show_all_matches:
-                            self.log(_('Matches in book: <b>%s</b>')%get_title_authors_text(db, book_id))
-                        else:
-                            self.log(_('First match in book: <b>%s</b>')%get_title_authors_text(db, book_id))
-                        for log_line in log_lines:
-                            self.log(log_line)
-                        return True
+                log_lines = []
+                if self.search_index is not None:
+                    if self.search_index.is_current(book_id, path_to_book):
+                        # Books whose indexed text lacks the literal parts of the expression cannot match
+                        if candidate_ids is not None and book_id not in candidate_ids:
+                            return False
+                        texts = self.search_index.get_texts(book_id)
+                    else:
+                        with self._open_epub(path_to_book) as zf:
+                            texts = self._get_indexable_texts(zf)
+                        self.search_index.update_book(book_id, path_to_book, texts)
+                    for resource_name, content in texts:
+                        if search_for_match(content, show_all_matches):
+                            if not show_all_matches:
+                                break
+                else:
+                    with self._open_epub(path_to_book) as zf:
+                        contents = zf.namelist()
+                        for resource_name in contents:
+                            extension = resource_name[resource_name.rfind('.'):].lower()
+                            check_file = extract_body_text = False
+                            if extension not in NON_HTML_FILES:
+                                extract_body_text = self.search_opts['scope_plaintext']
+                                check_file = self.search_opts['scope_html'] or extract_body_text
+                            elif extension in CSS_FILES:
+                                check_file = self.search_opts['scope_css']
+                            elif extension in OPF_FILES:
+                                check_file = self.search_opts['scope_opf']
+                            elif extension in NCX_FILES:
+                                check_file = self.search_opts['scope_ncx']
+                            if check_file:
+                                if extract_body_text or stream_width is None:
+                                    content = zf.read(resource_name).decode('utf-8',errors='replace')
+                                    if extract_body_text:
+                                        content = self._extract_body_text(content)
+                                    found = search_for_match(content, show_all_matches)
+                                else:
+                                    # Raw content is decompressed and searched a block at a time
+                                    with zf.open(resource_name) as f:
+                                        found = search_stream_for_match(f, show_all_matches)
+                                if found:
+                                    if not show_all_matches:
+                                        break
+                            if self.search_opts['scope_zip']:
+                                filename = os.path.basename(resource_name)
+                                if search_for_match(filename, show_all_matches):
+                                    if not show_all_matches:
+                                        break
+                if log_lines:
+                    if show_all_matches:
+                        self.log(_('Matches in book: <b>%s</b>')%get_title_authors_text(db, book_id))
+                    else:
+                        self.log(_('First match in book: <b>%s</b>')%get_title_authors_text(db, book_id))
+                    for log_line in log_lines:
+                        self.log(log_line)
+                    return True
                 return False
 
             except InvalidEpub as e:
@@ -288,10 +639,19 @@ class EpubCheck(BaseCheck):
                 self.log(traceback.format_exc())
                 return False
 
-        self.check_all_files(evaluate_book,
-                             no_match_msg=_('No searched ePub books have your search text'),
-                             marked_text='epub_search_text',
-                             status_msg_type=_('ePub books for search text'))
+        # Cached results depend on the expression and options, not the search history
+        cache_options = dict((k, v) for k, v in self.search_opts.items() if k not in ['previous_finds', 'use_index'])
+        cache_options['expression'] = self.search_opts['previous_finds'][0]
+        try:
+            self.check_all_files(evaluate_book,
+                                 no_match_msg=_('No searched ePub books have your search text'),
+                                 marked_text='epub_search_text',
+                                 status_msg_type=_('ePub books for search text'),
+                                 cache_options=cache_options)
+        finally:
+            if self.search_index is not None:
+                self.search_index.close()
+                self.search_index = None
 
 
     def check_epub_jacket(self, check_has_jacket, check_legacy_only=False):
@@ -302,7 +662,7 @@ class EpubCheck(BaseCheck):
                 self.log.error(_('ERROR: EPUB format is missing: '), get_title_authors_text(db, book_id))
                 return not check_has_jacket
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         if 'jacket' in resource_name and resource_name.endswith('.xhtml'):
                             html = zf.read(resource_name).decode('utf-8')
@@ -343,7 +703,7 @@ class EpubCheck(BaseCheck):
                 return False
             try:
                 jacket_count = 0
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         if 'jacket' in resource_name and resource_name.endswith('.xhtml'):
                             html = self.zf_read(zf, resource_name)
@@ -391,13 +751,13 @@ class EpubCheck(BaseCheck):
                 return False
             try:
                 displayed_path = False
-                with ZipFile(path_to_book, 'r') as zf:
-                    opf_name = self._get_opf_xml(path_to_book, zf)
+                with self._open_epub(path_to_book) as zf:
+                    opf = self._get_opf_model(zf)
+                    opf_name = opf.name
                     if opf_name:
                         for mt in TEMPLATE_MIME_TYPES:
-                            xpgt_name = self._get_opf_item(zf, opf_name,
-                                    xpath=unicode_type(r'child::opf:manifest/opf:item'
-                                           '[@media-type="%s"]')%mt)
+                            xpgt_name = opf.get_item_name(unicode_type(r'child::opf:manifest/opf:item'
+                                                                       '[@media-type="%s"]')%mt)
                             if xpgt_name:
                                 if not displayed_path:
                                     displayed_path = True
@@ -445,7 +805,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     for resource_name in contents:
                         extension = resource_name[resource_name.rfind('.'):].lower()
@@ -489,10 +849,11 @@ class EpubCheck(BaseCheck):
                 return False
             try:
                 displayed_path = False
-                with ZipFile(path_to_book, 'r') as zf:
-                    opf_name = self._get_opf_xml(path_to_book, zf)
+                with self._open_epub(path_to_book) as zf:
+                    opf = self._get_opf_model(zf)
+                    opf_name = opf.name
                     if opf_name:
-                        manifest_items_map = self._get_opf_items_map(zf, opf_name)
+                        manifest_items_map = opf.items_map()
                         resource_names = list(self._manifest_worthy_names(zf))
                         for resource_name in resource_names:
                             if resource_name not in manifest_items_map:
@@ -541,7 +902,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     if self._is_drm_encrypted(zf, contents):
                         self.log.error(_('SKIPPING BOOK (DRM Encrypted): '), get_title_authors_text(db, book_id))
@@ -608,7 +969,7 @@ class EpubCheck(BaseCheck):
                 self.log.error(_('ERROR: EPUB format is missing: '), get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     if self._is_drm_encrypted(zf, contents):
                         self.log.error(_('SKIPPING BOOK (DRM Encrypted): '), get_title_authors_text(db, book_id))
@@ -678,7 +1039,7 @@ class EpubCheck(BaseCheck):
                 self.log.error(_('ERROR: EPUB format is missing: '), get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     if self._is_drm_encrypted(zf, contents):
                         self.log.error(_('SKIPPING BOOK (DRM Encrypted): '), get_title_authors_text(db, book_id))
@@ -748,7 +1109,7 @@ class EpubCheck(BaseCheck):
             try:
                 match = False
                 displayed_path = False
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     for resource_name in contents:
                         found = False
@@ -808,13 +1169,13 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return not check_has_cover
             try:
-                with ZipFile(path_to_book, 'r') as zf:
-                    opf_name = self._get_opf_xml(path_to_book, zf)
+                with self._open_epub(path_to_book) as zf:
+                    opf = self._get_opf_model(zf)
+                    opf_name = opf.name
                     if not opf_name:
                         self.log.error(_('No OPF file in:'), get_title_authors_text(db, book_id))
                         return not check_has_cover
-                    opf_xml = self._get_opf_tree(zf, opf_name)
-                    rcover = raster_cover(opf_xml)
+                    rcover = raster_cover(opf.tree)
                     if not rcover:
                         self.log(_('No supported meta tag or non-xml cover in:'), get_title_authors_text(db, book_id))
                         return not check_has_cover
@@ -857,12 +1218,12 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return not check_has_svg_cover
             try:
-                with ZipFile(path_to_book, 'r') as zf:
-                    opf_name = self._get_opf_xml(path_to_book, zf)
+                with self._open_epub(path_to_book) as zf:
+                    opf = self._get_opf_model(zf)
+                    opf_name = opf.name
                     if opf_name:
-                        cover_name = self._get_opf_item(zf, opf_name,
-                                    xpath=r'child::opf:guide/opf:reference'
-                                           '[@type="cover"and @href]')
+                        cover_name = opf.get_item_name(r'child::opf:guide/opf:reference'
+                                                        '[@type="cover"and @href]')
                         if cover_name and cover_name.endswith('.xhtml'):
                             html = self.zf_read(zf, cover_name)
                             data = self._parse_xhtml(html, cover_name)
@@ -904,12 +1265,12 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return not check_has_cover
             try:
-                with ZipFile(path_to_book, 'r') as zf:
-                    opf_name = self._get_opf_xml(path_to_book, zf)
+                with self._open_epub(path_to_book) as zf:
+                    opf = self._get_opf_model(zf)
+                    opf_name = opf.name
                     if opf_name:
-                        cover_name = self._get_opf_item(zf, opf_name,
-                                    xpath=r'child::opf:guide/opf:reference'
-                                           '[@type="cover"and @href]')
+                        cover_name = opf.get_item_name(r'child::opf:guide/opf:reference'
+                                                        '[@type="cover"and @href]')
                         if cover_name and cover_name.endswith('.xhtml'):
                             html = self.zf_read(zf, cover_name)
                             if html.find('<meta content="true" name="calibre:cover"') != -1 or \
@@ -944,8 +1305,9 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return not check_converted
             try:
-                with ZipFile(path_to_book, 'r') as zf:
-                    opf_name = self._get_opf_xml(path_to_book, zf)
+                with self._open_epub(path_to_book) as zf:
+                    opf = self._get_opf_model(zf)
+                    opf_name = opf.name
                     if opf_name:
                         opf_xml = self.zf_read(zf, opf_name)
                         if opf_xml.find('name="calibre:timestamp"') != -1 or \
@@ -980,14 +1342,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
-                    for e in zf.infolist():
-                        if e.filename.endswith('/'): #file represent a folder
-                            continue
-                        if e.file_size == 0: #file is empty (cannot be read)
-                            continue
-                        zf.read(e)
-                    return False
+                return self._get_archive_manifest(book_id, path_to_book, test_members=True).corrupt
 
             except InvalidEpub:
                 return True
@@ -1010,11 +1365,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
-                    opf_name = self._get_opf_xml(path_to_book, zf)
-                    if opf_name:
-                        return False
-                return True
+                return bool(self._get_archive_manifest(book_id, path_to_book, test_opf=True).opf_error)
 
             except InvalidEpub:
                 return True
@@ -1037,7 +1388,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     if 'META-INF/container.xml' not in contents:
                         # We have no container xml so file is completely knackered
@@ -1049,7 +1400,8 @@ class EpubCheck(BaseCheck):
                         self.log.info(path_to_book)
                         self.log.error(_('\tIncorrect container.xml namespace in'), path_to_book)
                         return True
-                    opf_name = self._get_opf_xml(path_to_book, zf)
+                    opf = self._get_opf_model(zf)
+                    opf_name = opf.name
                     if opf_name:
                         data = self.zf_read(zf, opf_name)
                         if OPF_NS not in data:
@@ -1077,11 +1429,11 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
-                    opf_name = self._get_opf_xml(path_to_book, zf)
+                with self._open_epub(path_to_book) as zf:
+                    opf = self._get_opf_model(zf)
+                    opf_name = opf.name
                     if opf_name:
-                        opf = self._get_opf_tree(zf, opf_name)
-                        metadata = opf.xpath('//opf:metadata', namespaces={'opf':OPF_NS})
+                        metadata = opf.tree.xpath('//opf:metadata', namespaces={'opf':OPF_NS})
                         if len(metadata):
                             for child in metadata[0]:
                                 try:
@@ -1118,13 +1470,13 @@ class EpubCheck(BaseCheck):
             try:
                 displayed_path = False
                 missing = False
-                with ZipFile(path_to_book, 'r') as zf:
-                    opf_name = self._get_opf_xml(path_to_book, zf)
+                with self._open_epub(path_to_book) as zf:
+                    opf = self._get_opf_model(zf)
+                    opf_name = opf.name
                     if opf_name:
-                        manifest_items_map = self._get_opf_items_map(zf, opf_name)
-                        contents = zf.namelist()
+                        manifest_items_map = opf.items_map()
                         for resource_name in manifest_items_map:
-                            if resource_name not in contents:
+                            if resource_name not in opf.names:
                                 if not displayed_path:
                                     displayed_path = True
                                     self.log(_('Manifest file missing from: <b>%s</b>')%get_title_authors_text(db, book_id))
@@ -1154,22 +1506,22 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     if self._is_drm_encrypted(zf, contents):
                         self.log.error('SKIPPING BOOK (DRM Encrypted): ', get_title_authors_text(db, book_id))
                         return False
-                    for name in self._manifest_worthy_names(zf):
-                        if name.endswith('.ncx'):
-                            try:
-                                ncx = self._parse_xml(self.zf_read(zf, name))
-                                nested = ncx.xpath(r'descendant::ncx:navPoint/ncx:navPoint',
-                                                   namespaces={'ncx':NCX_NS})
-                                if len(nested) > 0:
-                                    return True
-                            except UnicodeDecodeError:
-                                self.log.error(_('Ignoring DRM protected ePub: '), path_to_book)
-                                return False
+                    opf = self._get_opf_model(zf)
+                    for name in opf.ncx_names:
+                        try:
+                            ncx = opf.get_ncx_tree(name)
+                            nested = ncx.xpath(r'descendant::ncx:navPoint/ncx:navPoint',
+                                               namespaces={'ncx':NCX_NS})
+                            if len(nested) > 0:
+                                return True
+                        except UnicodeDecodeError:
+                            self.log.error(_('Ignoring DRM protected ePub: '), path_to_book)
+                            return False
                 return False
 
             except InvalidEpub as e:
@@ -1195,20 +1547,19 @@ class EpubCheck(BaseCheck):
                 return False
             try:
                 count = None
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     if self._is_drm_encrypted(zf, contents):
                         self.log.error('SKIPPING BOOK (DRM Encrypted): ', get_title_authors_text(db, book_id))
                         return False
-                    for name in self._manifest_worthy_names(zf):
-                        if name.endswith('.ncx'):
-                            try:
-                                ncx_xml = self.zf_read(zf, name)
-                                count = len(ncx_xml.split('<navLabel>')) - 1
-                                break
-                            except UnicodeDecodeError:
-                                self.log.error(_('Ignoring DRM protected ePub: '), path_to_book)
-                                return True
+                    for name in self._get_opf_model(zf).ncx_names:
+                        try:
+                            ncx_xml = self.zf_read(zf, name)
+                            count = len(ncx_xml.split('<navLabel>')) - 1
+                            break
+                        except UnicodeDecodeError:
+                            self.log.error(_('Ignoring DRM protected ePub: '), path_to_book)
+                            return True
                 if count >= 3:
                     return False
                 self.log(get_title_authors_text(db, book_id))
@@ -1241,7 +1592,7 @@ class EpubCheck(BaseCheck):
                 return False
             try:
                 broken_links = []
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     if self._is_drm_encrypted(zf, contents):
                         self.log.error('SKIPPING BOOK (DRM Encrypted): ', get_title_authors_text(db, book_id))
@@ -1249,25 +1600,25 @@ class EpubCheck(BaseCheck):
                     manifest_names = list(self._manifest_worthy_names(zf))
                     html_names_map = dict((os.path.normpath(six.moves.urllib.request.url2pathname(k)),True) for k in manifest_names
                                           if k[k.rfind('.'):].lower() not in NON_HTML_FILES)
-                    for name in manifest_names:
-                        if name.endswith('.ncx'):
-                            ncx_dir = os.path.dirname(name)
-                            if ncx_dir:
-                                ncx_dir += '/'
-                            try:
-                                ncx = self._parse_xml(self.zf_read(zf, name))
-                                src_nodes = ncx.xpath(r'descendant::ncx:content/@src',
-                                                   namespaces={'ncx':NCX_NS})
-                                for src_node in src_nodes:
-                                    link = src_node.partition('#')[0]
-                                    link_path = os.path.normpath(six.moves.urllib.request.url2pathname(ncx_dir + link))
-                                    #self.log.info('\tLooking for:', link_path)
-                                    if link_path not in html_names_map:
-                                        broken_links.append(link)
-                                break
-                            except UnicodeDecodeError:
-                                self.log.error('Ignoring DRM protected ePub: ', path_to_book)
-                                return True
+                    opf = self._get_opf_model(zf)
+                    for name in opf.ncx_names:
+                        ncx_dir = os.path.dirname(name)
+                        if ncx_dir:
+                            ncx_dir += '/'
+                        try:
+                            ncx = opf.get_ncx_tree(name)
+                            src_nodes = ncx.xpath(r'descendant::ncx:content/@src',
+                                               namespaces={'ncx':NCX_NS})
+                            for src_node in src_nodes:
+                                link = src_node.partition('#')[0]
+                                link_path = os.path.normpath(six.moves.urllib.request.url2pathname(ncx_dir + link))
+                                #self.log.info('\tLooking for:', link_path)
+                                if link_path not in html_names_map:
+                                    broken_links.append(link)
+                            break
+                        except UnicodeDecodeError:
+                            self.log.error('Ignoring DRM protected ePub: ', path_to_book)
+                            return True
                 if broken_links:
                     self.log(get_title_authors_text(db, book_id))
                     for broken_link in broken_links:
@@ -1298,16 +1649,14 @@ class EpubCheck(BaseCheck):
                 return False
             try:
                 broken_links = []
-                with ZipFile(path_to_book, 'r') as zf:
-                    opf_name = self._get_opf_xml(path_to_book, zf)
+                with self._open_epub(path_to_book) as zf:
+                    opf = self._get_opf_model(zf)
+                    opf_name = opf.name
                     if opf_name:
-                        manifest_items_map = self._get_opf_items_map(zf, opf_name, rebase_href=False)
+                        manifest_items_map = opf.items_map(rebase_href=False)
                         #self.log('Items map:', manifest_items_map)
-                        opf_xml = self._get_opf_tree(zf, opf_name)
-                        guide_refs = opf_xml.xpath(r'child::opf:guide/opf:reference[@href]',
-                                               namespaces={'opf':OPF_NS})
-                        if len(guide_refs):
-                            for guide_ref in guide_refs:
+                        if len(opf.guide_refs):
+                            for guide_ref in opf.guide_refs:
                                 href = guide_ref.get('href', None)
                                 if href:
                                     link = href.partition('#')[0]
@@ -1343,17 +1692,16 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
-                    contents = zf.infolist()
-                    for resource in contents:
-                        if resource.file_size > MAX_SIZE:
-                            # Is this an HTML file?
-                            ext = os.path.splitext(resource.filename.lower())[1]
-                            if ext in ['.htm', '.html', '.xhtml']:
-                                self.log.info(path_to_book)
-                                self.log('\t<span style="color:orange">Oversize file: %s of %d bytes</span>'% \
-                                               (resource.filename, resource.file_size))
-                                return True
+                contents = self._get_archive_manifest(book_id, path_to_book).infolist()
+                for resource in contents:
+                    if resource.file_size > MAX_SIZE:
+                        # Is this an HTML file?
+                        ext = os.path.splitext(resource.filename.lower())[1]
+                        if ext in ['.htm', '.html', '.xhtml']:
+                            self.log.info(path_to_book)
+                            self.log('\t<span style="color:orange">Oversize file: %s of %d bytes</span>'% \
+                                           (resource.filename, resource.file_size))
+                            return True
                 return False
 
             except InvalidEpub as e:
@@ -1378,7 +1726,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     return self._is_drm_encrypted(zf, contents)
                 return False
@@ -1406,7 +1754,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         extension = resource_name[resource_name.rfind('.'):].lower()
                         if extension in NON_HTML_FILES:
@@ -1440,7 +1788,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         extension = resource_name[resource_name.rfind('.'):].lower()
                         if extension in NON_HTML_FILES:
@@ -1475,15 +1823,15 @@ class EpubCheck(BaseCheck):
             try:
                 found = False
                 displayed_path = False
-                with ZipFile(path_to_book, 'r') as zf:
-                    for resource_name in self._manifest_worthy_names(zf):
-                        extension = resource_name[resource_name.rfind('.'):].lower()
-                        if extension in FONT_FILES:
-                            if not displayed_path:
-                                displayed_path = True
-                                self.log(_('Font found in: <b>%s</b>')%get_title_authors_text(db, book_id))
-                            self.log('\t<span style="color:darkgray">%s</span>'%resource_name)
-                            found = True
+                manifest = self._get_archive_manifest(book_id, path_to_book)
+                for resource_name in self._manifest_worthy_names(manifest):
+                    extension = resource_name[resource_name.rfind('.'):].lower()
+                    if extension in FONT_FILES:
+                        if not displayed_path:
+                            displayed_path = True
+                            self.log(_('Font found in: <b>%s</b>')%get_title_authors_text(db, book_id))
+                        self.log('\t<span style="color:darkgray">%s</span>'%resource_name)
+                        found = True
                 return found
 
             except InvalidEpub as e:
@@ -1501,7 +1849,6 @@ class EpubCheck(BaseCheck):
 
 
     def check_epub_font_faces(self):
-        RE_FONT_FACE = re.compile(r'@font\-face', re.UNICODE)
 
         def evaluate_book(book_id, db):
             path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
@@ -1509,21 +1856,15 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
-                    for resource_name in self._manifest_worthy_names(zf):
-                        extension = resource_name[resource_name.rfind('.'):].lower()
-                        if extension in CSS_FILES:
-                            css = self.zf_read(zf, resource_name).lower()
-                            if RE_FONT_FACE.search(css):
+                with self._open_epub(path_to_book) as zf:
+                    for resource in self._get_css_summary(zf).resources():
+                        if resource.has_font_face:
+                            if resource.is_css:
                                 self.log(_('CSS file contains @font-face: <b>%s</b>')%get_title_authors_text(db, book_id))
-                                self.log('\t<span style="color:darkgray">%s</span>'%resource_name)
-                                return True
-                        elif extension not in NON_HTML_FILES:
-                            data = self.zf_read(zf, resource_name).lower()
-                            if RE_FONT_FACE.search(data):
+                            else:
                                 self.log(_('At least one html file contains @font-face: <b>%s</b>')%get_title_authors_text(db, book_id))
-                                self.log('\t<span style="color:darkgray">%s</span>'%resource_name)
-                                return True
+                            self.log('\t<span style="color:darkgray">%s</span>'%resource.name)
+                            return True
                 return False
 
             except InvalidEpub as e:
@@ -1541,7 +1882,6 @@ class EpubCheck(BaseCheck):
 
 
     def check_epub_css_justify(self):
-        RE_TEXT_ALIGN = re.compile(r'text\-align:\s*justify', re.UNICODE)
 
         def evaluate_book(book_id, db):
             path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
@@ -1549,12 +1889,10 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
-                    for resource_name in self._manifest_worthy_names(zf):
-                        if resource_name.lower().endswith('css'):
-                            css = self.zf_read(zf, resource_name).lower()
-                            if RE_TEXT_ALIGN.search(css):
-                                return False
+                with self._open_epub(path_to_book) as zf:
+                    for resource in self._get_css_summary(zf).stylesheets():
+                        if resource.has_justify:
+                            return False
                 return True
 
             except InvalidEpub as e:
@@ -1572,17 +1910,15 @@ class EpubCheck(BaseCheck):
 
 
     def check_epub_css_margins(self):
-        RE_BOOK_MGNS = re.compile(r'(#\w+\s+)?(?P<selector>(?<!\.)\bbody|@page)\b\s*{(?P<styles>[^}]*margin[^}]+);?\s*\}', re.UNICODE)
 
-        def match_margins(data, allow_less=False):
-            self.user_margins = get_user_margins()
+        def match_margins(rules, allow_less=False):
             doc_defined_margins = {}
 
-            for match in RE_BOOK_MGNS.finditer(data):
-                styles = match.group('styles').lower().strip()
+            for rule in rules:
+                styles = rule.styles.strip()
                 # delete trailing semicolons
                 styles = re.sub(r'\s*;$', '', styles)
-                if match.group('selector').lower() == 'body' and styles.find('margin') != -1:
+                if rule.selector == 'body' and styles.find('margin') != -1:
                     self.log('\t\tMargins are defined in a body tag')
                     return True
 
@@ -1611,7 +1947,7 @@ class EpubCheck(BaseCheck):
 
             # If we got to here, then we found "some" margins in the style that are
             # either identical or a subset of our preferred margins
-            for pref, pref_value in self.user_margins.items():
+            for pref, pref_value in user_margins.items():
                 if pref_value < 0.0:  # The user does not want this margin defined
                     if pref in doc_defined_margins:  # Currently is defined, so remove it
                         self.log(_('\t\tMargins are defined in pts but don\'t match calibre preferences'))
@@ -1645,50 +1981,47 @@ class EpubCheck(BaseCheck):
                 prefs_margins = calibre_default_margins
             return prefs_margins
 
+        user_margins = get_user_margins()
+
         def evaluate_book(book_id, db):
-            self.path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
-            if not self.path_to_book:
+            path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
+            if not path_to_book:
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(self.path_to_book, 'r') as zf:
-                    self.log(_('\tAnalyzing margins in ')+self.path_to_book)
-                    contents = list(self._manifest_worthy_names(zf))
+                with self._open_epub(path_to_book) as zf:
+                    self.log(_('\tAnalyzing margins in ')+path_to_book)
+                    css_summary = self._get_css_summary(zf)
                     # Check the CSS files for @page and body declarations
-                    for resource_name in contents:
-                        if resource_name.lower().endswith('css'):
-                            css = self.zf_read(zf, resource_name).lower()
-                            if RE_BOOK_MGNS.search(css):
-                                return match_margins(css)
+                    for resource in css_summary.stylesheets():
+                        rules = resource.margin_rules(include_dotted=False)
+                        if rules:
+                            return match_margins(rules)
                     # Check the xhtml files for inline @page and body declarations
-                    for resource_name in contents:
-                        extension = resource_name[resource_name.rfind('.'):].lower()
-                        if extension in NON_HTML_FILES:
-                            continue
-                        elif resource_name.endswith('titlepage.xhtml'):
+                    for resource in css_summary.resources(css=False):
+                        if resource.name.endswith('titlepage.xhtml'):
                             continue
-                        else:
-                            data = self.zf_read(zf, resource_name).lower()
-                            if RE_BOOK_MGNS.search(data[:1000]):
-                                if match_margins(data[:1000], True):
-                                    return True
+                        rules = resource.margin_rules(include_dotted=False)
+                        if rules:
+                            if match_margins(rules, True):
+                                return True
 
             except InvalidEpub as e:
                 self.log.error('Invalid epub:', e)
                 return False
             except:
-                self.log.error('ERROR parsing book: ', self.path_to_book)
+                self.log.error('ERROR parsing book: ', path_to_book)
                 self.log(traceback.format_exc())
                 return False
 
         self.check_all_files(evaluate_book,
                              no_match_msg=_('All searched ePub books match the calibre page setup preferences'),
                              marked_text='epub_css_margins',
-                             status_msg_type=_('ePub books for body or @page css margins'))
+                             status_msg_type=_('ePub books for body or @page css margins'),
+                             cache_options=user_margins)
 
 
     def check_epub_css_no_margins(self):
-        RE_BOOK_MGNS = re.compile(r'(#\w+\s+)?(?P<selector>\bbody|@page)\b\s*{(?P<styles>[^}]+margin[^}]+);?\s*\}', re.UNICODE)
 
         def evaluate_book(book_id, db):
             path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
@@ -1696,21 +2029,14 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
-                    contents = list(self._manifest_worthy_names(zf))
-                    for resource_name in contents:
-                        if resource_name.lower().endswith('css'):
-                            css = self.zf_read(zf, resource_name).lower()
-                            if RE_BOOK_MGNS.search(css):
-                                return False
-                    for resource_name in contents:
-                        extension = resource_name[resource_name.rfind('.'):].lower()
-                        if extension in NON_HTML_FILES:
-                            continue
-                        else:
-                            data = self.zf_read(zf, resource_name).lower()
-                            if RE_BOOK_MGNS.search(data[:1000]):
-                                return False
+                with self._open_epub(path_to_book) as zf:
+                    css_summary = self._get_css_summary(zf)
+                    for resource in css_summary.stylesheets():
+                        if resource.margin_rules(min_before=1):
+                            return False
+                    for resource in css_summary.resources(css=False):
+                        if resource.margin_rules(min_before=1):
+                            return False
                     return True
 
             except InvalidEpub as e:
@@ -1728,7 +2054,6 @@ class EpubCheck(BaseCheck):
 
 
     def check_epub_inline_margins(self):
-        RE_BOOK_MGNS = re.compile(r'(#\w+\s+)?(?P<selector>\bbody|@page)\b\s*{(?P<styles>[^}]+margin[^}]+);?\s*\}', re.UNICODE)
 
         def evaluate_book(book_id, db):
             path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
@@ -1736,19 +2061,14 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
-                    for resource_name in self._manifest_worthy_names(zf):
-                        extension = resource_name[resource_name.rfind('.'):].lower()
-                        if extension in NON_HTML_FILES:
+                with self._open_epub(path_to_book) as zf:
+                    for resource in self._get_css_summary(zf).resources(css=False):
+                        if resource.name.lower().find('title') != -1:
                             continue
-                        elif resource_name.lower().find('title') != -1:
+                        elif resource.name.lower().find('cover') != -1:
                             continue
-                        elif resource_name.lower().find('cover') != -1:
-                            continue
-                        else:
-                            data = self.zf_read(zf, resource_name).lower()
-                            if RE_BOOK_MGNS.search(data[:1000]):
-                                return True
+                        elif resource.margin_rules(min_before=1):
+                            return True
                     return False
 
             except InvalidEpub as e:
@@ -1774,7 +2094,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     if self._is_drm_encrypted(zf, contents):
                         self.log.error('SKIPPING BOOK (DRM Encrypted): ', get_title_authors_text(db, book_id))
@@ -1819,15 +2139,15 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     if self._is_drm_encrypted(zf, contents):
                         self.log.error('SKIPPING BOOK (DRM Encrypted): ', get_title_authors_text(db, book_id))
                         return False
-                    opf_name = self._get_opf_xml(path_to_book, zf)
+                    opf = self._get_opf_model(zf)
+                    opf_name = opf.name
                     if opf_name:
-                        manifest_items_map = self._get_opf_items_map(zf, opf_name, spine_only=True)
-                        contents = zf.namelist()
+                        manifest_items_map = opf.items_map(spine_only=True)
                         for resource_name in manifest_items_map:
                             extension = resource_name[resource_name.rfind('.'):].lower()
                             if extension in NON_HTML_FILES:
@@ -1861,7 +2181,10 @@ class EpubCheck(BaseCheck):
     #
     # -----------------------------------------------------------
 
-    def _get_opf_xml(self, path_to_book, zf):
+    def _get_opf_model(self, zf):
+        return zf.memo('opf_model', lambda: OpfModel(self, zf))
+
+    def _read_opf_name(self, path_to_book, zf):
         contents = zf.namelist()
         if 'META-INF/container.xml' not in contents:
             raise InvalidEpub('Missing container.xml from:%s'%path_to_book)
@@ -1876,41 +2199,7 @@ class EpubCheck(BaseCheck):
             raise InvalidEpub(_('OPF file in container.xml not found in:%s')%path_to_book)
         return opf_name
 
-    def _get_opf_item(self, zf, opf_name, xpath, opf_xml=None):
-        if not opf_xml:
-            opf_xml = self._get_opf_tree(zf, opf_name)
-        items = opf_xml.xpath(xpath, namespaces={'opf':OPF_NS})
-        if len(items):
-            opf_dir = posixpath.dirname(opf_name)
-            item_name = self._href_to_name(items[0].attrib['href'], opf_dir)
-            if item_name in zf.namelist():
-                return item_name
-
-    def _get_opf_items_map(self, zf, opf_name, opf_xml=None, rebase_href=True, spine_only=False):
-        if not opf_xml:
-            opf_xml = self._get_opf_tree(zf, opf_name)
-        items = opf_xml.xpath(r'child::opf:manifest/opf:item[@href]',
-                              namespaces={'opf':OPF_NS})
-        spine_items = []
-        if spine_only:
-            spine_items = opf_xml.xpath(r'child::opf:spine/opf:itemref/@idref',
-                              namespaces={'opf':OPF_NS})
-
-        items_map = {}
-        opf_dir = posixpath.dirname(opf_name)
-        for item in items:
-            if spine_only:
-                id = item.attrib['id']
-                if not id in spine_items:
-                    continue
-            if rebase_href:
-                item_name = self._href_to_name(item.attrib['href'], opf_dir)
-            else:
-                item_name = item.attrib['href']
-            items_map[item_name] = item
-        return items_map
-
-    def _get_opf_tree(self, zf, opf_name):
+    def _parse_opf_tree(self, zf, opf_name):
         data = zf.read(opf_name)
         data = data.decode('utf-8')
         data = re.sub(r'http://openebook.org/namespaces/oeb-package/1.0/',
@@ -1929,6 +2218,92 @@ class EpubCheck(BaseCheck):
         name = os.path.normpath(name).replace('\\', '/')
         return name
 
+    def _get_archive_manifest(self, book_id, path_to_book, test_members=False, test_opf=False):
+        '''
+        Return the ArchiveManifest of this ePub, from the cache if the size and
+        mtime of the file are unchanged, otherwise read from the zip and cached.
+        Testing every member for corruption needs the whole zip decompressed,
+        and locating the OPF needs container.xml read, so each is only done
+        when a check asks for it.
+        '''
+        st = os.stat(path_to_book)
+        data = self._get_cached_archive_manifests().get(book_id)
+        if data is not None and (data['size'], data['mtime']) != (st.st_size, st.st_mtime):
+            data = None
+        if data is None or (test_members and data['corrupt'] is None) or \
+                (test_opf and data['opf_error'] is None):
+            data = self._read_archive_manifest(path_to_book, st, test_members, test_opf, data)
+            self.new_archive_manifests[book_id] = data
+        return ArchiveManifest(data)
+
+    def _read_archive_manifest(self, path_to_book, st, test_members, test_opf, data=None):
+        if data is None:
+            data = {'size': st.st_size, 'mtime': st.st_mtime, 'entries': None,
+                    'zip_error': None, 'opf_error': None, 'corrupt': None}
+        else:
+            data = dict(data)
+        try:
+            with self._open_epub(path_to_book) as zf:
+                if data['entries'] is None:
+                    data['entries'] = [[i.filename, i.file_size, i.compress_size, i.CRC, bool(i.flag_bits & 0x1)]
+                                       for i in zf.infolist()]
+                if test_members:
+                    data['corrupt'] = self._has_corrupt_member(zf)
+        except BadZipfile as e:
+            data['zip_error'] = unicode(e) or _('Bad zip file')
+            data['corrupt'] = True
+        if test_opf and not data['zip_error']:
+            data['opf_error'] = self._read_opf_error(path_to_book)
+        return data
+
+    def _read_opf_error(self, path_to_book):
+        '''
+        Return why container.xml does not locate the OPF, or '' if it does. Any
+        other error reading container.xml, such as a member failing its CRC, is
+        raised for the check to report rather than cached as a zip error.
+        '''
+        try:
+            with self._open_epub(path_to_book) as zf:
+                self._get_opf_model(zf).name
+        except InvalidEpub as e:
+            return unicode(e)
+        return ''
+
+    def _has_corrupt_member(self, zf):
+        try:
+            for e in zf.infolist():
+                if e.filename.endswith('/'): #file represent a folder
+                    continue
+                if e.file_size == 0: #file is empty (cannot be read)
+                    continue
+                zf.read(e)
+            return False
+        except:
+            return True
+
+    def _get_cached_archive_manifests(self):
+        with self.manifest_lock:
+            if self.archive_manifests is None:
+                self.archive_manifests = {}
+                if self._is_result_cache_enabled() and not self.force_rescan:
+                    self.archive_manifests = self.gui.current_db.new_api.get_custom_book_data(
+                                                cfg.ARCHIVE_MANIFEST_KEY, self.book_ids, default=None)
+            return self.archive_manifests
+
+    def _save_archive_manifests(self):
+        if self.new_archive_manifests and self._is_result_cache_enabled():
+            self.gui.current_db.new_api.add_custom_book_data(cfg.ARCHIVE_MANIFEST_KEY, self.new_archive_manifests)
+        self.archive_manifests = None
+        self.new_archive_manifests = {}
+
+    def _is_result_cache_enabled(self):
+        return cfg.plugin_prefs[cfg.STORE_OPTIONS].get(cfg.KEY_CACHE_RESULTS, True)
+
+    def _get_css_summary(self, zf):
+        return zf.memo('css_summary', lambda: BookCssSummary(list(self._manifest_worthy_names(zf)),
+                                                             lambda name: self.zf_read(zf, name),
+                                                             CSS_FILES, NON_HTML_FILES))
+
     def _manifest_worthy_names(self, zf, suppress_apple_fonts=True):
         for name in zf.namelist():
             if name == 'mimetype': continue
@@ -1941,6 +2316,9 @@ class EpubCheck(BaseCheck):
             yield name
 
     def _is_drm_encrypted(self, zf, contents):
+        return zf.memo('drm_encrypted', lambda: self._read_is_drm_encrypted(zf, contents))
+
+    def _read_is_drm_encrypted(self, zf, contents):
         for resource_name in contents:
             if resource_name.lower().endswith('encryption.xml'):
                 root = self._parse_xml(self.zf_read(zf, resource_name))
@@ -1969,6 +2347,19 @@ class EpubCheck(BaseCheck):
             return RE_STRIP_MARKUP.sub('', body[0])
         return ''
 
+    def _get_indexable_texts(self, zf):
+        '''
+        Get a list of (resource_name, body text) for the html content of this epub,
+        as searched by a plain text search
+        '''
+        texts = []
+        for resource_name in zf.namelist():
+            extension = resource_name[resource_name.rfind('.'):].lower()
+            if extension not in NON_HTML_FILES:
+                content = zf.read(resource_name).decode('utf-8',errors='replace')
+                texts.append((resource_name, self._extract_body_text(content).replace('&nbsp;', ' ')))
+        return texts
+
     def _parse_xml(self, data):
         data = xml_to_unicode(data, strip_encoding_pats=True, assume_utf8=True,
                              resolve_entities=True)[0].strip()
@@ -2033,15 +2424,15 @@ class EpubCheck(BaseCheck):
             try:
                 found = False
                 displayed_path = False
-                with ZipFile(path_to_book, 'r') as zf:
-                    for resource_name in self._manifest_worthy_names(zf):
-                        extension = resource_name[resource_name.rfind('.'):].lower()
-                        if extension in EPUB_FILES:
-                            if not displayed_path:
-                                displayed_path = True
-                                self.log('ePub found in: <b>%s</b>'%get_title_authors_text(db, book_id))
-                            self.log('\t<span style="color:darkgray">%s</span>'%resource_name)
-                            found = True
+                manifest = self._get_archive_manifest(book_id, path_to_book)
+                for resource_name in self._manifest_worthy_names(manifest):
+                    extension = resource_name[resource_name.rfind('.'):].lower()
+                    if extension in EPUB_FILES:
+                        if not displayed_path:
+                            displayed_path = True
+                            self.log('ePub found in: <b>%s</b>'%get_title_authors_text(db, book_id))
+                        self.log('\t<span style="color:darkgray">%s</span>'%resource_name)
+                        found = True
                 return found
 
             except InvalidEpub as e:
@@ -71,93 +71,69 @@ class MetadataCheck(BaseCheck):
 
     def check_title_sort_valid(self):
 
-        def book_lang(self):
-            try:
-                book_lang = self.languages_edit.lang_codes[0]
-            except:
-                book_lang = None
-            return book_lang
-
-        def evaluate_book(book_id, db):
-            current_title_sort = db.title_sort(book_id, index_is_id=True)
-            current_languages = db.languages(book_id, index_is_id=True)
+        def evaluate_book(book_id, title, current_title_sort, languages):
             book_lang = None
-            if current_languages:
-                book_lang = current_languages.split(',')[0]
-            title = db.title(book_id, index_is_id=True)
+            if languages:
+                book_lang = languages[0]
             if current_title_sort != title_sort(title, lang=book_lang):
                 return True
             return False
 
-        self.check_all_files(evaluate_book,
-                             no_match_msg=_('All searched books have a valid Title Sort'),
-                             marked_text='invalid_title_sort',
-                             status_msg_type=_('books for invalid title sort'))
+        self.check_all_metadata(['title', 'sort', 'languages'], evaluate_book,
+                                no_match_msg=_('All searched books have a valid Title Sort'),
+                                marked_text='invalid_title_sort')
 
 
     def check_author_sort_valid(self):
+        author_sort_from_authors = self.gui.current_db.new_api.author_sort_from_authors
 
-        def evaluate_book(book_id, db):
-            current_author_sort = db.author_sort(book_id, index_is_id=True)
-            authors = db.authors(book_id, index_is_id=True)
+        def evaluate_book(book_id, authors, current_author_sort):
             if not authors:
                 return True
-            authors = [a.strip().replace('|', ',') for a in authors.split(',')]
-            if current_author_sort != db.author_sort_from_authors(authors):
+            if current_author_sort != author_sort_from_authors(authors):
                 return True
             return False
 
-        self.check_all_files(evaluate_book,
-                             no_match_msg=_('All searched books have a valid Author Sort'),
-                             marked_text='invalid_author_sort',
-                             status_msg_type=_('books for invalid author sort'))
+        self.check_all_metadata(['authors', 'author_sort'], evaluate_book,
+                                no_match_msg=_('All searched books have a valid Author Sort'),
+                                marked_text='invalid_author_sort')
 
 
     def check_isbn_valid(self):
 
-        def evaluate_book(book_id, db):
-            isbn = db.isbn(book_id, index_is_id=True)
+        def evaluate_book(book_id, identifiers):
+            isbn = (identifiers or {}).get('isbn')
             if isbn:
                 if not check_isbn(isbn):
                     return True
             return False
 
-        self.check_all_files(evaluate_book,
-                             no_match_msg=_('All searched books have a valid ISBN'),
-                             marked_text='invalid_isbn',
-                             status_msg_type=_('books for invalid ISBN'))
+        self.check_all_metadata(['identifiers'], evaluate_book,
+                                no_match_msg=_('All searched books have a valid ISBN'),
+                                marked_text='invalid_isbn')
 
 
     def check_pubdate_valid(self):
 
-        def evaluate_book(book_id, db):
-            pubdate = db.pubdate(book_id, index_is_id=True)
-            timestamp = db.timestamp(book_id, index_is_id=True)
+        def evaluate_book(book_id, pubdate, timestamp):
             if pubdate == timestamp:
                 return True
             return False
 
-        self.check_all_files(evaluate_book,
-                             no_match_msg=_('All searched books have a valid pubdate'),
-                             marked_text='invalid_pubdate',
-                             status_msg_type=_('books for invalid pubdate'))
+        self.check_all_metadata(['pubdate', 'timestamp'], evaluate_book,
+                                no_match_msg=_('All searched books have a valid pubdate'),
+                                marked_text='invalid_pubdate')
 
 
     def check_duplicate_isbn(self):
 
-        books_by_isbn = {}
-
-        def evaluate_book(book_id, db):
-            isbn = db.isbn(book_id, index_is_id=True)
+        book_ids, (identifiers_map,) = self.get_metadata_columns(['identifiers'])
+        books_by_isbn = defaultdict(set)
+        for book_id, identifiers in identifiers_map.items():
+            isbn = (identifiers or {}).get('isbn')
             if isbn:
-                if isbn not in books_by_isbn:
-                    books_by_isbn[isbn] = set()
                 books_by_isbn[isbn].add(book_id)
-            # We will determine the match as a post step, not in this function
-            return False
 
-        total_count, _result_ids, cancelled_msg = self.check_all_files(evaluate_book, show_matches=False,
-                                                                  status_msg_type=_('books for duplicate ISBN'))
         result_ids = list()
         for values in books_by_isbn.values():
             if len(values) > 1:
@@ -166,30 +142,22 @@ class MetadataCheck(BaseCheck):
         if len(result_ids) > 0:
             self.show_invalid_rows(result_ids, 'duplicate_isbn')
 
-        msg = 'Checked %d books, found %d matches' %(total_count, len(result_ids))
+        msg = 'Checked %d books, found %d matches' %(len(book_ids), len(result_ids))
         self.gui.status_bar.showMessage(msg)
         if len(result_ids) == 0:
-            info_dialog(self.gui, _('No Matches%s')%cancelled_msg,
+            info_dialog(self.gui, _('No Matches'),
                                _('All searched books have unique ISBNs'), show=True)
 
 
     def check_duplicate_series(self):
 
-        books_by_series = {}
-
-        def evaluate_book(book_id, db):
-            series = db.series(book_id, index_is_id=True)
+        book_ids, (series_map, series_index_map) = self.get_metadata_columns(['series', 'series_index'])
+        books_by_series = defaultdict(set)
+        for book_id, series in series_map.items():
             if series:
-                series_index = db.series_index(book_id, index_is_id=True)
-                _hash = '%s%0.4f'%(series, series_index)
-                if _hash not in books_by_series:
-                    books_by_series[_hash] = set()
+                _hash = '%s%0.4f'%(series, series_index_map.get(book_id) or 0)
                 books_by_series[_hash].add(book_id)
-            # We will determine the match as a post step, not in this function
-            return False
 
-        total_count, _result_ids, cancelled_msg = self.check_all_files(evaluate_book, show_matches=False,
-                                                                  status_msg_type=_('books for duplicate series'))
         result_ids = list()
         for values in books_by_series.values():
             if len(values) > 1:
@@ -199,10 +167,10 @@ class MetadataCheck(BaseCheck):
             self.show_invalid_rows(result_ids, 'duplicate_series')
             self.gui.library_view.sort_by_named_field('series', True)
 
-        msg = 'Checked %d books, found %d matches' %(total_count, len(result_ids))
+        msg = 'Checked %d books, found %d matches' %(len(book_ids), len(result_ids))
         self.gui.status_bar.showMessage(msg)
         if len(result_ids) == 0:
-            info_dialog(self.gui, _('No Matches%s')%cancelled_msg,
+            info_dialog(self.gui, _('No Matches'),
                                _('All searched books have unique series indexes'), show=True)
 
 
@@ -211,18 +179,17 @@ class MetadataCheck(BaseCheck):
         series_name_book_map = defaultdict(list)
         series_name_indexes_map = defaultdict(list)
 
-        def evaluate_book(book_id, db):
-            series = db.series(book_id, index_is_id=True)
+        book_ids, (series_map, series_index_map, authors_map) = \
+                        self.get_metadata_columns(['series', 'series_index', 'authors'])
+        for book_id in book_ids:
+            series = series_map.get(book_id)
             if series:
-                series_index = db.series_index(book_id, index_is_id=True)
+                series_index = series_index_map.get(book_id)
                 series_name_book_map[series].append(book_id)
                 if round(series_index) == series_index and series_index > 0:
                     series_name_indexes_map[series].append(int(series_index))
-            # We will determine the match as a post step, not in this function
-            return False
+        total_count, cancelled_msg = len(book_ids), ''
 
-        total_count, _result_ids, cancelled_msg = self.check_all_files(evaluate_book, show_matches=False,
-                                                                  status_msg_type='books for series gaps')
         result_ids = list()
         series_gap_count = book_gap_count = 0
         for series_name in sorted(list(series_name_indexes_map.keys()), key=lambda s: s.lower()):
@@ -231,9 +198,8 @@ class MetadataCheck(BaseCheck):
             max_value = max(series_indexes)
 
             book_id = series_name_book_map[series_name][0]
-            authors = self.gui.current_db.authors(book_id, index_is_id=True)
+            authors = authors_map.get(book_id)
             if authors:
-                authors = [x.replace('|', ',') for x in authors.split(',')]
                 header_text = 'Series: <b>%s</b> - Author: <b>%s</b> - Last: #%d' % (series_name, authors_to_string(authors), max_value)
             else:
                 header_text = 'Series: <b>%s</b> - Last: #%d'%(series_name, max_value)
@@ -277,21 +243,19 @@ class MetadataCheck(BaseCheck):
         series_name_book_map = defaultdict(list)
         series_name_indexes_map = defaultdict(list)
 
-        def evaluate_book(book_id, db):
-            series = db.series(book_id, index_is_id=True)
+        book_ids, (series_map, series_index_map, pubdate_map, authors_map) = \
+                        self.get_metadata_columns(['series', 'series_index', 'pubdate', 'authors'])
+        for book_id in book_ids:
+            series = series_map.get(book_id)
             if series:
-                series_index = db.series_index(book_id, index_is_id=True)
+                series_index = series_index_map.get(book_id)
                 series_name_book_map[series].append(book_id)
                 # Ignore books with series index < 1 - will assume they are anthologies or unrelated books
                 if series_index >= 1:
                     # Add a tuple of the series index and the pubdate
-                    pubdate = db.pubdate(book_id, index_is_id=True)
-                    series_name_indexes_map[series].append( (series_index, pubdate) )
-            # We will determine the match as a post step, not in this function
-            return False
+                    series_name_indexes_map[series].append( (series_index, pubdate_map.get(book_id)) )
+        total_count, cancelled_msg = len(book_ids), ''
 
-        total_count, _result_ids, cancelled_msg = self.check_all_files(evaluate_book, show_matches=False,
-                                                                  status_msg_type=_('books for series pubdate order'))
         result_ids = list()
         series_disorder_count = book_disorder_count = 0
         for series_name in sorted(series_name_indexes_map.keys()):
@@ -299,9 +263,8 @@ class MetadataCheck(BaseCheck):
             series_index_dates = sorted(series_name_indexes_map[series_name])
 
             book_id = series_name_book_map[series_name][0]
-            authors = self.gui.current_db.authors(book_id, index_is_id=True)
+            authors = authors_map.get(book_id)
             if authors:
-                authors = [x.replace('|', ',') for x in authors.split(',')]
                 self.log('Series: <b>%s</b> - Author: <b>%s</b>'%
                          (series_name, authors_to_string(authors)))
             else:
@@ -338,19 +301,16 @@ class MetadataCheck(BaseCheck):
         max_tags = c[cfg.KEY_MAX_TAGS]
         excluded_tags_set = set(c[cfg.KEY_MAX_TAG_EXCLUSIONS])
 
-        def evaluate_book(book_id, db):
-            tags = db.tags(book_id, index_is_id=True)
+        def evaluate_book(book_id, tags):
             if tags:
-                tags = [t.strip() for t in tags.split(',')]
                 tags_set = set(tags) - excluded_tags_set
                 if len(tags_set) > max_tags:
                     return True
             return False
 
-        self.check_all_files(evaluate_book,
-                             no_match_msg=_('All searched books have a valid tag count'),
-                             marked_text='excess_tags',
-                             status_msg_type=_('books for invalid tag count'))
+        self.check_all_metadata(['tags'], evaluate_book,
+                                no_match_msg=_('All searched books have a valid tag count'),
+                                marked_text='excess_tags')
 
 
     def check_html_comments(self):
@@ -370,8 +330,7 @@ class MetadataCheck(BaseCheck):
                 ]
         ]
 
-        def evaluate_book(book_id, db):
-            comments = db.comments(book_id, index_is_id=True)
+        def evaluate_book(book_id, comments):
             if comments:
                 has_html = False
                 for pat in html_patterns:
@@ -382,10 +341,9 @@ class MetadataCheck(BaseCheck):
                     return True
             return False
 
-        self.check_all_files(evaluate_book,
-                             no_match_msg=_('All searched books have no HTML in comments'),
-                             marked_text='html_in_comments',
-                             status_msg_type=_('books for no HTML in comments'))
+        self.check_all_metadata(['comments'], evaluate_book,
+                                no_match_msg=_('All searched books have no HTML in comments'),
+                                marked_text='html_in_comments')
 
 
     def check_no_html_comments(self):
@@ -407,8 +365,7 @@ class MetadataCheck(BaseCheck):
                 ]
         ]
 
-        def evaluate_book(book_id, db):
-            comments = db.comments(book_id, index_is_id=True)
+        def evaluate_book(book_id, comments):
             if comments:
                 has_no_html = True
                 for pat in no_html_patterns:
@@ -419,147 +376,124 @@ class MetadataCheck(BaseCheck):
                     return True
             return False
 
-        self.check_all_files(evaluate_book,
-                             no_match_msg=_('All searched books have HTML in comments'),
-                             marked_text='no_html_in_comments',
-                             status_msg_type=_('books for HTML in comments'))
+        self.check_all_metadata(['comments'], evaluate_book,
+                                no_match_msg=_('All searched books have HTML in comments'),
+                                marked_text='no_html_in_comments')
 
 
     def check_authors_commas(self):
 
-        def evaluate_book(book_id, db):
-            authors = db.authors(book_id, index_is_id=True)
+        def evaluate_book(book_id, authors):
             if authors:
-                authors = [a.strip().replace('|', ',') for a in authors.split(',')]
                 for author in authors:
                     if ',' in author:
                         return True
             return False
 
-        self.check_all_files(evaluate_book,
-                             no_match_msg=_('All searched book authors have no commas'),
-                             marked_text='authors_commas',
-                             status_msg_type=_('books with authors having commas'))
+        self.check_all_metadata(['authors'], evaluate_book,
+                                no_match_msg=_('All searched book authors have no commas'),
+                                marked_text='authors_commas')
 
 
     def check_authors_no_commas(self):
 
-        def evaluate_book(book_id, db):
-            authors = db.authors(book_id, index_is_id=True)
+        def evaluate_book(book_id, authors):
             if authors:
-                authors = [a.strip().replace('|', ',') for a in authors.split(',')]
                 for author in authors:
                     if ',' not in author:
                         return True
             return False
 
-        self.check_all_files(evaluate_book,
-                             no_match_msg=_('All searched book authors have commas'),
-                             marked_text='authors_no_commas',
-                             status_msg_type=_('books with authors not having commas'))
+        self.check_all_metadata(['authors'], evaluate_book,
+                                no_match_msg=_('All searched book authors have commas'),
+                                marked_text='authors_no_commas')
 
 
     def check_authors_case(self):
 
-        def evaluate_book(book_id, db):
-            authors = db.authors(book_id, index_is_id=True)
+        def evaluate_book(book_id, authors):
             if authors:
-                authors = [a.strip().replace('|', ',') for a in authors.split(',')]
                 for author in authors:
                     if author == author.upper() or author == author.lower():
                         return True
             return False
 
-        self.check_all_files(evaluate_book,
-                             no_match_msg=_('All searched authors have a valid casing'),
-                             marked_text='invalid_author_case',
-                             status_msg_type=_('books for invalid author casing'))
+        self.check_all_metadata(['authors'], evaluate_book,
+                                no_match_msg=_('All searched authors have a valid casing'),
+                                marked_text='invalid_author_case')
 
 
     def check_authors_non_alpha(self):
         RE_ALPHA = re.compile(r'[^A-Za-z\'\.,\- ]', re.UNICODE)
         handler = get_udc()
 
-        def evaluate_book(book_id, db):
-            authors = db.authors(book_id, index_is_id=True)
+        def evaluate_book(book_id, authors):
             if authors:
-                authors = [a.strip().replace('|', ',') for a in authors.split(',')]
                 for author in authors:
                     ascii_author = handler.decode(author)
                     if RE_ALPHA.search(ascii_author):
                         return True
             return False
 
-        self.check_all_files(evaluate_book,
-                             no_match_msg=_('All searched book authors have alphabetic names'),
-                             marked_text='authors_non_alphabetic',
-                             status_msg_type=_('books with authors having non-alphabetic names'))
+        self.check_all_metadata(['authors'], evaluate_book,
+                                no_match_msg=_('All searched book authors have alphabetic names'),
+                                marked_text='authors_non_alphabetic')
 
 
     def check_authors_non_ascii(self):
         handler = get_udc()
 
-        def evaluate_book(book_id, db):
-            authors = db.authors(book_id, index_is_id=True)
+        def evaluate_book(book_id, authors):
             if authors:
-                authors = [a.strip().replace('|', ',') for a in authors.split(',')]
                 for author in authors:
                     ascii_author = handler.decode(author)
                     if ascii_author != author:
                         return True
             return False
 
-        self.check_all_files(evaluate_book,
-                             no_match_msg=_('All searched book authors have ascii names'),
-                             marked_text='authors_non_ascii',
-                             status_msg_type=_('books with authors having non-ascii names'))
+        self.check_all_metadata(['authors'], evaluate_book,
+                                no_match_msg=_('All searched book authors have ascii names'),
+                                marked_text='authors_non_ascii')
 
 
     def check_authors_initials(self):
         c = cfg.plugin_prefs[cfg.STORE_OPTIONS]
         initials_mode = c.get(cfg.KEY_AUTHOR_INITIALS_MODE, cfg.AUTHOR_INITIALS_MODES[0])
 
-        def evaluate_book(book_id, db):
-            authors = db.authors(book_id, index_is_id=True)
+        def evaluate_book(book_id, authors):
             if authors:
-                authors = [a.strip().replace('|', ',') for a in authors.split(',')]
                 for author in authors:
                     expected_author = get_formatted_author_initials(initials_mode, author)
                     if expected_author != author:
                         return True
             return False
 
-        self.check_all_files(evaluate_book,
-                             no_match_msg=_('All searched book authors have correct initials'),
-                             marked_text='authors_incorrect_initials',
-                             status_msg_type=_('books with authors having incorrect initials'))
+        self.check_all_metadata(['authors'], evaluate_book,
+                                no_match_msg=_('All searched book authors have correct initials'),
+                                marked_text='authors_incorrect_initials')
 
 
     def check_titles_series(self):
 
-        def evaluate_book(book_id, db):
-            title = db.title(book_id, index_is_id=True)
+        def evaluate_book(book_id, title):
             if '-' not in title:
                 if re.match(r'[0-9]', title) is None:
                     return False
             return True
 
-        self.check_all_files(evaluate_book,
-                             no_match_msg=_('All searched books do not have titles with series names'),
-                             marked_text='invalid_titles_series',
-                             status_msg_type=_('book titles with possible series names'))
+        self.check_all_metadata(['title'], evaluate_book,
+                                no_match_msg=_('All searched books do not have titles with series names'),
+                                marked_text='invalid_titles_series')
 
 
     def check_titles_titlecase(self):
 
-        def evaluate_book(book_id, db):
-            title = db.title(book_id, index_is_id=True)
+        def evaluate_book(book_id, title):
             if title != titlecase(title):
                 return True
             return False
 
-        self.check_all_files(evaluate_book,
-                             no_match_msg=_('All searched titles have a valid title casing'),
-                             marked_text='invalid_title_case',
-                             status_msg_type=_('books for invalid title casing'))
+        self.check_all_metadata(['title'], evaluate_book,
+                                no_match_msg=_('All searched titles have a valid title casing'),
+                                marked_text='invalid_title_case')
 
@@ -21,6 +21,7 @@ class MobiCheck(BaseCheck):
     All checks related to working with MOBI formats.
     '''
     MOBI_FORMATS = ['MOBI', 'AZW', 'AZW3']
+    WORKER_FORMATS = MOBI_FORMATS
 
     def __init__(self, gui):
         BaseCheck.__init__(self, gui, 'formats:=mobi or formats:=azw or formats:=azw3')
@@ -6,7 +6,7 @@ __copyright__ = '2011, Grant Drake'
 from six import text_type as unicode
 from six.moves import range
 
-import copy
+import copy, os
 from collections import OrderedDict
 
 try:
@@ -17,11 +17,11 @@ except NameError:
 try:
     from qt.core import (QWidget, QVBoxLayout, QLabel, QUrl,
                           QGroupBox, QGridLayout, QListWidget, QListWidgetItem,
-                          QAbstractItemView, Qt, QPushButton, QSpinBox)
+                          QAbstractItemView, Qt, QPushButton, QSpinBox, QCheckBox)
 except:
     from PyQt5.Qt import (QWidget, QVBoxLayout, QLabel, QUrl,
                           QGroupBox, QGridLayout, QListWidget, QListWidgetItem,
-                          QAbstractItemView, Qt, QPushButton, QSpinBox)
+                          QAbstractItemView, Qt, QPushButton, QSpinBox, QCheckBox)
 
 from calibre.gui2 import open_url
 from calibre.gui2.actions import menu_action_unique_name
@@ -31,6 +31,7 @@ from calibre.utils.config import JSONConfig
 from calibre_plugins.quality_check.common_icons import get_icon
 from calibre_plugins.quality_check.common_dialogs import KeyboardConfigDialog, PrefsViewerDialog
 from calibre_plugins.quality_check.common_widgets import KeyValueComboBox
+from calibre_plugins.quality_check.search_index import get_index_path
 
 HELP_URL = 'https://github.com/kiwidude68/calibre_plugins/wiki/Quality-Check'
 
@@ -42,6 +43,8 @@ KEY_MAX_TAGS = 'maxTags'
 KEY_MAX_TAG_EXCLUSIONS = 'maxTagExclusions'
 KEY_HIDDEN_MENUS = 'hiddenMenus'
 KEY_SEARCH_SCOPE = 'searchScope'
+KEY_WORKER_THREADS = 'workerThreads'
+KEY_CACHE_RESULTS = 'cacheResults'
 
 SCOPE_LIBRARY = 'Library'
 SCOPE_SELECTION = 'Selection'
@@ -50,6 +53,8 @@ DEFAULT_STORE_VALUES = {
                            KEY_MAX_TAGS: 5,
                            KEY_MAX_TAG_EXCLUSIONS: [],
                            KEY_HIDDEN_MENUS: [],
+                           KEY_WORKER_THREADS: 4,
+                           KEY_CACHE_RESULTS: True,
                        }
 
 # Per library we store an exclusions map
@@ -62,6 +67,12 @@ KEY_EXCLUSIONS_BY_CHECK = 'exclusionsByCheck'
 KEY_AUTHOR_INITIALS_MODE = 'authorInitialsMode'
 AUTHOR_INITIALS_MODES = ['A.B.', 'A. B.', 'A B', 'AB']
 
+# Results of file based checks are cached per book as custom book data, under
+# this prefix plus the check menu key.
+RESULT_CACHE_PREFIX = 'quality_check_results:'
+# Zip central directory listings of ePub books are cached per book under this name
+ARCHIVE_MANIFEST_KEY = 'quality_check_manifest:epub'
+
 DEFAULT_LIBRARY_VALUES = {
                           KEY_EXCLUSIONS_BY_CHECK: {  },
                          }
@@ -150,8 +161,12 @@ PLUGIN_MENUS = OrderedDict([
        ('check_missing_formats',    {'name': _('Check missing formats'),          'cat':'missing',  'sub_menu': _('Check missing'),  'group': 1, 'excludable': False,  'image': 'images/check_book.png',               'tooltip':_('Find books missing formats')}),
 
        ('search_epub',              {'name': _('Search ePubs')+'...',             'cat':'epub',     'sub_menu': '',               'group': 0, 'excludable': False, 'image': 'search.png',                           'tooltip':_('Find ePub books with text matching your own regular expression')}),
+       ('check_epub_suite',         {'name': _('Run ePub check suite')+'...',     'cat':'epub',     'sub_menu': '',               'group': 0, 'excludable': False, 'image': 'images/check_book.png',                'tooltip':_('Run a selection of ePub checks together, reading each ePub only once')}),
        ])
 
+# ePub menus that cannot be run as part of the ePub check suite
+EPUB_SUITE_EXCLUDED_MENUS = ['search_epub', 'check_epub_suite']
+
 
 PLUGIN_FIX_MENUS = OrderedDict([
        ('fix_swap_author_names',    {'name': _('Swap author FN LN <-> LN,FN'),   'cat':'fix',  'group': 0, 'image': 'images/check_comma.png',         'tooltip':_('For the selected book(s) swap author names between FN LN and LN, FN formats')}),
@@ -233,6 +248,15 @@ def set_excluded_books(db, menu_key, book_ids):
     exclusions_map[menu_key] = book_ids
     set_library_config(db, library_config)
 
+def clear_cached_results(db):
+    api = db.new_api
+    for menu_key in PLUGIN_MENUS:
+        api.delete_custom_book_data(RESULT_CACHE_PREFIX + menu_key)
+    api.delete_custom_book_data(ARCHIVE_MANIFEST_KEY)
+    index_path = get_index_path(db)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+
 def show_help():
     open_url(QUrl(HELP_URL))
 
@@ -316,6 +340,27 @@ class ConfigWidget(QWidget):
         initials_mode = c.get(KEY_AUTHOR_INITIALS_MODE, AUTHOR_INITIALS_MODES[0])
         self.initials_combo = KeyValueComboBox(self, initials_map, initials_mode)
         other_layout.addWidget(self.initials_combo, 0, 1, 1, 1)
+
+        workers_label = QLabel(_('Worker threads:'), self)
+        workers_label.setToolTip(_('The number of books to check at once for ePub, MOBI and cover checks.\n'
+                                   'Set to 1 to check one book at a time in the calibre interface thread.'))
+        other_layout.addWidget(workers_label, 1, 0, 1, 1)
+        self.worker_threads_spin = QSpinBox(self)
+        self.worker_threads_spin.setMinimum(1)
+        self.worker_threads_spin.setMaximum(16)
+        self.worker_threads_spin.setProperty('value', c.get(KEY_WORKER_THREADS, DEFAULT_STORE_VALUES[KEY_WORKER_THREADS]))
+        other_layout.addWidget(self.worker_threads_spin, 1, 1, 1, 1)
+
+        self.cache_results_checkbox = QCheckBox(_('Cache results of ePub, MOBI and cover checks'), self)
+        self.cache_results_checkbox.setToolTip(_('Books whose files have not changed since a check was last run with the same options\n'
+                                                 'will report their previous result rather than being checked again.\n'
+                                                 'Use "Repeat last check (full rescan)" to ignore the cached results.'))
+        self.cache_results_checkbox.setChecked(c.get(KEY_CACHE_RESULTS, True))
+        other_layout.addWidget(self.cache_results_checkbox, 2, 0, 1, 2)
+        clear_cache_button = QPushButton(_('Clear cached results'), self)
+        clear_cache_button.setToolTip(_('Remove the cached check results and ePub text index for all books in this library'))
+        clear_cache_button.clicked.connect(self.clear_cached_results)
+        other_layout.addWidget(clear_cache_button, 2, 2, 1, 1)
         other_layout.setColumnStretch(2, 1)
 
         menus_groupbox = QGroupBox(_('Visible menus'))
@@ -349,6 +394,8 @@ class ConfigWidget(QWidget):
             exclude_tag_text = exclude_tag_text[:-1]
         new_prefs[KEY_MAX_TAG_EXCLUSIONS] = [t.strip() for t in exclude_tag_text.split(',')]
         new_prefs[KEY_AUTHOR_INITIALS_MODE] = self.initials_combo.selected_key()
+        new_prefs[KEY_WORKER_THREADS] = int(unicode(self.worker_threads_spin.value()))
+        new_prefs[KEY_CACHE_RESULTS] = self.cache_results_checkbox.isChecked()
         new_prefs[KEY_SEARCH_SCOPE] = plugin_prefs[STORE_OPTIONS].get(KEY_SEARCH_SCOPE, SCOPE_LIBRARY)
 
         new_prefs[KEY_HIDDEN_MENUS] = self.visible_menus_list.get_hidden_menus()
@@ -367,6 +414,9 @@ class ConfigWidget(QWidget):
 
         plugin_prefs[STORE_OPTIONS] = new_prefs
 
+    def clear_cached_results(self):
+        clear_cached_results(self.plugin_action.gui.current_db)
+
     def edit_shortcuts(self):
         d = KeyboardConfigDialog(self.plugin_action.gui, self.plugin_action.action_spec[0])
         if d.exec_() == d.Accepted:
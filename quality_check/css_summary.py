@@ -0,0 +1,95 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import re
+from collections import namedtuple
+
+# Every body or @page rule, noting a body selector used as a class name (.body)
+RE_BOOK_RULE = re.compile(r'(?P<dot>\.)?(?P<selector>\bbody|@page)\b\s*{(?P<styles>[^}]*)\}', re.UNICODE)
+RE_TEXT_ALIGN = re.compile(r'text\-align:\s*justify', re.UNICODE)
+
+# Only the start of an html file is looked at for inline body or @page styles
+HTML_HEAD_LENGTH = 1000
+
+CssRule = namedtuple('CssRule', 'selector styles dotted')
+
+
+class CssResource(object):
+    '''
+    The result of scanning one stylesheet, or the start of one html file, for the
+    body and @page rules, text-align:justify and @font-face declarations.
+    '''
+    def __init__(self, name, is_css, data):
+        self.name = name
+        self.is_css = is_css
+        self.has_font_face = '@font-face' in data
+        if is_css:
+            self.has_justify = RE_TEXT_ALIGN.search(data) is not None
+        else:
+            self.has_justify = False
+            data = data[:HTML_HEAD_LENGTH]
+        self.rules = [CssRule(m.group('selector'), m.group('styles'), bool(m.group('dot')))
+                      for m in RE_BOOK_RULE.finditer(data)]
+
+    def margin_rules(self, min_before=0, include_dotted=True):
+        '''
+        Return the rules whose styles mention margin with at least min_before
+        characters before it and one after, optionally excluding .body rules.
+        '''
+        rules = []
+        for rule in self.rules:
+            if rule.dotted and rule.selector == 'body' and not include_dotted:
+                continue
+            i = rule.styles.find('margin', min_before)
+            if i != -1 and i + len('margin') < len(rule.styles):
+                rules.append(rule)
+        return rules
+
+
+class BookCssSummary(object):
+    '''
+    The CSS related content of the stylesheets and html files of an ePub, each
+    read, lower cased and scanned once on first use then shared by all the CSS
+    checks run against the book.
+    '''
+    def __init__(self, names, read_text, css_extensions, non_html_extensions):
+        self.read_text = read_text
+        # Tuples of name, whether it has a css extension, whether it is html and
+        # whether the name ends in css, which is what the margin and justify
+        # checks treat as a stylesheet
+        self.entries = []
+        for name in names:
+            extension = name[name.rfind('.'):].lower()
+            is_css = extension in css_extensions
+            is_html = extension not in non_html_extensions
+            is_stylesheet = name.lower().endswith('css')
+            if is_css or is_html or is_stylesheet:
+                self.entries.append((name, is_css, is_html, is_stylesheet))
+        self._resources = {}
+
+    def resources(self, css=True, html=True):
+        '''
+        Yield the CssResource of each file with a css extension and/or each
+        html file, in zip order
+        '''
+        for name, is_css, is_html, _is_stylesheet in self.entries:
+            if is_css and css:
+                yield self._get_resource(name, True)
+            elif is_html and html:
+                yield self._get_resource(name, False)
+
+    def stylesheets(self):
+        '''
+        Yield the CssResource of each file whose name ends in css, in zip order
+        '''
+        for name, _is_css, _is_html, is_stylesheet in self.entries:
+            if is_stylesheet:
+                yield self._get_resource(name, True)
+
+    def _get_resource(self, name, is_css):
+        resource = self._resources.get((name, is_css))
+        if resource is None:
+            resource = self._resources[(name, is_css)] = CssResource(name, is_css, self.read_text(name).lower())
+        return resource
@@ -6,6 +6,9 @@ __copyright__ = '2011, Grant Drake'
 import six
 from six.moves import range
 from six import text_type as unicode
+from functools import partial
+from threading import Thread, Event
+from six.moves.queue import Queue, Empty
 
 try:
     load_translations()
@@ -16,12 +19,14 @@ try:
     from qt.core import (QVBoxLayout, QLabel, QRadioButton, QDialogButtonBox,
                           QGroupBox, QGridLayout, QComboBox, QProgressDialog,
                           QTimer, QIcon, QTableWidget, QHBoxLayout, QLayout,
-                          QAbstractItemView, Qt, QCheckBox, QSpinBox, QToolButton)
+                          QAbstractItemView, Qt, QCheckBox, QSpinBox, QToolButton,
+                          QListWidget, QListWidgetItem)
 except:
     from PyQt5.Qt import (QVBoxLayout, QLabel, QRadioButton, QDialogButtonBox,
                           QGroupBox, QGridLayout, QComboBox, QProgressDialog,
                           QTimer, QIcon, QTableWidget, QHBoxLayout, QLayout,
-                          QAbstractItemView, Qt, QCheckBox, QSpinBox, QToolButton)
+                          QAbstractItemView, Qt, QCheckBox, QSpinBox, QToolButton,
+                          QListWidget, QListWidgetItem)
 
 from calibre.ebooks.metadata import authors_to_string, fmt_sidx
 from calibre.gui2 import gprefs, error_dialog
@@ -35,9 +40,35 @@ from calibre_plugins.quality_check.common_widgets import ImageTitleLayout, ReadO
 def truncate_title(title, length = 75):
     return (title[:length] + '...') if len(title) > length else title
 
+class QualityCheckWorker(Thread):
+    '''
+    Evaluates books from a shared queue off the GUI thread, posting each
+    result back to the progress dialog.
+    '''
+    def __init__(self, callback_fn, db, book_queue, results_queue, abort):
+        Thread.__init__(self)
+        self.daemon = True
+        self.callback_fn, self.db = callback_fn, db
+        self.book_queue, self.results_queue, self.abort = book_queue, results_queue, abort
+
+    def run(self):
+        while not self.abort.is_set():
+            try:
+                index, book_id = self.book_queue.get_nowait()
+            except Empty:
+                return
+            self.results_queue.put((index, book_id, self.callback_fn(book_id, self.db)))
+
+
 class QualityProgressDialog(QProgressDialog):
 
-    def __init__(self, gui, book_ids, callback_fn, db, status_msg_type='books', action_type=_('Checking')):
+    def __init__(self, gui, book_ids, callback_fn, db, status_msg_type='books', action_type=_('Checking'),
+                 worker_count=1, result_fn=None):
+        '''
+        With a worker_count greater than one, callback_fn is called on worker
+        threads and result_fn(book_id, result) is then called on the GUI thread
+        for each book in order, returning whether the book matched.
+        '''
         self.total_count = len(book_ids)
         QProgressDialog.__init__(self, '', _('Cancel'), 0, self.total_count, gui)
         self.setMinimumWidth(500)
@@ -46,10 +77,52 @@ class QualityProgressDialog(QProgressDialog):
         self.gui = gui
         self.setWindowTitle('%s %d %s...' % (self.action_type, self.total_count, self.status_msg_type))
         self.i, self.result_ids = 0, []
+        self.result_fn = result_fn
+        self.abort = Event()
+        self.workers, self.results_queue, self.pending_results = [], None, {}
         # QTimer workaround on Win 10 on first go for Win10/Qt6 users not displaying dialog properly.
-        QTimer.singleShot(100, self.do_book_action)
+        if worker_count > 1:
+            QTimer.singleShot(100, partial(self.start_workers, worker_count))
+        else:
+            QTimer.singleShot(100, self.do_book_action)
         self.exec_()
 
+    def start_workers(self, worker_count):
+        if self.wasCanceled():
+            return self.do_close()
+        book_queue = Queue()
+        for index, book_id in enumerate(self.book_ids):
+            book_queue.put((index, book_id))
+        self.results_queue = Queue()
+        for i in range(min(worker_count, self.total_count)):
+            worker = QualityCheckWorker(self.callback_fn, self.db, book_queue, self.results_queue, self.abort)
+            self.workers.append(worker)
+            worker.start()
+        self.do_poll_results()
+
+    def do_poll_results(self):
+        if self.wasCanceled():
+            return self.do_close()
+        while True:
+            try:
+                index, book_id, result = self.results_queue.get_nowait()
+            except Empty:
+                break
+            self.pending_results[index] = (book_id, result)
+        # Apply results in book order so the log reads the same as a serial run
+        while self.i in self.pending_results:
+            book_id, result = self.pending_results.pop(self.i)
+            self.i += 1
+            if self.result_fn(book_id, result):
+                self.result_ids.append(book_id)
+            dtitle = truncate_title(self.db.title(book_id, index_is_id=True))
+            self.setWindowTitle(_('%s %d %s  (%d matches)...') % (self.action_type, self.total_count, self.status_msg_type, len(self.result_ids)))
+            self.setLabelText('%s: %s'%(self.action_type, dtitle))
+            self.setValue(self.i)
+        if self.i >= self.total_count:
+            return self.do_close()
+        QTimer.singleShot(50, self.do_poll_results)
+
     def do_book_action(self):
         if self.wasCanceled():
             return self.do_close()
@@ -68,9 +141,28 @@ class QualityProgressDialog(QProgressDialog):
         QTimer.singleShot(0, self.do_book_action)
 
     def do_close(self):
+        self.stop_workers()
         self.hide()
         self.gui = None
 
+    def stop_workers(self):
+        '''
+        Wait for any worker threads to finish the book they are checking, so
+        nothing is still using the plugin's shared state once the dialog returns.
+        Results of books checked after a cancel are discarded.
+        '''
+        self.abort.set()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        if self.results_queue is not None:
+            while True:
+                try:
+                    self.results_queue.get_nowait()
+                except Empty:
+                    break
+            self.pending_results.clear()
+
 
 class CompareTypeComboBox(QComboBox):
 
@@ -482,6 +574,7 @@ class SearchEpubDialog(SizePersistedDialog):
 
         self.ignore_case_checkbox.setChecked(search_opts.get('ignore_case', True))
         self.show_all_matches_checkbox.setChecked(search_opts.get('show_all_matches', False))
+        self.use_index_checkbox.setChecked(search_opts.get('use_index', False))
         self.scope_html_checkbox.setChecked(search_opts.get('scope_html', True))
         self.scope_css_checkbox.setChecked(search_opts.get('scope_css', False))
         self.scope_plaintext_checkbox.setChecked(search_opts.get('scope_plaintext', False))
@@ -525,6 +618,11 @@ class SearchEpubDialog(SizePersistedDialog):
         self.show_all_matches_checkbox.setToolTip(_('If unchecked, the search of each ePub is stopped as soon as the first match is found.\n'
                                                   'If checked, all occurrences will be displayed in the log but it will run much slower.'))
         find_layout.addWidget(self.show_all_matches_checkbox)
+        self.use_index_checkbox = QCheckBox(_('Use text &index'), self)
+        self.use_index_checkbox.setToolTip(_('Only used when searching Plain text content alone.\n'
+                                           'Keeps an index of the body text of each ePub, updated when the ePub changes,\n'
+                                           'so repeated searches only need to open new or changed ePubs.'))
+        find_layout.addWidget(self.use_index_checkbox)
 
         layout.addSpacing(5)
         scope_group = QGroupBox(_('Scope'), self)
@@ -585,6 +683,7 @@ class SearchEpubDialog(SizePersistedDialog):
         search_opts['previous_finds'] = self.previous_finds[:10]
         search_opts['ignore_case'] = self.ignore_case_checkbox.isChecked()
         search_opts['show_all_matches'] = self.show_all_matches_checkbox.isChecked()
+        search_opts['use_index'] = self.use_index_checkbox.isChecked()
         search_opts['scope_html'] = self.scope_html_checkbox.isChecked()
         search_opts['scope_css'] = self.scope_css_checkbox.isChecked()
         search_opts['scope_plaintext'] = self.scope_plaintext_checkbox.isChecked()
@@ -605,6 +704,86 @@ class SearchEpubDialog(SizePersistedDialog):
         return self.search_opts
 
 
+class EpubCheckSuiteDialog(SizePersistedDialog):
+
+    def __init__(self, parent):
+        SizePersistedDialog.__init__(self, parent, _('quality check plugin:epub check suite dialog'))
+
+        self.initialize_controls()
+
+        # Tick the checks that were selected the last time the dialog was used.
+        last_checks = gprefs.get(self.unique_pref_name+':selected_checks', [])
+        for x in range(self.checks_list.count()):
+            item = self.checks_list.item(x)
+            if unicode(item.data(Qt.UserRole)) in last_checks:
+                item.setCheckState(Qt.Checked)
+
+        # Cause our dialog size to be restored from prefs or created on first usage
+        self.resize_dialog()
+
+    def initialize_controls(self):
+        self.setWindowTitle('Quality Check')
+        layout = QVBoxLayout(self)
+        self.setLayout(layout)
+        title_layout = ImageTitleLayout(self, 'images/check_book.png', _('Run ePub Check Suite'))
+        layout.addLayout(title_layout)
+
+        layout.addWidget(QLabel(_('Run the following checks, reading each ePub only once:'), self))
+        self.checks_list = QListWidget(self)
+        self.checks_list.setSelectionMode(QAbstractItemView.NoSelection)
+        hidden_menus = cfg.plugin_prefs[cfg.STORE_OPTIONS].get(cfg.KEY_HIDDEN_MENUS, [])
+        for menu_key, value in cfg.PLUGIN_MENUS.items():
+            if value['cat'] != 'epub' or menu_key in cfg.EPUB_SUITE_EXCLUDED_MENUS:
+                continue
+            if menu_key in hidden_menus:
+                continue
+            name = value['name']
+            if value['sub_menu']:
+                name = value['sub_menu'] + ' -> ' + name
+            item = QListWidgetItem(get_icon(value['image']), name, self.checks_list)
+            item.setData(Qt.UserRole, menu_key)
+            item.setCheckState(Qt.Unchecked)
+        layout.addWidget(self.checks_list)
+
+        select_layout = QHBoxLayout()
+        layout.addLayout(select_layout)
+        select_all_button = QToolButton(self)
+        select_all_button.setText(_('Select all'))
+        select_all_button.clicked.connect(partial(self._set_all_checked, Qt.Checked))
+        select_layout.addWidget(select_all_button)
+        clear_all_button = QToolButton(self)
+        clear_all_button.setText(_('Clear all'))
+        clear_all_button.clicked.connect(partial(self._set_all_checked, Qt.Unchecked))
+        select_layout.addWidget(clear_all_button)
+        select_layout.addStretch(1)
+
+        # Dialog buttons
+        button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        button_box.accepted.connect(self.ok_clicked)
+        button_box.rejected.connect(self.reject)
+        layout.addWidget(button_box)
+
+    def _set_all_checked(self, state):
+        for x in range(self.checks_list.count()):
+            self.checks_list.item(x).setCheckState(state)
+
+    def ok_clicked(self):
+        if not self.selected_checks:
+            return error_dialog(self, _('No checks selected'),
+                _('You must select at least one check to run.'), show=True)
+        gprefs[self.unique_pref_name+':selected_checks'] = self.selected_checks
+        self.accept()
+
+    @property
+    def selected_checks(self):
+        selected = []
+        for x in range(self.checks_list.count()):
+            item = self.checks_list.item(x)
+            if item.checkState() == Qt.Checked:
+                selected.append(unicode(item.data(Qt.UserRole)).strip())
+        return selected
+
+
 class ApplyFixProgressDialog(QProgressDialog):
 
     def __init__(self, gui, title, book_ids, tdir, apply_fix_callback):
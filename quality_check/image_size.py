@@ -0,0 +1,105 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import os, struct
+
+# Enough for the headers of PNG, GIF and WebP images. JPEG segments are skipped over
+# using the buffered file, so only the blocks holding the markers are read.
+HEADER_SIZE = 64
+
+# JPEG start of frame markers, which hold the image dimensions
+JPEG_SOF_MARKERS = frozenset([0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                              0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF])
+# JPEG markers that have no length or payload
+JPEG_STANDALONE_MARKERS = frozenset([0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8])
+
+# Map of path to (size, mtime, (width, height)) for images already probed
+_dimensions_cache = {}
+
+
+def _jpeg_dimensions(f):
+    # Walk the marker segments, skipping over their payloads, up to the start of frame
+    f.seek(2)
+    while True:
+        if f.read(1) != b'\xff':
+            return None
+        marker = f.read(1)
+        while marker == b'\xff':
+            # Fill bytes before the marker
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = ord(marker)
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        data = f.read(2)
+        if len(data) < 2:
+            return None
+        if marker in JPEG_SOF_MARKERS:
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            height, width = struct.unpack(b'>HH', data[1:5])
+            return width, height
+        length = struct.unpack(b'>H', data)[0]
+        if length < 2:
+            return None
+        f.seek(length - 2, 1)
+
+
+def _webp_dimensions(header):
+    chunk = header[12:16]
+    if chunk == b'VP8 ' and len(header) >= 30 and header[23:26] == b'\x9d\x01\x2a':
+        width, height = struct.unpack(b'<HH', header[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L' and len(header) >= 25 and header[20:21] == b'\x2f':
+        bits = struct.unpack(b'<I', header[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X' and len(header) >= 30:
+        width = struct.unpack(b'<I', header[24:27] + b'\x00')[0]
+        height = struct.unpack(b'<I', header[27:30] + b'\x00')[0]
+        return width + 1, height + 1
+    return None
+
+
+def probe_image_dimensions(path):
+    '''
+    Return the (width, height) of a JPEG, PNG, GIF or WebP image by reading only
+    its header rather than decoding it, or None if it is not a format recognised here.
+    '''
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+        if header[:2] == b'\xff\xd8':
+            return _jpeg_dimensions(f)
+        if header[:8] == b'\x89PNG\r\n\x1a\n' and header[12:16] == b'IHDR':
+            return struct.unpack(b'>II', header[16:24])
+        if header[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack(b'<HH', header[6:10])
+        if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+            return _webp_dimensions(header)
+    return None
+
+
+def get_image_dimensions(path):
+    '''
+    Return the (width, height) of the image at this path, reusing the result of a
+    previous call while the file size and modification time are unchanged. Images
+    whose header cannot be probed are opened with PIL, which raises IOError if the
+    image cannot be identified.
+    '''
+    st = os.stat(path)
+    cached = _dimensions_cache.get(path)
+    if cached is not None and cached[:2] == (st.st_size, st.st_mtime):
+        return cached[2]
+    try:
+        dimensions = probe_image_dimensions(path)
+    except (struct.error, TypeError):
+        dimensions = None
+    if dimensions is None:
+        from PIL import Image
+        dimensions = Image.open(path).size
+    dimensions = tuple(dimensions)
+    _dimensions_cache[path] = (st.st_size, st.st_mtime, dimensions)
+    return dimensions
@@ -0,0 +1,161 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import os, sqlite3, threading
+from six import unichr
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+from calibre.utils.config import config_dir
+
+INDEX_DIR = 'plugins/Quality Check Search Index'
+SCHEMA_VERSION = 1
+# The trigram tokenizer cannot match on fragments shorter than this
+MIN_FRAGMENT_LENGTH = 3
+
+
+def get_index_path(db):
+    return os.path.join(config_dir, INDEX_DIR, '%s.sqlite' % db.library_id)
+
+
+def required_literals(pattern, flags=0):
+    '''
+    Return the runs of literal text that any match of this regular expression
+    must contain, ignoring runs too short for the trigram index to look up.
+    Only literals at the top level of the expression are considered, so an
+    expression using alternation at the top level returns nothing.
+    '''
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return []
+    literals = []
+    run = []
+    for op, av in list(parsed) + [(None, None)]:
+        if op == sre_parse.LITERAL:
+            run.append(unichr(av))
+            continue
+        if len(run) >= MIN_FRAGMENT_LENGTH:
+            literals.append(''.join(run))
+        run = []
+    return literals
+
+
+class EpubTextIndex(object):
+    '''
+    A persistent SQLite FTS5 index of the plain body text of each html resource
+    in the ePub of each book. A book is re-indexed whenever its ePub changes size
+    or modification time. The connection is shared between worker threads, so all
+    access is serialised through a lock.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        dir_name = os.path.dirname(path)
+        if not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        try:
+            self._create_schema()
+        except:
+            self.conn.close()
+            raise
+
+    @classmethod
+    def open(cls, db):
+        '''
+        Open the index for this library, or return None if this build of SQLite
+        does not support FTS5 with the trigram tokenizer.
+        '''
+        try:
+            return cls(get_index_path(db))
+        except (sqlite3.Error, EnvironmentError):
+            return None
+
+    def _create_schema(self):
+        c = self.conn
+        if c.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            c.executescript('''
+                DROP TABLE IF EXISTS books;
+                DROP TABLE IF EXISTS texts;
+                DROP TABLE IF EXISTS texts_fts;
+                ''')
+        c.executescript('''
+            CREATE TABLE IF NOT EXISTS books(book_id INTEGER PRIMARY KEY, path TEXT,
+                                             size INTEGER, mtime REAL);
+            CREATE TABLE IF NOT EXISTS texts(id INTEGER PRIMARY KEY, book_id INTEGER,
+                                             seq INTEGER, resource_name TEXT, body TEXT);
+            CREATE INDEX IF NOT EXISTS texts_book_idx ON texts(book_id);
+            CREATE VIRTUAL TABLE IF NOT EXISTS texts_fts USING fts5(body,
+                content='texts', content_rowid='id', tokenize='trigram');
+            ''')
+        c.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
+        c.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def is_current(self, book_id, path_to_book):
+        st = os.stat(path_to_book)
+        with self.lock:
+            row = self.conn.execute('SELECT path, size, mtime FROM books WHERE book_id=?',
+                                    (book_id,)).fetchone()
+        return row is not None and tuple(row) == (path_to_book, st.st_size, st.st_mtime)
+
+    def update_book(self, book_id, path_to_book, resources):
+        '''
+        Replace the indexed text for this book with the list of (resource_name, body)
+        tuples, recording the current size and mtime of its ePub.
+        '''
+        st = os.stat(path_to_book)
+        with self.lock:
+            c = self.conn
+            self._delete_book(book_id)
+            for seq, (resource_name, body) in enumerate(resources):
+                cur = c.execute('INSERT INTO texts(book_id, seq, resource_name, body) VALUES (?,?,?,?)',
+                                (book_id, seq, resource_name, body))
+                c.execute('INSERT INTO texts_fts(rowid, body) VALUES (?,?)', (cur.lastrowid, body))
+            c.execute('INSERT INTO books(book_id, path, size, mtime) VALUES (?,?,?,?)',
+                      (book_id, path_to_book, st.st_size, st.st_mtime))
+            c.commit()
+
+    def _delete_book(self, book_id):
+        c = self.conn
+        rows = c.execute('SELECT id, body FROM texts WHERE book_id=?', (book_id,)).fetchall()
+        for rowid, body in rows:
+            c.execute("INSERT INTO texts_fts(texts_fts, rowid, body) VALUES ('delete',?,?)", (rowid, body))
+        c.execute('DELETE FROM texts WHERE book_id=?', (book_id,))
+        c.execute('DELETE FROM books WHERE book_id=?', (book_id,))
+
+    def get_texts(self, book_id):
+        with self.lock:
+            return self.conn.execute('SELECT resource_name, body FROM texts WHERE book_id=? ORDER BY seq',
+                                     (book_id,)).fetchall()
+
+    def find_candidate_books(self, literals):
+        '''
+        Return the set of indexed book ids whose text contains all of these literal
+        fragments, ignoring case. This is a superset of the books a regular expression
+        requiring these fragments can match.
+        '''
+        query = ' AND '.join('"%s"' % l.replace('"', '""') for l in literals)
+        with self.lock:
+            rows = self.conn.execute('SELECT DISTINCT t.book_id FROM texts t JOIN texts_fts f ON f.rowid = t.id '
+                                     'WHERE texts_fts MATCH ?', (query,)).fetchall()
+        return set(r[0] for r in rows)
+
+    def clear(self):
+        with self.lock:
+            self.conn.executescript('''
+                DELETE FROM texts;
+                DELETE FROM books;
+                INSERT INTO texts_fts(texts_fts) VALUES('delete-all');
+                ''')
+            self.conn.commit()
@@ -0,0 +1,90 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import codecs
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+STREAM_BLOCK_SIZE = 64 * 1024
+# Expressions able to match more characters than this are searched in full
+MAX_STREAM_MATCH_WIDTH = 4096
+NBSP_ENTITY = '&nbsp;'
+# Opcodes whose result depends on text outside the match itself
+CONTEXT_OPCODES = (sre_parse.ASSERT, sre_parse.ASSERT_NOT,
+                   sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS)
+
+
+def _uses_context(parsed):
+    for op, av in parsed:
+        if op in CONTEXT_OPCODES:
+            return True
+        items = av if isinstance(av, (list, tuple)) else [av]
+        for item in items:
+            if isinstance(item, sre_parse.SubPattern):
+                if _uses_context(item):
+                    return True
+            elif isinstance(item, (list, tuple)):
+                if any(isinstance(i, sre_parse.SubPattern) and _uses_context(i) for i in item):
+                    return True
+    return False
+
+
+def get_stream_match_width(expression):
+    '''
+    Return the longest match possible for this compiled expression if it can be
+    searched a block at a time, or None if the content must be searched in full.
+    That is the case for unbounded or empty matches, lookarounds and backreferences.
+    '''
+    try:
+        parsed = sre_parse.parse(expression.pattern, expression.flags)
+    except Exception:
+        return None
+    lo, hi = parsed.getwidth()
+    if lo == 0 or hi > MAX_STREAM_MATCH_WIDTH or _uses_context(parsed):
+        return None
+    return hi
+
+
+def iter_stream_matches(fileobj, expression, width, context_chars, stop_at_first=False):
+    '''
+    Search the utf-8 content of fileobj a block at a time with any &nbsp; entities
+    replaced by spaces, yielding (text, match) for each match found, where text holds
+    at least context_chars either side of the match. The matches are the same as
+    expression.finditer() over the whole decoded content, but only the current block
+    plus a window of width and context_chars is held in memory.
+    '''
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    buf = pending = ''
+    # Absolute positions of the start of buf and of where the next search starts
+    offset = pos = 0
+    final = False
+    while not final:
+        block = fileobj.read(STREAM_BLOCK_SIZE)
+        final = not block
+        text = pending + decoder.decode(block, final)
+        pending = ''
+        if not final:
+            # Hold back a partial &nbsp; entity until the next block completes it
+            amp = text.rfind('&', max(0, len(text) - len(NBSP_ENTITY) + 1))
+            if amp != -1 and NBSP_ENTITY.startswith(text[amp:]):
+                text, pending = text[:amp], text[amp:]
+        buf += text.replace(NBSP_ENTITY, ' ')
+        # A match starting before limit cannot be extended by, or need context from, the next block
+        limit = len(buf) if final else len(buf) - width - context_chars
+        for m in expression.finditer(buf, pos - offset):
+            if m.start() >= limit:
+                break
+            yield buf, m
+            if stop_at_first:
+                return
+            pos = offset + m.end()
+        pos = max(pos, offset + limit)
+        cut = pos - offset - context_chars
+        if cut > 0:
+            buf = buf[cut:]
+            offset += cut